@@ -0,0 +1,21 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    Table('dataset', meta, autoload=True)
+    datasetinstance = Table('datasetinstance', meta,
+            Column('id', Integer, primary_key=True),
+            Column('uid', LargeBinary(32), index=True),
+            Column('digest', LargeBinary(20)),
+            Column('dataset_id', Integer, ForeignKey('dataset.id', name='datasetinstance_dataset_id_fk'), index=True),
+            )
+    datasetinstance.create()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    Table('datasetinstance', meta, autoload=True).drop()
@@ -0,0 +1,39 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    dataset = Table('dataset', meta, autoload=True)
+    datasetfile = Table('datasetfile', meta,
+            Column('id', Integer, primary_key=True),
+            Column('name', String(255)),
+            Column('size', BigInteger),
+            Column('uncompressed_size', BigInteger),
+            Column('mtime', DateTime),
+            Column('digest', LargeBinary(20)),
+            Column('dataset_id', Integer, ForeignKey('dataset.id', name='datasetfile_dataset_id_fk'), index=True),
+            )
+    datasetfile.create()
+    # sizes and times are filled in as datasets are next sorted or scheduled
+    rows = [{'dataset_id': dataset_id, 'name': name}
+            for dataset_id, filenames in migrate_engine.execute(select([dataset.c.id, dataset.c.filenames]))
+            for name in (filenames.split(', ') if filenames else [])]
+    if rows:
+        migrate_engine.execute(datasetfile.insert(), rows)
+    dataset.c.filenames.drop()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    dataset = Table('dataset', meta, autoload=True)
+    datasetfile = Table('datasetfile', meta, autoload=True)
+    Column('filenames', String, default='').create(dataset)
+    filenames = {}
+    for dataset_id, name in migrate_engine.execute(select([datasetfile.c.dataset_id, datasetfile.c.name]).order_by(datasetfile.c.name)):
+        filenames.setdefault(dataset_id, []).append(name)
+    for dataset_id, names in filenames.iteritems():
+        migrate_engine.execute(dataset.update().where(dataset.c.id == dataset_id).values(filenames=', '.join(names)))
+    datasetfile.drop()
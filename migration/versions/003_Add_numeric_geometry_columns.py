@@ -0,0 +1,64 @@
+import re
+
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+VECTORS = [
+        ('fov', Float, ['fov_x', 'fov_y']),
+        ('mm_per_vox', Float, ['mm_per_vox_x', 'mm_per_vox_y', 'mm_per_vox_z']),
+        ('acquisition_matrix', Integer, ['acquisition_matrix_x', 'acquisition_matrix_y']),
+        ]
+
+
+def parse(string, type_, size):
+    """Parse '[2.0, 2.0, 2.0]' or '[ 2.  2.  2.]' into a list of size values, padded with None."""
+    values = [type_(float(v)) for v in NUMBER.findall(string or '')][:size]
+    return values + [None] * (size - len(values))
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    epoch = Table('epoch', meta, autoload=True)
+    for name, type_, colnames in VECTORS:
+        for colname in colnames:
+            Column(colname, type_).create(epoch)
+
+    rows = []
+    for row in migrate_engine.execute(select([epoch.c.datacontainer_id] + [epoch.c[name] for name, type_, colnames in VECTORS])):
+        values = {'epoch_id': row[0]}
+        for name, type_, colnames in VECTORS:
+            values.update(zip(['new_' + cn for cn in colnames], parse(row[name], int if type_ is Integer else float, len(colnames))))
+        rows.append(values)
+    if rows:
+        update = epoch.update().where(epoch.c.datacontainer_id == bindparam('epoch_id'))
+        update = update.values(**dict((cn, bindparam('new_' + cn)) for name, type_, colnames in VECTORS for cn in colnames))
+        migrate_engine.execute(update, rows)
+    for name, type_, colnames in VECTORS:
+        epoch.c[name].drop()
+    Index('ix_epoch_fov_x', epoch.c.fov_x).create()
+    Index('ix_epoch_mm_per_vox_x', epoch.c.mm_per_vox_x).create()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    epoch = Table('epoch', meta, autoload=True)
+    for name, type_, colnames in VECTORS:
+        Column(name, Unicode(255)).create(epoch)
+    rows = []
+    for row in migrate_engine.execute(select([epoch.c.datacontainer_id] + [epoch.c[cn] for name, type_, colnames in VECTORS for cn in colnames])):
+        values = {'epoch_id': row[0]}
+        for name, type_, colnames in VECTORS:
+            vector = [row[cn] for cn in colnames if row[cn] is not None]
+            values['old_' + name] = unicode(str(vector)) if vector else None
+        rows.append(values)
+    if rows:
+        update = epoch.update().where(epoch.c.datacontainer_id == bindparam('epoch_id'))
+        update = update.values(**dict((name, bindparam('old_' + name)) for name, type_, colnames in VECTORS))
+        migrate_engine.execute(update, rows)
+    for name, type_, colnames in VECTORS:
+        for colname in colnames:
+            epoch.c[colname].drop()     # along with its index
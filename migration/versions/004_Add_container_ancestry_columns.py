@@ -0,0 +1,43 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+# (table, column, referenced column), in the order in which they can be filled in
+ANCESTRY = [
+        ('epoch', 'experiment_datacontainer_id', 'experiment.datacontainer_id'),
+        ('epoch', 'research_group_id', 'researchgroup.id'),
+        ('dataset', 'session_datacontainer_id', 'session.datacontainer_id'),
+        ('dataset', 'experiment_datacontainer_id', 'experiment.datacontainer_id'),
+        ('dataset', 'research_group_id', 'researchgroup.id'),
+        ]
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for table_name in ['experiment', 'researchgroup', 'subject', 'session']:
+        Table(table_name, meta, autoload=True)
+    epoch = Table('epoch', meta, autoload=True)
+    dataset = Table('dataset', meta, autoload=True)
+    for table_name, colname, ref in ANCESTRY:
+        Column(colname, Integer, ForeignKey(ref, name='%s_%s_fk' % (table_name, colname))).create(meta.tables[table_name])
+
+    subject, session, experiment = meta.tables['subject'], meta.tables['session'], meta.tables['experiment']
+    migrate_engine.execute(epoch.update().values(experiment_datacontainer_id=
+            select([subject.c.experiment_datacontainer_id],
+                and_(session.c.datacontainer_id == epoch.c.session_datacontainer_id,
+                    subject.c.datacontainer_id == session.c.subject_datacontainer_id)).as_scalar()))
+    migrate_engine.execute(epoch.update().values(research_group_id=
+            select([experiment.c.owner_id], experiment.c.datacontainer_id == epoch.c.experiment_datacontainer_id).as_scalar()))
+    for colname in ['session_datacontainer_id', 'experiment_datacontainer_id', 'research_group_id']:
+        migrate_engine.execute(dataset.update().values(**{colname:
+                select([epoch.c[colname]], epoch.c.datacontainer_id == dataset.c.container_id).as_scalar()}))
+    for table_name, colname, ref in ANCESTRY:
+        Index('ix_%s_%s' % (table_name, colname), meta.tables[table_name].c[colname]).create()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for table_name, colname, ref in reversed(ANCESTRY):
+        table = Table(table_name, meta, autoload=True)
+        table.c[colname].drop()
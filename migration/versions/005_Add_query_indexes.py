@@ -0,0 +1,38 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+# (table, index name, columns, postgresql partial index condition)
+INDEXES = [
+        ('job', 'ix_job_status_id', ['status', 'id'], None),
+        ('job', 'ix_job_pending', ['status', 'task', 'id'], "status = 'pending'"),
+        ('job', 'ix_job_needs_rerun', ['needs_rerun'], 'needs_rerun'),
+        ('job', 'ix_job_data_container_id_task', ['data_container_id', 'task'], None),
+        ('access', 'ix_access_user_experiment', ['user_id', 'experiment_datacontainer_id', 'privilege'], None),
+        ('datacontainer', 'ix_datacontainer_dirty_timestamp', ['dirty', 'timestamp'], 'dirty'),
+        ('datacontainer', 'ix_datacontainer_trashtime', ['trashtime'], 'trashtime IS NOT NULL'),
+        ('session', 'ix_session_exam', ['exam'], None),
+        ('epoch', 'ix_epoch_session_series_acq', ['session_datacontainer_id', 'series', 'acq'], None),
+        ('epoch', 'ix_epoch_psd', ['psd'], None),
+        ('epoch', 'ix_epoch_scan_type', ['scan_type'], None),
+        ('dataset', 'ix_dataset_container_id_kind', ['container_id', 'kind'], 'trashtime IS NULL'),
+        ('dataset', 'ix_dataset_container_id_updatetime', ['container_id', 'updatetime'], None),
+        ('dataset', 'ix_dataset_kind_filetype', ['kind', 'filetype'], None),
+        ('dataset', 'ix_dataset_trashtime', ['trashtime'], 'trashtime IS NOT NULL'),
+        ]
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for table_name, name, colnames, where in INDEXES:
+        table = Table(table_name, meta, autoload=True)
+        kwargs = {'postgresql_where': text(where)} if where else {}
+        Index(name, *[table.c[cn] for cn in colnames], **kwargs).create()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for table_name, name, colnames, where in reversed(INDEXES):
+        table = Table(table_name, meta, autoload=True)
+        Index(name, *[table.c[cn] for cn in colnames]).drop()
@@ -0,0 +1,31 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    Table('datacontainer', meta, autoload=True)
+    jobhistory = Table('jobhistory', meta,
+            Column('id', Integer, primary_key=True),
+            Column('timestamp', DateTime, index=True),
+            Column('status', Enum(u'pending', u'running', u'done', u'failed', u'abandoned', name=u'job_status')),
+            Column('task', Enum(u'find', u'proc', u'find&proc', name=u'job_task')),
+            Column('progress', Integer),
+            Column('activity', Unicode(255)),
+            Column('archivetime', DateTime),
+            Column('data_container_id', Integer, ForeignKey('datacontainer.id', name='jobhistory_data_container_id_fk'), index=True),
+            )
+    jobhistory.create(checkfirst=True)     # the enum types exist already on PostgreSQL
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    job = Table('job', meta, autoload=True)
+    jobhistory = Table('jobhistory', meta, autoload=True)
+    colnames = [c.name for c in jobhistory.c if c.name != 'archivetime']
+    rows = [dict(zip(colnames, row), needs_rerun=False) for row in migrate_engine.execute(select([jobhistory.c[cn] for cn in colnames]))]
+    if rows:
+        migrate_engine.execute(job.insert(), rows)
+    jobhistory.drop()
@@ -0,0 +1,62 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    datacontainer = Table('datacontainer', meta, autoload=True)
+    experiment = Table('experiment', meta, autoload=True)
+    subject = Table('subject', meta, autoload=True)
+    session = Table('session', meta, autoload=True)
+    epoch = Table('epoch', meta, autoload=True)
+    dataset = Table('dataset', meta, autoload=True)
+    # only the columns summed up; reflecting datasetfile trips over foreign keys left behind by migrate on SQLite
+    datasetfile = Table('datasetfile', meta, Column('dataset_id', Integer), Column('size', BigInteger))
+    experimentrollup = Table('experimentrollup', meta,
+            Column('session_cnt', Integer),
+            Column('epoch_cnt', Integer),
+            Column('dataset_cnt', Integer),
+            Column('byte_cnt', BigInteger),
+            Column('trash_byte_cnt', BigInteger),
+            Column('experiment_datacontainer_id', Integer, ForeignKey('experiment.datacontainer_id', name='experimentrollup_experiment_datacontainer_id_fk'), primary_key=True),
+            )
+    psdrollup = Table('psdrollup', meta,
+            Column('id', Integer, primary_key=True),
+            Column('psd', Unicode(255), index=True),
+            Column('epoch_cnt', Integer),
+            )
+    experimentrollup.create()
+    psdrollup.create()
+
+    experiment_id = experimentrollup.c.experiment_datacontainer_id
+    rows = [dict(experiment_datacontainer_id=exp_id) for exp_id, in migrate_engine.execute(select([experiment.c.datacontainer_id]))]
+    if rows:
+        migrate_engine.execute(experimentrollup.insert(), rows)
+    totals = {
+            'session_cnt': select([func.count()], and_(subject.c.experiment_datacontainer_id == experiment_id,
+                session.c.subject_datacontainer_id == subject.c.datacontainer_id,
+                datacontainer.c.id == session.c.datacontainer_id, datacontainer.c.trashtime == None)),
+            'epoch_cnt': select([func.count()], and_(epoch.c.experiment_datacontainer_id == experiment_id,
+                datacontainer.c.id == epoch.c.datacontainer_id, datacontainer.c.trashtime == None)),
+            'dataset_cnt': select([func.count()], and_(dataset.c.experiment_datacontainer_id == experiment_id,
+                dataset.c.trashtime == None)),
+            'byte_cnt': select([func.coalesce(func.sum(datasetfile.c.size), 0)], and_(dataset.c.experiment_datacontainer_id == experiment_id,
+                dataset.c.trashtime == None, datasetfile.c.dataset_id == dataset.c.id)),
+            'trash_byte_cnt': select([func.coalesce(func.sum(datasetfile.c.size), 0)], and_(dataset.c.experiment_datacontainer_id == experiment_id,
+                dataset.c.trashtime != None, datasetfile.c.dataset_id == dataset.c.id)),
+            }
+    migrate_engine.execute(experimentrollup.update().values(**dict((cn, query.as_scalar()) for cn, query in totals.iteritems())))
+
+    rows = [dict(psd=psd, epoch_cnt=cnt) for psd, cnt in
+            migrate_engine.execute(select([epoch.c.psd, func.count()], epoch.c.psd != None).group_by(epoch.c.psd))]
+    if rows:
+        migrate_engine.execute(psdrollup.insert(), rows)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    Table('experiment', meta, autoload=True)
+    Table('psdrollup', meta, autoload=True).drop()
+    Table('experimentrollup', meta, autoload=True).drop()
@@ -0,0 +1,18 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    # uncompressed sizes of gzipped files without a manifest digest were taken from the 32-bit gzip trailer
+    datasetfile = Table('datasetfile', meta, Column('name', String(255)), Column('digest', LargeBinary), Column('uncompressed_size', BigInteger))
+    migrate_engine.execute(datasetfile.update()
+            .where(datasetfile.c.digest == None)
+            .where(or_(datasetfile.c.name.like('%.gz'), datasetfile.c.name.like('%.tgz')))
+            .values(uncompressed_size=None))
+
+
+def downgrade(migrate_engine):
+    pass
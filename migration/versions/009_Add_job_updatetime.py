@@ -0,0 +1,19 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for table_name in ['job', 'jobhistory']:
+        table = Table(table_name, meta, Column('timestamp', DateTime))
+        Column('updatetime', DateTime).create(table)
+        # the time of the last change is not known for existing jobs; their creation time is the best guess
+        migrate_engine.execute(table.update().values(updatetime=table.c.timestamp))
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for table_name in ['job', 'jobhistory']:
+        Table(table_name, meta, autoload=True).c.updatetime.drop()
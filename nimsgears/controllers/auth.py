@@ -76,21 +76,51 @@ class AuthController(BaseController):
         return dict(page='prefs', prefs=prefs)
 
     @expose('nimsgears.templates.status')
-    def status(self):
+    def status(self, failed_after=0, queued_after=0, page_size=100):
         #if not predicates.in_group('active_users').is_met(request.environ):
         #    flash(l_('Your account is not yet active.'))
         #    redirect('/auth/prefs')
 
-        failed_jobs = Job.query.filter(Job.status == u'failed').order_by(Job.id).all()
-        active_jobs = Job.query.filter(Job.status == u'running').order_by(Job.id).all()
-        queued_jobs = Job.query.filter(Job.status == u'pending').order_by(Job.id).limit(200).all()
+        def int_param(value, default):
+            """Return a query parameter as a non-negative int, or default if it is not one."""
+            try:
+                return max(int(value), 0)
+            except (TypeError, ValueError):
+                return default
+
+        page_size = int_param(page_size, 100) or 100
+
+        def job_page(status, after_id):
+            """Return the count of jobs with the given status, and (Job, Epoch, ...) rows of the next page after after_id."""
+            rows = (Job.query_with_containers()
+                    .filter(Job.status == status)
+                    .filter(Job.id > int_param(after_id, 0))
+                    .order_by(Job.id).limit(page_size).all())
+            return Job.query.filter(Job.status == status).count(), rows
+
+        failed_cnt, failed_jobs = job_page(u'failed', failed_after)
+        active_cnt, active_jobs = job_page(u'running', 0)
+        queued_cnt, queued_jobs = job_page(u'pending', queued_after)
         return dict(
                 page='status',
+                page_size=page_size,
+                failed_cnt=failed_cnt,
                 failed_jobs=failed_jobs,
+                active_cnt=active_cnt,
                 active_jobs=active_jobs,
+                queued_cnt=queued_cnt,
                 queued_jobs=queued_jobs,
                 )
 
     @expose('nimsgears.templates.admin')
     def admin(self):
-        return dict(page='admin', params={})
+        if not request.identity['user'].is_superuser:
+            flash(l_('Administration requires superuser mode.'))
+            redirect('/auth/status')
+        return dict(
+                page='admin',
+                params={},
+                hrsize=nimsutil.hrsize,
+                group_usage=ExperimentRollup.by_group(),
+                experiment_usage=ExperimentRollup.by_experiment(),
+                )
@@ -2,6 +2,7 @@
 
 from tg import expose, request, session
 import transaction
+import datetime
 import json
 
 from nimsgears.model import *
@@ -69,30 +70,29 @@ class BrowseController(NimsController):
     @expose()
     def trash(self, **kwargs):
         user = request.identity['user']
+        cls = None
         if 'exp' in kwargs:
             id_list = kwargs['exp'] if isinstance(kwargs['exp'], list) else [kwargs['exp']]
-            db_results = Experiment.query.filter(Experiment.id.in_(id_list)).all()
+            cls = Experiment
         elif 'sess' in kwargs:
             id_list = kwargs['sess'] if isinstance(kwargs['sess'], list) else [kwargs['sess']]
-            db_results = Session.query.filter(Session.id.in_(id_list)).all()
+            cls = Session
         elif 'epoch' in kwargs:
             id_list = kwargs['epoch'] if isinstance(kwargs['epoch'], list) else [kwargs['epoch']]
-            db_results = Epoch.query.filter(Epoch.id.in_(id_list)).all()
+            cls = Epoch
         elif 'dataset' in kwargs:
             id_list = kwargs['dataset'] if isinstance(kwargs['dataset'], list) else [kwargs['dataset']]
-            db_results = Dataset.query.filter(Dataset.id.in_(id_list)).all()
-        else:
-            db_results = None
+            cls = Dataset
+        db_results = cls.query.filter(cls.id.in_(id_list)).all() if cls else None
         result = {'success': False}
-        if db_results and all([user.has_access_to(datum, u'Read-Write') for datum in db_results]):
+        ids = [datum.id for datum in db_results] if db_results else []
+        if db_results and user.accessible_ids(cls, ids, u'Read-Write') == set(ids):
             if any([(datum.trashtime is None) for datum in db_results]):    # trashing
                 result['untrashed'] = True
-                for datum in db_results:
-                    datum.trash()
+                cls.set_trashtime(ids, datetime.datetime.now())
             else:                                                           # untrashing
                 result['untrashed'] = True
-                for datum in db_results:
-                    datum.untrash()
+                cls.set_trashtime(ids, None)
             result['success'] = True
             transaction.commit()
         else:
@@ -104,14 +104,15 @@ class BrowseController(NimsController):
         user = request.identity['user']
         if 'sess_id_list' in kwargs:
             sess_ids = kwargs['sess_id_list'] if isinstance(kwargs['sess_id_list'], list) else [kwargs['sess_id_list']]
-        sessions = Session.query.filter(Session.id.in_(sess_ids))
+        sessions = Session.query.filter(Session.id.in_(sess_ids)).all()
         exp = Experiment.get(kwargs.get('exp_id'))
         result = {'success': False, 'untrashed': False}
-        if sessions and exp and all([user.has_access_to(s, u'Read-Write') for s in sessions]) and user.has_access_to(exp, u'Read-Write'):
-            for sess in sessions:
-                sess.move_to_experiment(exp)
-            if exp.trashtime is not None and any([(sess.trashtime is None) for sess in sessions]):
-                exp.untrash(propagate=False)
+        session_ids = set(sess.id for sess in sessions)
+        if sessions and exp and user.accessible_ids(Session, session_ids, u'Read-Write') == session_ids and user.has_access_to(exp, u'Read-Write'):
+            untrash = exp.trashtime is not None and any([(sess.trashtime is None) for sess in sessions])
+            Session.move_all_to_experiment([sess.id for sess in sessions], exp)
+            if untrash:
+                Experiment.set_trashtime([exp.id], None, propagate=False)
                 result['untrashed'] = True
             result['success'] = True
             transaction.commit()
@@ -13,8 +13,9 @@ class NimsController(BaseController):
     def _modify_access(self, user, exp_list, user_list, access_level):
         privilege = AccessPrivilege.value(access_level)
         success = True
+        managed_ids = user.accessible_ids(Experiment, [exp.id for exp in exp_list], u'Manage')
         for exp in exp_list:
-            if not user.has_access_to(exp, u'Manage'):
+            if exp.id not in managed_ids:
                 success = False
                 break
             for user_ in user_list:
@@ -59,8 +60,10 @@ class NimsController(BaseController):
     def get_datasets(self, user, epoch_id):
         dataset_data_list = []
         dataset_attr_list = []
-        for ds in user.datasets(epoch_id):
-            if (ds.kind != u'primary' and ds.kind != u'secondary') or user.has_access_to(ds, u'Read-Only'):
+        datasets = user.datasets(epoch_id)
+        readable_ids = user.accessible_ids(Dataset, [ds.id for ds in datasets if ds.kind == u'primary' or ds.kind == u'secondary'], u'Read-Only')
+        for ds in datasets:
+            if (ds.kind != u'primary' and ds.kind != u'secondary') or ds.id in readable_ids:
                 dataset_data_list.append((ds.label + ('*' if ds.kind == u'primary' else ''),))
                 dataset_attr_list.append({'id':'dataset=%d' % ds.id, 'class':'%s' % ('trash' if ds.trashtime else '')})
         return (dataset_data_list, dataset_attr_list)
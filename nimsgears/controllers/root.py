@@ -162,8 +162,11 @@ class RootController(BaseController):
                     .join(ResearchGroup, Experiment.owner)
                     .filter(Dataset.id.in_(id_list))
                     .all())
+        original_ids = set(r.Dataset.id for r in db_results if r.Dataset.kind == u'primary' or r.Dataset.kind == u'secondary')
+        other_ids = set(r.Dataset.id for r in db_results) - original_ids
+        permitted_ids = user.accessible_ids(Dataset, original_ids, u'Read-Only') | user.accessible_ids(Dataset, other_ids, u'Anon-Read')
         for r in db_results:
-            if user.has_access_to(r.Dataset, u'Read-Only' if (r.Dataset.kind == u'primary' or r.Dataset.kind == u'secondary') else u'Anon-Read'):
+            if r.Dataset.id in permitted_ids:
                 if kwargs.get('legacy'):
                     ep = '%s/nims/%s/%s/%s' % (temp_dir, r.ResearchGroup.gid, r.Experiment.name, r.Session.legacy_dirname)
                 else:
@@ -91,15 +91,14 @@ class SearchController(NimsController):
     @expose('nimsgears.templates.search')
     def index(self):
         user = request.identity['user'] if request.identity else User.get_by(uid=u'@public')
-        dataset_cnt = Session.query.count()
+        dataset_cnt = ExperimentRollup.totals()['session_cnt']
         flag = user.is_superuser
         userdataset_cnt = user.dataset_cnt
         epoch_columns = [('Group', 'col_sunet'), ('Experiment', 'col_exp'), ('Date & Time', 'col_datetime'),
             ('Exam', 'col_exam'), ('Type Scan', 'col_scantype'), ('Description', 'col_desc')]
         dataset_columns = [('Data Type', 'col_type')]
         scantype_values = [''] + sorted(nimsdata.nimsimage.scan_types.all)
-        psd_names_tuples = DBSession.query(Epoch.psd).distinct(Epoch.psd)
-        psd_values = [''] + sorted([elem[0] for elem in psd_names_tuples])
+        psd_values = [''] + sorted(PsdRollup.names())
         return dict(page='search',
             psd_values=psd_values,
             userdataset_cnt=userdataset_cnt,
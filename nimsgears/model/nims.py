@@ -7,9 +7,13 @@ import re
 import shutil
 import hashlib
 import datetime
+import collections
 
 import transaction
+import sqlalchemy as sa
 from elixir import *
+from elixir.events import before_insert, before_update
+from zope.sqlalchemy import mark_changed
 
 import nimsutil
 from nimsgears.model import metadata, DBSession
@@ -20,8 +24,71 @@ from sqlalchemy.util._collections import NamedTuple
 __session__ = DBSession
 __metadata__ = metadata
 
-__all__  = ['Group', 'User', 'Permission', 'Message', 'Job', 'Access', 'AccessPrivilege']
+__all__  = ['Group', 'User', 'Permission', 'Message', 'Job', 'JobHistory', 'Access', 'AccessPrivilege']
 __all__ += ['ResearchGroup', 'Person', 'Subject', 'DataContainer', 'Experiment', 'Session', 'Epoch', 'Dataset']
+__all__ += ['DatasetInstance', 'DatasetFile', 'ExperimentRollup', 'PsdRollup']
+
+
+class ResolutionCache(object):
+
+    """
+    Bounded, transaction-aware cache of the containers that ingested files resolve to.
+
+    Instances put into the cache are only visible within their own transaction until it commits, at which point
+    their ids are promoted to the shared, least-recently-used part of the cache. Entries from an aborted transaction
+    are dropped.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.committed = collections.OrderedDict()
+        self.pending = {}
+        self.txn = None
+
+    def _sync(self):
+        txn = transaction.get()
+        if txn is not self.txn:     # previous transaction was aborted, or already committed
+            self.txn = txn
+            self.pending = {}
+            txn.addBeforeCommitHook(self._before_commit, args=(txn,))
+            txn.addAfterCommitHook(self._after_commit, args=(txn,))
+        return txn
+
+    def _before_commit(self, txn):
+        if txn is self.txn and self.pending:
+            DBSession.flush()       # assign ids to new instances
+            self.pending = dict((key, instance.id) for key, instance in self.pending.iteritems())
+
+    def _after_commit(self, success, txn):
+        if txn is self.txn:
+            if success:
+                for key, id_ in self.pending.iteritems():
+                    self.committed.pop(key, None)
+                    self.committed[key] = id_
+                while len(self.committed) > self.maxsize:
+                    self.committed.popitem(last=False)
+            self.pending = {}
+
+    def get(self, cls, key):
+        """Return the instance of cls cached under key, or None."""
+        self._sync()
+        if key in self.pending:
+            return self.pending[key]
+        id_ = self.committed.pop(key, None)
+        instance = cls.get(id_) if id_ is not None else None
+        if instance is not None:
+            self.committed[key] = id_
+        return instance
+
+    def put(self, key, instance):
+        self._sync()
+        self.pending[key] = instance
+
+    def clear(self):
+        self.committed.clear()
+        self.pending = {}
+
+resolution_cache = ResolutionCache()
 
 
 class Group(Entity):
@@ -99,7 +166,7 @@ class User(Entity):
     @property
     def is_superuser(self):
         """Return True if user is a superuser and has admin mode enabled."""
-        return Group.by_gid(u'superusers') in self.groups and self.admin_mode
+        return self.admin_mode and any(group.gid == u'superusers' for group in self.groups)
 
     @classmethod
     def by_email(cls, email):
@@ -158,10 +225,7 @@ class User(Entity):
 
     @property
     def dataset_cnt(self):
-        query = DBSession.query(Session)
-        if not self.is_superuser:
-            query = query.join(Subject, Session.subject).join(Experiment, Subject.experiment).join(Access).filter(Access.user==self)
-        return query.count()
+        return ExperimentRollup.totals(None if self.is_superuser else self)['session_cnt']
 
     @property
     def job_cnt(self):
@@ -192,13 +256,18 @@ class User(Entity):
         return query.join(Access).filter(Access.user == self).filter(Access.privilege >= AccessPrivilege.value(min_access_level))
 
     def has_access_to(self, data_container, min_access_level=u'Anon-Read'):
-        if self.is_superuser:
-            return True
-        else:
-            data_container.toplevel_query().first()
-            return bool(self._filter_access(data_container.toplevel_query(), min_access_level)
-                    .filter(data_container.__class__.id == data_container.id)
-                    .first())
+        return data_container.id in self.accessible_ids(data_container.__class__, [data_container.id], min_access_level)
+
+    def accessible_ids(self, cls, ids, min_access_level=u'Anon-Read'):
+        """
+        Return the subset of ids of Experiments, Sessions, Epochs or Datasets to which the user has at least the given
+        access, with a single query.
+        """
+        ids = set(ids)
+        if self.is_superuser or not ids:
+            return ids
+        query = self._filter_access(cls.toplevel_query(), min_access_level).filter(cls.id.in_(ids))
+        return set(id_ for id_, in query.with_entities(cls.id).distinct())
 
     def experiments_with_access_privilege(self, min_access_level=u'Anon-Read', ignore_superuser=False):
         query = Experiment.toplevel_query()
@@ -227,7 +296,7 @@ class User(Entity):
         return query.all()
 
     def epochs(self, sess_id, min_access_level=u'Anon-Read'):
-        query = Epoch.query.join(Session, Epoch.session).filter(Session.id == sess_id).join(Subject, Session.subject).join(Experiment, Subject.experiment) ## FIXME: use toplevel_query (sqlalchemy is broken, filter and join have order dependency)
+        query = Epoch.query.filter(Epoch.session_datacontainer_id == sess_id).join(Experiment, Epoch.experiment)
         if not self.is_superuser:
             query = self._filter_access(query, min_access_level)
         if self.trash_flag == 0:
@@ -237,7 +306,7 @@ class User(Entity):
         return query.all()
 
     def datasets(self, epoch_id, min_access_level=u'Anon-Read'):
-        query = Dataset.query.join(Epoch, Dataset.container).filter(Epoch.id == epoch_id).join(Session, Epoch.session).join(Subject, Session.subject).join(Experiment, Subject.experiment) ## FIXME: use toplevel_query (sqlalchemy is broken, filter and join have order dependency)
+        query = Dataset.query.filter(Dataset.container_id == epoch_id).join(Experiment, Dataset.experiment)
         if not self.is_superuser:
             query = self._filter_access(query, min_access_level)
         if self.trash_flag == 0:
@@ -292,7 +361,15 @@ class Message(Entity):
 
 class Job(Entity):
 
+    using_table_options(
+            sa.Index('ix_job_status_id', 'status', 'id'),
+            sa.Index('ix_job_pending', 'status', 'task', 'id', postgresql_where=sa.text("status = 'pending'")),
+            sa.Index('ix_job_needs_rerun', 'needs_rerun', postgresql_where=sa.text('needs_rerun')),
+            sa.Index('ix_job_data_container_id_task', 'data_container_id', 'task'),
+            )
+
     timestamp = Field(DateTime, default=datetime.datetime.now)
+    updatetime = Field(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
     status = Field(Enum(u'pending', u'running', u'done', u'failed', u'abandoned', name=u'job_status'))
     task = Field(Enum(u'find', u'proc', u'find&proc', name=u'job_task'))
     needs_rerun = Field(Boolean, default=False)
@@ -307,6 +384,64 @@ class Job(Entity):
     def __unicode__(self):
         return u'%s %s' % (self.data_container, self.task)
 
+    @classmethod
+    def query_with_containers(cls):
+        """
+        Return a query for (Job, Epoch, Session, Subject, Experiment, ResearchGroup) rows of jobs on epochs.
+
+        As long as the rows are referenced, printing their jobs costs no further queries.
+        """
+        return (DBSession.query(cls, Epoch, Session, Subject, Experiment, ResearchGroup)
+                .join(Epoch, cls.data_container)
+                .join(Session, Epoch.session)
+                .join(Subject, Session.subject)
+                .join(Experiment, Subject.experiment)
+                .join(ResearchGroup, Experiment.owner))
+
+    @classmethod
+    def archive(cls, before, batch_size=1000):
+        """
+        Move a batch of done or abandoned jobs last updated before the given time into the job history.
+
+        A job is updated whenever it is (re)started and when it finishes, so a rerun job is kept for as long after its
+        latest run as any other. The jobs are locked while they are copied and deleted, so that a job marked for rerun in the meantime stays
+        in the queue. Return the number of archived jobs; call again until it returns 0.
+        """
+        job_table = cls.table
+        colnames = [c.name for c in JobHistory.table.c if c.name != 'archivetime']
+        rows = DBSession.execute(sa.select([job_table.c[cn] for cn in colnames], for_update=True)
+                .where(job_table.c.status.in_([u'done', u'abandoned']))
+                .where(job_table.c.updatetime < before)
+                .where(sa.func.coalesce(job_table.c.needs_rerun, False) == False)
+                .limit(batch_size)).fetchall()
+        if rows:
+            archivetime = datetime.datetime.now()
+            DBSession.execute(JobHistory.table.insert(), [dict(zip(colnames, row), archivetime=archivetime) for row in rows])
+            DBSession.execute(job_table.delete().where(job_table.c.id.in_([row.id for row in rows])))
+            mark_changed(DBSession())
+        return len(rows)
+
+
+class JobHistory(Entity):
+
+    """Done and abandoned jobs, moved out of the job queue by Job.archive."""
+
+    timestamp = Field(DateTime, index=True)
+    updatetime = Field(DateTime)
+    status = Field(Enum(u'pending', u'running', u'done', u'failed', u'abandoned', name=u'job_status'))
+    task = Field(Enum(u'find', u'proc', u'find&proc', name=u'job_task'))
+    progress = Field(Integer)
+    activity = Field(Unicode(255))
+    archivetime = Field(DateTime, default=datetime.datetime.now)
+
+    data_container = ManyToOne('DataContainer')
+
+    def __repr__(self):
+        return ('<JobHistory %d: %s, %s>' % (self.id, self.task, self.status)).encode('utf-8')
+
+    def __unicode__(self):
+        return u'%s %s' % (self.data_container, self.task)
+
 
 class AccessPrivilege(object):
 
@@ -338,6 +473,8 @@ class AccessPrivilege(object):
 
 class Access(Entity):
 
+    using_table_options(sa.Index('ix_access_user_experiment', 'user_id', 'experiment_datacontainer_id', 'privilege'))
+
     user = ManyToOne('User')
     experiment = ManyToOne('Experiment')
     privilege = Field(Integer)
@@ -365,6 +502,8 @@ class ResearchGroup(Entity):
 
     experiments = OneToMany('Experiment')
 
+    _id_matcher = nimsutil.CloseMatcher(cutoff=0.8)
+
     def __repr__(self):
         return (u'<%s: %s>' % (self.__class__.__name__, self.gid)).encode('utf-8')
 
@@ -373,7 +512,13 @@ class ResearchGroup(Entity):
 
     @classmethod
     def all_ids(cls):
-        return [rg.gid for rg in cls.query.all()]
+        return [gid for gid, in DBSession.query(cls.gid).all()]
+
+    @classmethod
+    def id_matcher(cls):
+        """Return a matcher for all group ids, incrementally refreshed from the database."""
+        cls._id_matcher.refresh(cls.all_ids())
+        return cls._id_matcher
 
     @property
     def all_member_ids(self):
@@ -392,6 +537,10 @@ class Person(Entity):
 class DataContainer(Entity):
 
     using_options(inheritance='multi')
+    using_table_options(
+            sa.Index('ix_datacontainer_dirty_timestamp', 'dirty', 'timestamp', postgresql_where=sa.text('dirty')),
+            sa.Index('ix_datacontainer_trashtime', 'trashtime', postgresql_where=sa.text('trashtime IS NOT NULL')),
+            )
 
     timestamp = Field(DateTime, default=datetime.datetime.now)
     duration = Field(Interval, default=datetime.timedelta())
@@ -407,16 +556,109 @@ class DataContainer(Entity):
 
     @property
     def primary_dataset(self):
-        return Dataset.query.filter_by(container=self).filter_by(kind=u'primary').first()
+        return next((ds for ds in self.datasets if ds.kind == u'primary'), None)
 
     @property
     def original_datasets(self):
-        return Dataset.query.filter(Dataset.container == self).filter((Dataset.kind == u'primary') | (Dataset.kind == u'secondary')).all()
+        return [ds for ds in self.datasets if ds.kind == u'primary' or ds.kind == u'secondary']
 
     @property
     def is_trash(self):
         return bool(self.trashtime)
 
+    @property
+    def contains_trash(self):
+        """Return True if this container, or any container or dataset below it, is in the trash."""
+        if self.is_trash:
+            return True
+        DBSession.flush()
+        dc_table, ds_table = DataContainer.table, Dataset.table
+        id_sets = [[self.id]] + self._descendant_ids([self.id])
+        trashed_containers = sa.exists([dc_table.c.id],
+                sa.and_(dc_table.c.trashtime != None, sa.or_(*[dc_table.c.id.in_(id_set) for id_set in id_sets])))
+        trashed_datasets = sa.exists([ds_table.c.id],
+                sa.and_(ds_table.c.trashtime != None, ds_table.c.container_id.in_(id_sets[-1])))
+        return DBSession.execute(sa.select([sa.or_(trashed_containers, trashed_datasets)])).scalar()
+
+    @classmethod
+    def _descendant_ids(cls, ids):
+        """Return a select of the ids of the descendants of the given containers for each level below this class."""
+        levels = _container_levels()
+        id_sets = []
+        child_ids = ids
+        for child_cls, fk in levels[[level_cls for level_cls, fk in levels].index(cls)+1:]:
+            child_ids = sa.select([child_cls.table.c.datacontainer_id], child_cls.table.c[fk].in_(child_ids))
+            id_sets.append(child_ids)
+        return id_sets
+
+    @classmethod
+    def set_trashtime(cls, ids, trashtime, propagate=True):
+        """
+        Set the trashtime of the containers of this class with the given ids, with a few set-based UPDATEs.
+
+        With propagate, all descendants down to datasets get the same trashtime. Untrashing, i.e., a trashtime of None,
+        also untrashes all ancestors, as untrash() always has. Untrashing only touches what is in the trash, and costs a
+        single query if nothing is.
+        """
+        ids = list(ids)
+        if not ids:
+            return
+        levels = _container_levels()
+        level_classes = [level_cls for level_cls, fk in levels]
+        level = level_classes.index(cls)
+        DBSession.flush()
+        level_ids = {cls: ids}      # ids, or a select of them, for each level of the hierarchy that is updated
+        if propagate:
+            level_ids.update(zip(level_classes[level+1:], cls._descendant_ids(ids)))
+        if trashtime is None:
+            parent_ids = ids
+            for parent_level in reversed(range(level)):
+                child_cls, fk = levels[parent_level+1]
+                parent_ids = sa.select([child_cls.table.c[fk]], child_cls.table.c.datacontainer_id.in_(parent_ids))
+                level_ids[level_classes[parent_level]] = parent_ids
+        dc_table, ds_table = DataContainer.table, Dataset.table
+        dc_where = sa.or_(*[dc_table.c.id.in_(id_set) for id_set in level_ids.values()])
+        ds_where = ds_table.c.container_id.in_(level_ids[Epoch]) if propagate else None
+        if trashtime is None:
+            # narrow the updates, and their rollup measurements, down to the rows in the trash
+            trashed_ids = [id_ for id_, in DBSession.execute(sa.select([dc_table.c.id], sa.and_(dc_where, dc_table.c.trashtime != None)))]
+            trashed_ds_ids = []
+            if propagate:
+                trashed_ds_ids = [id_ for id_, in DBSession.execute(sa.select([ds_table.c.id], sa.and_(ds_where, ds_table.c.trashtime != None)))]
+            if not trashed_ids and not trashed_ds_ids:
+                return
+            dc_where = dc_table.c.id.in_(trashed_ids) if trashed_ids else None
+            ds_where = ds_table.c.id.in_(trashed_ds_ids) if trashed_ds_ids else None
+            rollup_where = dict(
+                    session_where=(Session.table.c.datacontainer_id.in_(trashed_ids) if trashed_ids else None),
+                    epoch_where=(Epoch.table.c.datacontainer_id.in_(trashed_ids) if trashed_ids else None),
+                    dataset_where=ds_where)
+        else:
+            rollup_where = dict(
+                    session_where=(Session.table.c.datacontainer_id.in_(level_ids[Session]) if Session in level_ids else None),
+                    epoch_where=(Epoch.table.c.datacontainer_id.in_(level_ids[Epoch]) if Epoch in level_ids else None),
+                    dataset_where=ds_where)
+        rollups_before = ExperimentRollup.measure(**rollup_where)
+        if ds_where is not None:
+            DBSession.execute(ds_table.update().where(ds_where).values(trashtime=trashtime))
+        if dc_where is not None:
+            DBSession.execute(dc_table.update().where(dc_where).values(trashtime=trashtime))
+        ExperimentRollup.add_change(rollups_before, ExperimentRollup.measure(**rollup_where))
+        mark_changed(DBSession())
+        if trashtime is None:
+            _expire_trashtime(DataContainer, trashed_ids)
+            _expire_trashtime(Dataset, trashed_ds_ids)
+        else:
+            DBSession.expire_all()
+
+    def trash(self, trashtime=None):
+        DBSession.flush()
+        self.set_trashtime([self.id], trashtime or datetime.datetime.now())
+
+    def untrash(self, propagate=True):
+        DBSession.flush()
+        self.set_trashtime([self.id], None, propagate)
+
 
 class Experiment(DataContainer):
 
@@ -432,6 +674,15 @@ class Experiment(DataContainer):
     def __unicode__(self):
         return u'%s/%s' % (self.owner, self.name)
 
+    @before_update
+    def _update_owner_of_descendants(self):
+        """Keep the research group of the epochs and datasets of the experiment in line with its owner."""
+        if sa.orm.attributes.get_history(self, 'owner').has_changes():
+            for table in (Epoch.table, Dataset.table):
+                DBSession.execute(table.update()
+                        .where(table.c.experiment_datacontainer_id == self.id)
+                        .values(research_group_id=self.owner.id))
+
     @classmethod
     def from_owner_name(cls, owner, name):
         experiment = cls.query.filter_by(owner=owner).filter_by(name=name).first()
@@ -456,15 +707,6 @@ class Experiment(DataContainer):
         code_num = max([int('0%s' % re.sub(r'[^0-9]+', '', subj.code)) for subj in self.subjects]) + 1 if self.subjects else 1
         return u's%03d' % code_num
 
-    @property
-    def contains_trash(self):
-        if self.is_trash:
-            return True
-        for subject in self.subjects:
-            if subject.contains_trash:
-                return True
-        return False
-
     def users_with_access_privilege(self, user):
         user_access = User.query.join(Access).add_entity(Access).filter(Access.experiment == self).filter(Access.user == user).first()
         if user.is_superuser or user_access.Access.privilege == AccessPrivilege.value(u'Manage'):
@@ -473,17 +715,6 @@ class Experiment(DataContainer):
             db_results = [user_access]
         return [(user, AccessPrivilege.name(acc.privilege)) for user, acc in db_results]
 
-    def trash(self, trashtime=datetime.datetime.now()):
-        self.trashtime = trashtime
-        for subject in self.subjects:
-            subject.trash(trashtime)
-
-    def untrash(self, propagate=True):
-        self.trashtime = None
-        if propagate:
-            for subject in self.subjects:
-                subject.untrash()
-
     def renumber_subjects(self):
         ordered_subjects = sorted(self.subjects, key=lambda subj: (sorted(subj.sessions, key=lambda session: session.timestamp)[0].timestamp))
         for i, subj in enumerate(ordered_subjects):
@@ -504,16 +735,22 @@ class Subject(DataContainer):
     person = ManyToOne('Person')
     sessions = OneToMany('Session')
 
+    first_timestamp = ColumnProperty(lambda c: _first_session_timestamp(c.datacontainer_id))
+
     def __unicode__(self):
         return u'%s, %s' % (self.lastname, self.firstname)
 
     @classmethod
     def from_mrfile(cls, mrfile):
-        subj_code, group_name, exp_name = nimsutil.parse_patient_id(mrfile.patient_id, ResearchGroup.all_ids())
+        subj_code, group_name, exp_name = nimsutil.parse_patient_id(mrfile.patient_id, ResearchGroup.id_matcher())
         query = cls.query.join(Experiment, cls.experiment).filter(Experiment.name == exp_name)
         query = query.join(ResearchGroup, Experiment.owner).filter(ResearchGroup.gid == group_name)
+        cache_key = (cls.__name__, group_name, exp_name, subj_code)
         if subj_code:
-            subject = query.filter(cls.code==subj_code).first()
+            subject = resolution_cache.get(cls, cache_key)
+            # the experiment may have been renamed or transferred to another group since the subject was cached
+            if not subject or subject.code != subj_code or (subject.experiment.name, subject.experiment.owner.gid) != (exp_name, group_name):
+                subject = query.filter(cls.code==subj_code).first()
         elif mrfile.subj_firstname and mrfile.subj_lastname:
             subject = query.filter(cls.firstname==mrfile.subj_firstname).filter(cls.lastname==mrfile.subj_lastname).filter(cls.dob==mrfile.subj_dob).first()
         else:
@@ -529,6 +766,8 @@ class Subject(DataContainer):
                     lastname=mrfile.subj_lastname[:63],
                     dob=mrfile.subj_dob,
                     )
+        if subj_code:
+            resolution_cache.put(cache_key, subject)
         return subject
 
     @classmethod
@@ -541,32 +780,12 @@ class Subject(DataContainer):
     @classmethod
     def toplevel_query(self):
         return (Subject.query
-                .join(Experiment, Subject.experiment))
+                .join(Experiment, Subject.experiment)
+                .options(sa.orm.contains_eager(Subject.experiment)))
 
     @property
     def name(self):
-        return u'%s %s: %s, %s' % (self.code, self.sessions[0].timestamp, self.lastname, self.firstname)
-
-    @property
-    def contains_trash(self):
-        if self.is_trash:
-            return True
-        for session in self.sessions:
-            if session.contains_trash:
-                return True
-        return False
-
-    def trash(self, trashtime=datetime.datetime.now()):
-        self.trashtime = trashtime
-        for session in self.sessions:
-            session.trash(trashtime)
-
-    def untrash(self, propagate=True):
-        self.trashtime = None
-        self.experiment.untrash(propagate=False)
-        if propagate:
-            for session in self.sessions:
-                session.untrash()
+        return u'%s %s: %s, %s' % (self.code, self.first_timestamp, self.lastname, self.firstname)
 
     def clone(self, experiment):
         subj = Subject()
@@ -578,12 +797,21 @@ class Subject(DataContainer):
         return subj
 
 
+def _first_session_timestamp(subject_id):
+    """Return a correlated subquery for the timestamp of the first session of a subject."""
+    dc_table = DataContainer.table.alias()
+    sess_table = Session.table
+    return (sa.select([sa.func.min(dc_table.c.timestamp)],
+                sa.and_(sess_table.c.datacontainer_id == dc_table.c.id, sess_table.c.subject_datacontainer_id == subject_id))
+            .label('first_timestamp'))
+
+
 class Session(DataContainer):
 
     using_options(inheritance='multi')
 
     uid = Field(LargeBinary(32), index=True)
-    exam = Field(Integer)
+    exam = Field(Integer, index=True)
     notes = Field(Unicode)
 
     subject = ManyToOne('Subject')
@@ -596,7 +824,8 @@ class Session(DataContainer):
     @classmethod
     def from_mrfile(cls, mrfile):
         uid = nimsutil.pack_dicom_uid(mrfile.exam_uid)
-        session = cls.query.filter_by(uid=uid).first()
+        cache_key = (cls.__name__, str(uid))
+        session = resolution_cache.get(cls, cache_key) or cls.query.filter_by(uid=uid).first()
         if not session:
             subject = Subject.from_mrfile(mrfile)
             # If we trusted the scan operator to carefully enter their uid in the
@@ -606,13 +835,15 @@ class Session(DataContainer):
             # just let the operator be None if the user isn't already in the system.
             operator = User.by_uid(unicode(mrfile.operator), create=False)
             session = Session(uid=uid, exam=mrfile.exam_no, subject=subject, operator=operator)
+        resolution_cache.put(cache_key, session)
         return session
 
     @classmethod
     def toplevel_query(self):
         return (Session.query
                 .join(Subject, Session.subject)
-                .join(Experiment, Subject.experiment))
+                .join(Experiment, Subject.experiment)
+                .options(sa.orm.contains_eager(Session.subject, Subject.experiment)))
 
     @property
     def name(self):
@@ -626,48 +857,81 @@ class Session(DataContainer):
     def legacy_dirname(self):
         return u'%s_%s' % (self.timestamp.strftime('%Y%m%d'), self.exam)
 
-    @property
-    def contains_trash(self):
-        if self.is_trash:
-            return True
-        for epoch in self.epochs:
-            if epoch.contains_trash:
-                return True
-        return False
-
     @property
     def experiment(self):
-        return DBSession.query(Session, Experiment).join(Subject, Session.subject).join(Experiment, Subject.experiment).filter(Session.id == self.id).one().Experiment
+        return self.subject.experiment
 
-    def trash(self, trashtime=datetime.datetime.now()):
-        self.trashtime = trashtime
-        for epoch in self.epochs:
-            epoch.trash(trashtime)
-
-    def untrash(self, propagate=True):
-        self.trashtime = None
-        self.subject.untrash(propagate=False)
-        if propagate:
-            for epoch in self.epochs:
-                epoch.untrash()
+    @classmethod
+    def move_all_to_experiment(cls, ids, experiment):
+        """
+        Move the sessions with the given ids to another experiment, with one UPDATE per subject.
+
+        Sessions of the same person go to that person's subject in the experiment, which is cloned if necessary.
+        Subjects left without sessions are deleted.
+        """
+        rows = (DBSession.query(Session.id, Subject.id, Subject.person_id)
+                .join(Subject, Session.subject)
+                .filter(Session.id.in_(list(ids)))
+                .all())
+        if not rows:
+            return
+        person_ids = set(person_id for session_id, subject_id, person_id in rows)
+        new_subjects = dict((subj.person_id, subj) for subj in
+                Subject.query.filter(Subject.experiment == experiment).filter(Subject.person_id.in_(person_ids)))
+        for session_id, subject_id, person_id in rows:
+            if person_id not in new_subjects:
+                new_subjects[person_id] = Subject.get(subject_id).clone(experiment)
+        DBSession.flush()
+        session_ids = [session_id for session_id, subject_id, person_id in rows]
+        rollup_where = dict(
+                session_where=Session.table.c.datacontainer_id.in_(session_ids),
+                epoch_where=Epoch.table.c.session_datacontainer_id.in_(session_ids),
+                dataset_where=Dataset.table.c.session_datacontainer_id.in_(session_ids))
+        rollups_before = ExperimentRollup.measure(**rollup_where)
+        sess_table = Session.table
+        for person_id, subject in new_subjects.iteritems():
+            person_session_ids = [session_id for session_id, subject_id, pid in rows if pid == person_id]
+            DBSession.execute(sess_table.update()
+                    .where(sess_table.c.datacontainer_id.in_(person_session_ids))
+                    .values(subject_datacontainer_id=subject.id))
+        ancestry = dict(experiment_datacontainer_id=experiment.id, research_group_id=experiment.owner.id)
+        for table in (Epoch.table, Dataset.table):
+            DBSession.execute(table.update().where(table.c.session_datacontainer_id.in_(session_ids)).values(**ancestry))
+        ExperimentRollup.add_change(rollups_before, ExperimentRollup.measure(**rollup_where))
+        mark_changed(DBSession())
+        DBSession.expire_all()
+        old_subject_ids = set(subject_id for session_id, subject_id, person_id in rows)
+        for old_subject in Subject.query.filter(Subject.id.in_(old_subject_ids)).filter(~Subject.sessions.any()):
+            old_subject.delete()
 
     def move_to_experiment(self, experiment):
-        old_subject = self.subject
-        self.subject = Subject.for_session_in_experiment(self, experiment)
-        if not old_subject.sessions:
-            old_subject.delete()
+        DBSession.flush()
+        Session.move_all_to_experiment([self.id], experiment)
+
+
+def _vector_property(type_, *colnames):
+    """Expose numeric columns, e.g., fov_x and fov_y, together as a list, or None if all are NULL."""
+    def getter(self):
+        values = [getattr(self, cn) for cn in colnames]
+        return values if any(v is not None for v in values) else None
+    def setter(self, values):
+        values = list(values) if values is not None else []
+        for i, cn in enumerate(colnames):
+            setattr(self, cn, type_(values[i]) if i < len(values) and values[i] is not None else None)
+    return property(getter, setter)
 
 
 class Epoch(DataContainer):
 
     using_options(inheritance='multi')
+    using_table_options(sa.Index('ix_epoch_session_series_acq', 'session_datacontainer_id', 'series', 'acq'))
 
     uid = Field(LargeBinary(32), index=True)
     series = Field(Integer)
     acq = Field(Integer, index=True)
     description = Field(Unicode(255))
     notes = Field(Unicode)
-    psd = Field(Unicode(255))
+    psd = Field(Unicode(255), index=True)
     physio_recorded = Field(Boolean, default=False)
     physio_valid = Field(Boolean)
 
@@ -686,25 +950,53 @@ class Epoch(DataContainer):
     scanner_name = Field(Unicode(255))
     size_x = Field(Integer)
     size_y = Field(Integer)
-    fov = Field(Unicode(255))
-    scan_type = Field(Unicode(255))
+    fov_x = Field(Float, index=True)
+    fov_y = Field(Float)
+    scan_type = Field(Unicode(255), index=True)
     num_bands = Field(Integer)
     prescribed_duration = Field(Interval, default=datetime.timedelta())
-    mm_per_vox = Field(Unicode(255))
+    mm_per_vox_x = Field(Float, index=True)
+    mm_per_vox_y = Field(Float)
+    mm_per_vox_z = Field(Float)
     effective_echo_spacing = Field(Float)
     phase_encode_undersample = Field(Float)
     slice_encode_undersample = Field(Float)
-    acquisition_matrix = Field(Unicode(255))
+    acquisition_matrix_x = Field(Integer)
+    acquisition_matrix_y = Field(Integer)
 
     session = ManyToOne('Session')
+    experiment = ManyToOne('Experiment')
+    research_group = ManyToOne('ResearchGroup')
+
+    fov = _vector_property(float, 'fov_x', 'fov_y')
+    mm_per_vox = _vector_property(float, 'mm_per_vox_x', 'mm_per_vox_y', 'mm_per_vox_z')
+    acquisition_matrix = _vector_property(int, 'acquisition_matrix_x', 'acquisition_matrix_y')
 
     def __unicode__(self):
         return u'Epoch %s %s' % (self.session.subject.experiment, self.timestamp.strftime('%Y-%m-%d %H:%M:%S'))
 
+    @before_insert
+    @before_update
+    def _set_ancestry(self):
+        """Record the experiment and research group of the session, for filtering epochs with a single join."""
+        if self.session and (self.experiment_datacontainer_id is None or sa.orm.attributes.get_history(self, 'session').has_changes()):
+            experiment = self.session.subject.experiment
+            self.experiment_datacontainer_id = experiment.id
+            self.research_group_id = experiment.owner_id
+            if self.id is not None:
+                ds_table = Dataset.table
+                rollups_before = ExperimentRollup.measure(dataset_where=(ds_table.c.container_id == self.id))
+                DBSession.execute(ds_table.update()
+                        .where(ds_table.c.container_id == self.id)
+                        .values(session_datacontainer_id=self.session.id, experiment_datacontainer_id=experiment.id,
+                            research_group_id=experiment.owner_id))
+                ExperimentRollup.add_change(rollups_before, ExperimentRollup.measure(dataset_where=(ds_table.c.container_id == self.id)))
+
     @classmethod
     def from_mrfile(cls, mrfile):
         uid = nimsutil.pack_dicom_uid(mrfile.series_uid)
-        epoch = cls.query.filter_by(uid=uid).filter_by(acq=mrfile.acq_no).first()
+        cache_key = (cls.__name__, str(uid), mrfile.acq_no)
+        epoch = resolution_cache.get(cls, cache_key) or cls.query.filter_by(uid=uid).filter_by(acq=mrfile.acq_no).first()
         if not epoch:
             session = Session.from_mrfile(mrfile)
             if session.timestamp is None or session.timestamp > mrfile.timestamp:
@@ -735,16 +1027,16 @@ class Epoch(DataContainer):
                     scanner_name = unicode(mrfile.scanner_name),
                     size_x = mrfile.size[0],
                     size_y = mrfile.size[1],
-                    fov = unicode(str(mrfile.fov)),
-                    mm_per_vox = unicode(str(mrfile.mm_per_vox)),
+                    fov = mrfile.fov,
+                    mm_per_vox = mrfile.mm_per_vox,
                     scan_type = unicode(mrfile.scan_type),
                     num_bands = mrfile.num_bands,
                     effective_echo_spacing = mrfile.effective_echo_spacing,
                     phase_encode_undersample = mrfile.phase_encode_undersample,
                     slice_encode_undersample = mrfile.slice_encode_undersample,
-                    acquisition_matrix = unicode(str(mrfile.acquisition_matrix)),
-                    # to unpack fov, mm_per_vox, and acquisition_matrix: np.fromstring(str(mm)[1:-1],sep=',')
+                    acquisition_matrix = mrfile.acquisition_matrix,
                     )
+        resolution_cache.put(cache_key, epoch)
         return epoch
 
     @classmethod
@@ -752,7 +1044,8 @@ class Epoch(DataContainer):
         return (Epoch.query
                 .join(Session, Epoch.session)
                 .join(Subject, Session.subject)
-                .join(Experiment, Subject.experiment))
+                .join(Experiment, Subject.experiment)
+                .options(sa.orm.contains_eager(Epoch.session, Session.subject, Subject.experiment)))
 
     @property
     def name(self):
@@ -762,26 +1055,13 @@ class Epoch(DataContainer):
     def dirname(self):
         return '%d_%d_%s' % (self.series, self.acq, self.description)
 
-    @property
-    def contains_trash(self):
-        if self.is_trash:
-            return True
-        for dataset in self.datasets:
-            if dataset.is_trash:
-                return True
-        return False
 
-    def trash(self, trashtime=datetime.datetime.now()):
-        self.trashtime = trashtime
-        for dataset in self.datasets:
-            dataset.trash(trashtime)
-
-    def untrash(self, propagate=True):
-        self.trashtime = None
-        self.session.untrash(propagate=False)
-        if propagate:
-            for dataset in self.datasets:
-                dataset.untrash()
+def _container_levels():
+    """Return (class, column referencing the parent) for each level of the container hierarchy, from the top."""
+    return [(Experiment, None),
+            (Subject, 'experiment_datacontainer_id'),
+            (Session, 'subject_datacontainer_id'),
+            (Epoch, 'session_datacontainer_id')]
 
 
 class Dataset(Entity):
@@ -795,6 +1075,13 @@ class Dataset(Entity):
             u'physio':  u'Physio Data',
             }
 
+    using_table_options(
+            sa.Index('ix_dataset_container_id_kind', 'container_id', 'kind', postgresql_where=sa.text('trashtime IS NULL')),
+            sa.Index('ix_dataset_container_id_updatetime', 'container_id', 'updatetime'),
+            sa.Index('ix_dataset_kind_filetype', 'kind', 'filetype'),
+            sa.Index('ix_dataset_trashtime', 'trashtime', postgresql_where=sa.text('trashtime IS NOT NULL')),
+            )
+
     label = Field(Unicode(63))  # informational only
     offset = Field(Interval, default=datetime.timedelta())
     trashtime = Field(DateTime)
@@ -806,10 +1093,14 @@ class Dataset(Entity):
     digest = Field(LargeBinary(20))
     compressed = Field(Boolean, default=False)
     archived = Field(Boolean, default=False, index=True)
-    _filenames = Field(String, default='', colname='filenames', synonym='filenames')
 
     container = ManyToOne('DataContainer')
+    session = ManyToOne('Session')
+    experiment = ManyToOne('Experiment')
+    research_group = ManyToOne('ResearchGroup')
     parents = ManyToMany('Dataset')
+    instances = OneToMany('DatasetInstance')
+    files = OneToMany('DatasetFile', order_by='name', cascade='all, delete-orphan')
 
     def __repr__(self):
         return (u'<%s: %s>' % (self.__class__.__name__, self.label)).encode('utf-8')
@@ -817,6 +1108,15 @@ class Dataset(Entity):
     def __unicode__(self):
         return u'<%s %s>' % (self.__class__.__name__, self.container)
 
+    @before_insert
+    @before_update
+    def _set_ancestry(self):
+        """Record the session, experiment and research group of the epoch, for filtering datasets with a single join."""
+        if isinstance(self.container, Epoch) and (self.experiment_datacontainer_id is None or sa.orm.attributes.get_history(self, 'container').has_changes()):
+            self.session_datacontainer_id = self.container.session_datacontainer_id
+            self.experiment_datacontainer_id = self.container.experiment_datacontainer_id
+            self.research_group_id = self.container.research_group_id
+
     @classmethod
     def at_path(cls, nims_path, filetype, label=None, archived=False):
         dataset = cls(filetype=filetype, label=(label if label else cls.default_labels[filetype]), archived=archived)
@@ -826,9 +1126,15 @@ class Dataset(Entity):
         return dataset
 
     @classmethod
-    def from_mrfile(cls, mrfile, nims_path, archived=True):
+    def from_mrfile(cls, mrfile, nims_path, archived=True, commit=True):
+        """
+        Return the dataset that the data of mrfile belongs to, creating it and its containers as necessary.
+
+        A new dataset is committed right away, unless commit is False, e.g., for a caller that commits in batches.
+        """
         series_uid = nimsutil.pack_dicom_uid(mrfile.series_uid)
-        dataset = (cls.query.join(Epoch)
+        cache_key = (cls.__name__, str(series_uid), mrfile.acq_no, mrfile.filetype)
+        dataset = resolution_cache.get(cls, cache_key) or (cls.query.join(Epoch)
                 .filter(Epoch.uid == series_uid)
                 .filter(Epoch.acq == mrfile.acq_no)
                 .filter(cls.filetype == mrfile.filetype)
@@ -856,18 +1162,19 @@ class Dataset(Entity):
                     label=cls.default_labels[mrfile.filetype],
                     archived=archived,
                     )
-            transaction.commit()
-            DBSession.add(dataset)
+            if commit:
+                transaction.commit()
+                DBSession.add(dataset)
+            else:
+                DBSession.flush()   # assign the id, which the relpath is made of
             nimsutil.make_joined_path(nims_path, dataset.relpath)
+        resolution_cache.put(cache_key, dataset)
         return dataset
 
     @classmethod
     def toplevel_query(cls):
         return (Dataset.query
-                .join(Epoch, Dataset.container)
-                .join(Session, Epoch.session)
-                .join(Subject, Session.subject)
-                .join(Experiment, Subject.experiment))
+                .join(Experiment, Dataset.experiment))
 
     @property
     def name(self):
@@ -885,11 +1192,47 @@ class Dataset(Entity):
     updatetime = property(_get_updatetime, _set_updatetime)
 
     def _get_filenames(self):
-        return self._filenames.split(', ') if self._filenames else []
+        return [f.name for f in self.files]
     def _set_filenames(self, filenames):
-        self._filenames = ', '.join(filenames)
+        filenames = set(filenames)
+        for dataset_file in [f for f in self.files if f.name not in filenames]:
+            self.files.remove(dataset_file)
+        for filename in sorted(filenames - set(f.name for f in self.files)):
+            self.files.append(DatasetFile(name=filename))
     filenames = property(_get_filenames, _set_filenames)
 
+    def add_files(self, nims_path, filenames, digests=None):
+        """
+        Record files in the dataset directory, with their sizes and modification times.
+
+        Digests maps file names to (SHA-1 digest, uncompressed size) of their content, where known, e.g., from the
+        manifest of a reaper. Otherwise, the uncompressed size of a gzipped file is left unknown: the size in its
+        trailer is modulo 2**32, which is wrong for large PFiles, and is that of the tar stream for a tgz.
+        """
+        digests = digests or {}
+        dataset_files = dict((f.name, f) for f in self.files)
+        for filename in filenames:
+            filepath = os.path.join(nims_path, self.relpath, filename)
+            stat = os.stat(filepath)
+            mtime = datetime.datetime.fromtimestamp(int(stat.st_mtime))
+            dataset_file = dataset_files.get(filename)
+            if not dataset_file:
+                dataset_file = dataset_files[filename] = DatasetFile(name=filename)
+                self.files.append(dataset_file)
+            elif dataset_file.size == stat.st_size and dataset_file.mtime == mtime and filename not in digests:
+                continue
+            dataset_file.size = stat.st_size
+            dataset_file.mtime = mtime
+            dataset_file.digest, dataset_file.uncompressed_size = digests.get(filename, (None, None))
+            if dataset_file.uncompressed_size is None and not filename.endswith(('.gz', '.tgz')):
+                dataset_file.uncompressed_size = stat.st_size
+
+    def sync_files(self, nims_path):
+        """Bring the recorded files in line with the contents of the dataset directory."""
+        filenames = os.listdir(os.path.join(nims_path, self.relpath))
+        self.filenames = filenames
+        self.add_files(nims_path, filenames)
+
     @property
     def primary_file_relpath(self):
         fn = self._get_filenames()
@@ -920,12 +1263,312 @@ class Dataset(Entity):
     def contains_trash(self):
         return self.is_trash
 
-    def trash(self, trashtime=datetime.datetime.now()):
-        self.trashtime = trashtime
+    @classmethod
+    def set_trashtime(cls, ids, trashtime):
+        """
+        Set the trashtime of the datasets with the given ids; untrashing also untrashes their containers and up.
+
+        Untrashing only touches what is in the trash, so that untrashing after every ingest stays cheap.
+        """
+        ids = list(ids)
+        if not ids:
+            return
+        DBSession.flush()
+        table = cls.table
+        if trashtime is None:
+            container_ids = [row[0] for row in DBSession.execute(sa.select([table.c.container_id], table.c.id.in_(ids)).distinct())]
+            ids = [id_ for id_, in DBSession.execute(sa.select([table.c.id], sa.and_(table.c.id.in_(ids), table.c.trashtime != None)))]
+        if ids:
+            rollups_before = ExperimentRollup.measure(dataset_where=table.c.id.in_(ids))
+            DBSession.execute(table.update().where(table.c.id.in_(ids)).values(trashtime=trashtime))
+            ExperimentRollup.add_change(rollups_before, ExperimentRollup.measure(dataset_where=table.c.id.in_(ids)))
+            mark_changed(DBSession())
+        if trashtime is None:
+            _expire_trashtime(Dataset, ids)
+            Epoch.set_trashtime(container_ids, None, propagate=False)
+        else:
+            DBSession.expire_all()
+
+    def trash(self, trashtime=None):
+        DBSession.flush()
+        Dataset.set_trashtime([self.id], trashtime or datetime.datetime.now())
 
     def untrash(self, propagate=True):
-        self.trashtime = None
-        self.container.untrash(propagate=False)
+        DBSession.flush()
+        Dataset.set_trashtime([self.id], None)
 
     def datatype_from_mrfile(self, mrfile):
         return u'unknown'
+
+    def _instance_digests(self):
+        return dict((str(uid), str(digest)) for uid, digest in
+                DBSession.query(DatasetInstance.uid, DatasetInstance.digest).filter(DatasetInstance.dataset == self))
+
+    def new_instance_uids(self, instances):
+        """Return the set of uids of (uid, digest) pairs with new or changed content, without recording anything."""
+        known = self._instance_digests()
+        return set(uid for uid, digest in instances if known.get(uid) != digest)
+
+    def add_instances(self, instances):
+        """
+        Record the (uid, digest) pairs of ingested instances, and return the set of uids with new or changed content.
+
+        Uids are packed DICOM uids: SOPInstanceUIDs for DICOM files, series uids for PFiles.
+        """
+        table = DatasetInstance.table
+        known = self._instance_digests()
+        new_uids = set()
+        new_rows = []
+        for uid, digest in instances:
+            if uid not in known:
+                new_rows.append({'dataset_id': self.id, 'uid': uid, 'digest': digest})
+            elif known[uid] != digest:
+                DBSession.execute(table.update()
+                        .where(table.c.dataset_id == self.id)
+                        .where(table.c.uid == uid)
+                        .values(digest=digest))
+            else:
+                continue
+            known[uid] = digest
+            new_uids.add(uid)
+        if new_rows:
+            DBSession.execute(table.insert(), new_rows)
+        if new_uids:
+            mark_changed(DBSession())
+        return new_uids
+
+
+class DatasetInstance(Entity):
+
+    """Content digest of an ingested instance, used to detect duplicates."""
+
+    uid = Field(LargeBinary(32), index=True)
+    digest = Field(LargeBinary(20))
+
+    dataset = ManyToOne('Dataset', inverse='instances', column_kwargs={'index': True})
+
+    def __repr__(self):
+        return ('<%s: %s>' % (self.__class__.__name__, nimsutil.unpack_dicom_uid(self.uid))).encode('utf-8')
+
+
+class DatasetFile(Entity):
+
+    """A file of a dataset, with what is needed to list and stat it without touching the store."""
+
+    name = Field(String(255))
+    size = Field(BigInteger)
+    uncompressed_size = Field(BigInteger)
+    mtime = Field(DateTime)
+    digest = Field(LargeBinary(20))
+
+    dataset = ManyToOne('Dataset', inverse='files', column_kwargs={'index': True})
+
+    def __repr__(self):
+        return ('<%s: %s>' % (self.__class__.__name__, self.name)).encode('utf-8')
+
+
+class ExperimentRollup(Entity):
+
+    """
+    Running totals of the sessions, epochs and datasets of an experiment, and of the bytes in their files.
+
+    Counts are of sessions, epochs and datasets that are not in the trash. Bytes of trashed datasets are kept apart
+    in trash_byte_cnt. The totals change in the same transaction as the data they sum up, by _update_rollups for
+    whatever the ORM flushes, and by add_change around set-based updates.
+    """
+
+    columns = ['session_cnt', 'epoch_cnt', 'dataset_cnt', 'byte_cnt', 'trash_byte_cnt']
+
+    session_cnt = Field(Integer, default=0)
+    epoch_cnt = Field(Integer, default=0)
+    dataset_cnt = Field(Integer, default=0)
+    byte_cnt = Field(BigInteger, default=0)
+    trash_byte_cnt = Field(BigInteger, default=0)
+
+    experiment = ManyToOne('Experiment', primary_key=True)
+
+    def __repr__(self):
+        return ('<%s: %s>' % (self.__class__.__name__, self.experiment_datacontainer_id)).encode('utf-8')
+
+    @classmethod
+    def add(cls, deltas):
+        """Add deltas, {experiment id: {column name: delta}}, to the totals."""
+        table = cls.table
+        for experiment_id, column_deltas in deltas.iteritems():
+            values = dict((cn, table.c[cn] + delta) for cn, delta in column_deltas.iteritems() if delta)
+            if experiment_id is not None and values:
+                DBSession.execute(table.update().where(table.c.experiment_datacontainer_id == experiment_id).values(**values))
+
+    @classmethod
+    def add_change(cls, before, after):
+        """Add the difference between two results of measure()."""
+        cls.add(dict((experiment_id, dict((cn, after[experiment_id][cn] - before[experiment_id][cn]) for cn in cls.columns))
+                for experiment_id in set(before) | set(after)))
+
+    @classmethod
+    def measure(cls, session_where=None, epoch_where=None, dataset_where=None):
+        """
+        Return {experiment id: Counter of column totals} over the sessions, epochs and datasets matching the clauses.
+
+        Wrapping a set-based update of these rows in two calls, and handing the results to add_change, keeps the
+        totals right at a cost that grows with the number of rows updated, not with the size of the experiments.
+        """
+        dc_table, subj_table, sess_table = DataContainer.table, Subject.table, Session.table
+        epoch_table, ds_table, file_table = Epoch.table, Dataset.table, DatasetFile.table
+        queries = []
+        if session_where is not None:
+            experiment_id = subj_table.c.experiment_datacontainer_id
+            queries.append(('session_cnt', sa.select([experiment_id, sa.func.count()], sa.and_(session_where,
+                    subj_table.c.datacontainer_id == sess_table.c.subject_datacontainer_id,
+                    dc_table.c.id == sess_table.c.datacontainer_id, dc_table.c.trashtime == None)).group_by(experiment_id)))
+        if epoch_where is not None:
+            experiment_id = epoch_table.c.experiment_datacontainer_id
+            queries.append(('epoch_cnt', sa.select([experiment_id, sa.func.count()], sa.and_(epoch_where,
+                    dc_table.c.id == epoch_table.c.datacontainer_id, dc_table.c.trashtime == None)).group_by(experiment_id)))
+        if dataset_where is not None:
+            experiment_id = ds_table.c.experiment_datacontainer_id
+            queries.append(('dataset_cnt', sa.select([experiment_id, sa.func.count()],
+                    sa.and_(dataset_where, ds_table.c.trashtime == None)).group_by(experiment_id)))
+            for cn, trash_clause in [('byte_cnt', ds_table.c.trashtime == None), ('trash_byte_cnt', ds_table.c.trashtime != None)]:
+                queries.append((cn, sa.select([experiment_id, sa.func.sum(file_table.c.size)], sa.and_(dataset_where, trash_clause,
+                        file_table.c.dataset_id == ds_table.c.id)).group_by(experiment_id)))
+        totals = collections.defaultdict(collections.Counter)
+        for cn, query in queries:
+            for experiment_id, total in DBSession.execute(query):
+                totals[experiment_id][cn] += total or 0
+        return totals
+
+    @classmethod
+    def totals(cls, user=None):
+        """Return the totals over all experiments, or over those the given user has access to, keyed by column name."""
+        query = DBSession.query(*[sa.func.coalesce(sa.func.sum(cls.table.c[cn]), 0) for cn in cls.columns]).select_from(cls.table)
+        if user is not None:
+            query = (query.join(Access.table, Access.table.c.experiment_datacontainer_id == cls.table.c.experiment_datacontainer_id)
+                    .filter(Access.table.c.user_id == user.id))
+        return dict(zip(cls.columns, query.one()))
+
+    @classmethod
+    def by_group(cls):
+        """Return (gid, totals...) rows of the research groups, summed over the experiments they own, by size."""
+        sums = [sa.func.sum(cls.table.c[cn]).label(cn) for cn in cls.columns]
+        return (DBSession.query(ResearchGroup.gid, *sums)
+                .join(Experiment, ResearchGroup.experiments)
+                .join(cls, cls.experiment_datacontainer_id == Experiment.id)
+                .group_by(ResearchGroup.gid)
+                .order_by((sa.func.sum(cls.byte_cnt) + sa.func.sum(cls.trash_byte_cnt)).desc())
+                .all())
+
+    @classmethod
+    def by_experiment(cls):
+        """Return (ExperimentRollup, Experiment, ResearchGroup) rows of all experiments, by size."""
+        return (DBSession.query(cls, Experiment, ResearchGroup)
+                .join(Experiment, cls.experiment)
+                .join(ResearchGroup, Experiment.owner)
+                .order_by((cls.byte_cnt + cls.trash_byte_cnt).desc())
+                .all())
+
+
+class PsdRollup(Entity):
+
+    """Number of epochs per pulse sequence name, for listing the names without scanning all epochs."""
+
+    psd = Field(Unicode(255), index=True)
+    epoch_cnt = Field(Integer, default=0)
+
+    @classmethod
+    def add(cls, deltas):
+        """
+        Add deltas, {psd: delta}, to the epoch counts.
+
+        Concurrent transactions may both insert a row for a new name; the counts are summed over such rows, and only
+        the first of them is updated.
+        """
+        table = cls.table
+        for psd, delta in deltas.iteritems():
+            if psd is None or not delta:
+                continue
+            first_id = sa.select([sa.func.min(table.c.id)], table.c.psd == psd).as_scalar()
+            if not DBSession.execute(table.update().where(table.c.id == first_id).values(epoch_cnt=table.c.epoch_cnt + delta)).rowcount:
+                DBSession.execute(table.insert().values(psd=psd, epoch_cnt=delta))
+
+    @classmethod
+    def names(cls):
+        return [psd for psd, in DBSession.query(cls.psd).group_by(cls.psd).having(sa.func.sum(cls.epoch_cnt) > 0)]
+
+
+def _expire_trashtime(cls, ids):
+    """Expire the trashtime of the loaded instances of a class with the given ids, after a set-based update."""
+    ids = set(ids)
+    for instance in DBSession.identity_map.values():
+        if isinstance(instance, cls) and instance.id in ids:
+            DBSession.expire(instance, ['trashtime'])
+
+
+def _old_value(instance, key):
+    """Return the value of an attribute before the flush in progress; None if it was changed without being loaded."""
+    history = sa.orm.attributes.get_history(instance, key)
+    if history.deleted:
+        return history.deleted[0]
+    if history.added:
+        return None
+    return getattr(instance, key)
+
+
+def _byte_column(trashtime):
+    return 'trash_byte_cnt' if trashtime else 'byte_cnt'
+
+
+def _update_rollups(db_session, flush_context):
+    """Add what has just been flushed to the rollups: new, moved, trashed and deleted containers, datasets and files."""
+    deltas = collections.defaultdict(collections.Counter)
+    psd_deltas = collections.Counter()
+    old_byte_keys = {}
+    # orphans and cascaded deletes are not in db_session.deleted; the flush context knows them all
+    deleted = set(state.obj() for state, (isdelete, listonly) in flush_context.states.iteritems() if isdelete)
+    changed = [(instance, instance not in db_session.new, True)
+            for instance in db_session.new | db_session.dirty if instance not in deleted]
+    changed += [(instance, True, False) for instance in deleted]
+    for instance in [instance for instance in db_session.new if isinstance(instance, Experiment)]:
+        DBSession.execute(ExperimentRollup.table.insert().values(experiment_datacontainer_id=instance.id))
+    for instance, had_old, has_new in changed:
+        if isinstance(instance, Session):
+            if had_old and not _old_value(instance, 'trashtime'):
+                subject = _old_value(instance, 'subject')
+                deltas[subject and subject.experiment_datacontainer_id]['session_cnt'] -= 1
+            if has_new and not instance.trashtime:
+                deltas[instance.subject and instance.subject.experiment_datacontainer_id]['session_cnt'] += 1
+        elif isinstance(instance, Epoch):
+            if had_old:
+                if not _old_value(instance, 'trashtime'):
+                    deltas[_old_value(instance, 'experiment_datacontainer_id')]['epoch_cnt'] -= 1
+                psd_deltas[_old_value(instance, 'psd')] -= 1
+            if has_new:
+                if not instance.trashtime:
+                    deltas[instance.experiment_datacontainer_id]['epoch_cnt'] += 1
+                psd_deltas[instance.psd] += 1
+        elif isinstance(instance, Dataset):
+            old_key = had_old and (_old_value(instance, 'experiment_datacontainer_id'), _old_value(instance, 'trashtime'))
+            new_key = has_new and (instance.experiment_datacontainer_id, instance.trashtime)
+            if old_key and not old_key[1]:
+                deltas[old_key[0]]['dataset_cnt'] -= 1
+            if new_key and not new_key[1]:
+                deltas[new_key[0]]['dataset_cnt'] += 1
+            if old_key and new_key and (old_key[0], _byte_column(old_key[1])) != (new_key[0], _byte_column(new_key[1])):
+                # move the bytes already on record; files changed in this flush count towards the old totals first
+                old_byte_keys[instance] = (old_key[0], _byte_column(old_key[1]))
+                file_table = DatasetFile.table
+                byte_cnt = DBSession.execute(sa.select([sa.func.sum(file_table.c.size)], file_table.c.dataset_id == instance.id)).scalar() or 0
+                deltas[old_key[0]][_byte_column(old_key[1])] -= byte_cnt
+                deltas[new_key[0]][_byte_column(new_key[1])] += byte_cnt
+    flushed_datasets = dict((instance.id, instance) for instance, had_old, has_new in changed if isinstance(instance, Dataset))
+    for instance, had_old, has_new in changed:
+        if isinstance(instance, DatasetFile):
+            dataset_id = instance.dataset_id if has_new else _old_value(instance, 'dataset_id')
+            dataset = flushed_datasets.get(dataset_id) or (Dataset.get(dataset_id) if dataset_id is not None else None)
+            if dataset is not None:
+                experiment_id, cn = old_byte_keys.get(dataset) or (dataset.experiment_datacontainer_id, _byte_column(dataset.trashtime))
+                deltas[experiment_id][cn] += (has_new and instance.size or 0) - (had_old and _old_value(instance, 'size') or 0)
+    ExperimentRollup.add(deltas)
+    PsdRollup.add(psd_deltas)
+
+sa.event.listen(DBSession, 'after_flush', _update_rollups)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""Query counts of the container hierarchy, which must not grow with the number of containers"""
+import datetime
+
+import sqlalchemy as sa
+from nose.tools import eq_
+
+from nimsgears import model
+from nimsgears.model import DBSession
+
+_statements = []
+
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    _statements.append(statement)
+
+
+class TestQueryCounts(object):
+    """Listing or processing N containers must cost a constant number of queries."""
+
+    subject_cnt = 3
+    session_cnt = 2
+    epoch_cnt = 3
+
+    def setUp(self):
+        engine = DBSession.bind
+        if not getattr(engine, '_nims_query_counter', False):
+            sa.event.listen(engine, 'before_cursor_execute', _record_statement)
+            engine._nims_query_counter = True
+        group = model.ResearchGroup(gid=u'test_group')
+        experiment = model.Experiment(owner=group, name=u'test_experiment')
+        for i in range(self.subject_cnt):
+            subject = model.Subject(experiment=experiment, person=model.Person(), code=u's%03d' % (i+1))
+            for j in range(self.session_cnt):
+                session = model.Session(subject=subject, exam=10*i+j, timestamp=datetime.datetime(2013, 1, i+1, j+8))
+                for k in range(self.epoch_cnt):
+                    epoch = model.Epoch(session=session, series=k+1, acq=0, timestamp=datetime.datetime(2013, 1, i+1, j+8, k))
+                    model.Dataset(container=epoch, kind=u'primary', filetype=u'dicom')
+                    model.Dataset(container=epoch, kind=u'derived', filetype=u'nifti')
+                    model.Job(data_container=epoch, task=u'find&proc', status=u'pending')
+        other_experiment = model.Experiment(owner=group, name=u'other_experiment')
+        model.Subject(experiment=other_experiment, person=model.Person(), code=u's001',
+                sessions=[model.Session(exam=99, timestamp=datetime.datetime(2013, 2, 1))])
+        reader = model.User(firstname=u'Ima', lastname=u'Reader')
+        reader.uid = u'reader'
+        model.Access(experiment=experiment, user=reader, privilege_name=u'Read-Only')
+        model.Access(experiment=other_experiment, user=reader, privilege_name=u'Anon-Read')
+        DBSession.flush()
+        self.experiment_id = experiment.id
+        self.other_experiment_id = other_experiment.id
+        DBSession.expunge_all()
+
+    def tearDown(self):
+        DBSession.rollback()
+
+    def count_queries(self, func):
+        """Return the result of func, and the number of statements it executed."""
+        del _statements[:]
+        result = func()
+        return result, len(_statements)
+
+    def test_session_list_loads_ancestors(self):
+        """Sessions of the toplevel query come with their subjects and experiments"""
+        rows, cnt = self.count_queries(lambda: [(s.subject.code, s.experiment.name)
+                for s in model.Session.toplevel_query().filter(model.Experiment.id == self.experiment_id).all()])
+        eq_(cnt, 1)
+        eq_(len(rows), self.subject_cnt * self.session_cnt)
+        eq_(set(rows), set((u's%03d' % (i+1), u'test_experiment') for i in range(self.subject_cnt)))
+
+    def test_epoch_list_loads_ancestors(self):
+        """Epochs of the toplevel query come with their sessions, subjects and experiments"""
+        rows, cnt = self.count_queries(lambda: [(e.session.exam, e.session.subject.experiment.name)
+                for e in model.Epoch.toplevel_query().all()])
+        eq_(cnt, 1)
+        eq_(len(rows), self.subject_cnt * self.session_cnt * self.epoch_cnt)
+
+    def test_primary_dataset_from_loaded_datasets(self):
+        """Primary and original datasets are picked from the datasets of a container, without further queries"""
+        query = model.Epoch.query.options(sa.orm.subqueryload(model.Epoch.datasets))
+        epochs, cnt = self.count_queries(lambda: query.all())
+        eq_(cnt, 2)
+        kinds, cnt = self.count_queries(lambda: [(e.primary_dataset.kind, len(e.original_datasets)) for e in epochs for i in range(2)])
+        eq_(cnt, 0)
+        eq_(set(kinds), set([(u'primary', 1)]))
+
+    def test_subject_name(self):
+        """Subject names come with the timestamp of the first session, loaded with the subjects"""
+        names, cnt = self.count_queries(lambda: sorted(s.name for s in model.Subject.query.all()))
+        eq_(cnt, 1)
+        eq_(names[0], u's001 2013-01-01 08:00:00: None, None')
+
+    def test_contains_trash(self):
+        """Trash anywhere below a container is found with a single query"""
+        experiment = model.Experiment.get(self.experiment_id)
+        trash, cnt = self.count_queries(lambda: experiment.contains_trash)
+        eq_((trash, cnt), (False, 1))
+        dataset = model.Dataset.query.filter_by(kind=u'derived').first()
+        epoch_id, session_id = dataset.container.id, dataset.container.session.id
+        dataset.trash()
+        eq_(model.Experiment.get(self.experiment_id).contains_trash, True)
+        epoch = model.Epoch.get(epoch_id)
+        trash, cnt = self.count_queries(lambda: epoch.contains_trash)
+        eq_((trash, cnt), (True, 1))
+        eq_(model.Session.query.filter(model.Session.id != session_id).first().contains_trash, False)
+
+    def test_untrash(self):
+        """Untrashing what is not in the trash only queries, and untrashing a dataset untrashes its containers"""
+        dataset = model.Dataset.query.filter_by(kind=u'primary').first()
+        result, cnt = self.count_queries(dataset.untrash)
+        eq_([st for st in _statements if not st.lstrip().upper().startswith('SELECT')], [])
+        eq_(cnt, 3)
+        epoch_id, session_id = dataset.container.id, dataset.container.session.id
+        model.Session.get(session_id).trash()
+        dataset = model.Dataset.get(dataset.id)
+        eq_((dataset.is_trash, dataset.container.is_trash, dataset.container.session.is_trash), (True, True, True))
+        dataset.untrash()
+        eq_((dataset.is_trash, dataset.container.is_trash, dataset.container.session.is_trash), (False, False, False))
+        eq_(model.Dataset.query.filter(model.Dataset.trashtime != None).count(), 2 * self.epoch_cnt - 1)
+
+    def test_subject_resolution_follows_renames(self):
+        """A cached subject is not used for its old experiment name once the experiment was renamed or transferred"""
+        class MRFile(object):
+            patient_id = u's001@test_group/test_experiment'
+            subj_firstname = subj_lastname = u''
+            subj_dob = None
+        subject = model.Subject.from_mrfile(MRFile())
+        eq_(subject.experiment_datacontainer_id, self.experiment_id)
+        eq_(model.Subject.from_mrfile(MRFile()), subject)
+        subject.experiment.name = u'renamed_experiment'
+        DBSession.flush()
+        new_subject = model.Subject.from_mrfile(MRFile())
+        eq_((new_subject.experiment.name, new_subject.experiment.owner.gid), (u'test_experiment', u'test_group'))
+        DBSession.flush()
+        subject.experiment.name = u'test_experiment'
+        new_subject.experiment.name = u'another_experiment'
+        subject.experiment.owner = model.ResearchGroup(gid=u'other_group')
+        DBSession.flush()
+        eq_(model.Subject.from_mrfile(MRFile()).experiment.name, u'test_experiment')
+        eq_(model.Subject.from_mrfile(MRFile()).experiment.owner.gid, u'test_group')
+
+    def test_job_reprs(self):
+        """Jobs queried with their containers can be printed without lazy loads"""
+        reprs, cnt = self.count_queries(lambda: [unicode(row.Job) for row in model.Job.query_with_containers().all()])
+        eq_(cnt, 1)
+        eq_(len(reprs), self.subject_cnt * self.session_cnt * self.epoch_cnt)
+
+    def test_accessible_ids(self):
+        """Access to many containers is resolved with a single query"""
+        reader = model.User.by_uid(u'reader')
+        reader.groups
+        session_ids = [id_ for id_, in DBSession.query(model.Session.id)]
+        dataset_ids = [id_ for id_, in DBSession.query(model.Dataset.id)]
+        own_session_ids = set(s.id for s in model.Session.toplevel_query().filter(model.Experiment.id == self.experiment_id))
+        permitted, cnt = self.count_queries(lambda: reader.accessible_ids(model.Session, session_ids, u'Read-Only'))
+        eq_((permitted, cnt), (own_session_ids, 1))
+        eq_(reader.accessible_ids(model.Session, session_ids), set(session_ids))
+        eq_(reader.accessible_ids(model.Session, session_ids, u'Read-Write'), set())
+        permitted, cnt = self.count_queries(lambda: reader.accessible_ids(model.Dataset, dataset_ids, u'Read-Only'))
+        eq_((permitted, cnt), (set(dataset_ids), 1))
+        eq_(reader.accessible_ids(model.Experiment, [self.experiment_id, self.other_experiment_id], u'Read-Only'), set([self.experiment_id]))
+        eq_(reader.has_access_to(model.Experiment.get(self.other_experiment_id), u'Read-Only'), False)
+
+    def test_ancestry_columns(self):
+        """Epochs and datasets keep the ids of their experiment and research group when containers move"""
+        def stale_cnt():
+            stale = 0
+            for epoch in model.Epoch.query.all():
+                experiment = epoch.session.subject.experiment
+                stale += (epoch.experiment_datacontainer_id, epoch.research_group_id) != (experiment.id, experiment.owner_id)
+                for dataset in epoch.datasets:
+                    stale += ((dataset.session_datacontainer_id, dataset.experiment_datacontainer_id, dataset.research_group_id)
+                            != (epoch.session.id, experiment.id, experiment.owner_id))
+            return stale
+        eq_(stale_cnt(), 0)
+        other_experiment = model.Experiment.get(self.other_experiment_id)
+        other_experiment.owner = model.ResearchGroup(gid=u'other_group')
+        DBSession.flush()
+        subjects = model.Subject.query.filter(model.Subject.experiment_datacontainer_id == self.experiment_id).order_by(model.Subject.code)
+        session_ids = [subject.sessions[0].id for subject in subjects[:2]]
+        model.Session.move_all_to_experiment(session_ids, other_experiment)
+        DBSession.flush()
+        DBSession.expire_all()
+        eq_(stale_cnt(), 0)
+        for session_id in session_ids:
+            epochs = model.Epoch.query.filter(model.Epoch.session_datacontainer_id == session_id).all()
+            eq_(len(epochs), self.epoch_cnt)
+            ancestry = set((e.experiment_datacontainer_id, e.research_group_id) for e in epochs)
+            ancestry |= set((d.experiment_datacontainer_id, d.research_group_id) for e in epochs for d in e.datasets)
+            eq_(ancestry, set([(other_experiment.id, other_experiment.owner_id)]))
+        eq_(model.Dataset.toplevel_query().filter(model.Experiment.id == self.other_experiment_id).count(), 2 * self.epoch_cnt * 2)
+        model.Experiment.get(self.experiment_id).owner = model.ResearchGroup(gid=u'new_group')
+        DBSession.flush()
+        DBSession.expire_all()
+        eq_(stale_cnt(), 0)
+        epoch = model.Epoch.toplevel_query().filter(model.Experiment.id == self.experiment_id).first()
+        epoch.session = model.Session.get(session_ids[0])
+        DBSession.flush()
+        DBSession.expire_all()
+        eq_(stale_cnt(), 0)
+
+    def test_archive_jobs(self):
+        """Done and abandoned jobs move into the job history in batches, unless marked for rerun"""
+        jobs = model.Job.query.order_by(model.Job.id).all()
+        for job, status in zip(jobs, [u'done', u'done', u'abandoned', u'failed', u'done']):
+            job.status = status
+            job.timestamp = datetime.datetime(2012, 1, 1)
+        jobs[1].needs_rerun = True
+        DBSession.flush()
+        DBSession.execute(model.Job.table.update().values(updatetime=datetime.datetime(2012, 1, 1)))
+        jobs[4].status = u'running'     # rerun long after it was created
+        DBSession.flush()
+        jobs[4].status = u'done'
+        DBSession.flush()
+        archived_ids = [jobs[0].id, jobs[2].id]
+        DBSession.expunge_all()
+        before = datetime.datetime.now() - datetime.timedelta(days=30)
+        eq_(model.Job.archive(before, batch_size=1), 1)
+        eq_(model.Job.archive(before, batch_size=1), 1)
+        eq_(model.Job.archive(before, batch_size=1), 0)
+        eq_(sorted(jh.id for jh in model.JobHistory.query.all()), archived_ids)
+        eq_(model.JobHistory.get(archived_ids[1]).status, u'abandoned')
+        eq_(model.Job.query.filter(model.Job.id.in_(archived_ids)).count(), 0)
+        eq_(model.Job.query.count(), self.subject_cnt * self.session_cnt * self.epoch_cnt - 2)
+
+    def test_rollups(self):
+        """Experiment rollups follow ingest, file changes, trash, transfers and deletions"""
+        def check():
+            DBSession.flush()
+            DBSession.expire_all()
+            measured = model.ExperimentRollup.measure(
+                    session_where=model.Session.table.c.datacontainer_id != None,
+                    epoch_where=model.Epoch.table.c.datacontainer_id != None,
+                    dataset_where=model.Dataset.table.c.id != None)
+            for rollup in model.ExperimentRollup.query.all():
+                eq_([getattr(rollup, cn) for cn in model.ExperimentRollup.columns],
+                        [measured[rollup.experiment_datacontainer_id][cn] for cn in model.ExperimentRollup.columns])
+        check()
+        eq_(model.ExperimentRollup.totals()['session_cnt'], self.subject_cnt * self.session_cnt + 1)
+        epoch = model.Epoch.query.order_by(model.Epoch.id).first()
+        for dataset in epoch.datasets:
+            dataset.files.append(model.DatasetFile(name=u'a', size=100))
+            dataset.files.append(model.DatasetFile(name=u'b', size=10))
+        check()
+        eq_(model.ExperimentRollup.get(self.experiment_id).byte_cnt, 2 * 110)
+        epoch.datasets[0].files[0].size = 250
+        epoch.datasets[1].files.remove(epoch.datasets[1].files[1])
+        check()
+        session_id = epoch.session.id
+        epoch.session.trash()
+        check()
+        model.Epoch.get(epoch.id).untrash(propagate=False)
+        check()
+        model.Dataset.query.filter(model.Dataset.container_id == epoch.id).first().trash()
+        check()
+        other_session = model.Session.query.filter(model.Session.id != session_id).first()
+        self.count_queries(other_session.untrash)
+        eq_([st for st in _statements if 'GROUP BY' in st or not st.lstrip().upper().startswith('SELECT')], [])
+        model.Session.get(session_id).untrash()
+        check()
+        model.Session.move_all_to_experiment([session_id], model.Experiment.get(self.other_experiment_id))
+        check()
+        model.Dataset.query.filter(model.Dataset.container_id == epoch.id).first().delete()
+        check()
+        model.Epoch(session=model.Session.get(session_id), series=99, acq=0, psd=u'epi')
+        model.Epoch.get(epoch.id).psd = u'spiral'
+        check()
+        eq_(sorted(model.PsdRollup.names()), [u'epi', u'spiral'])
+        reader = model.User.by_uid(u'reader')
+        eq_(model.ExperimentRollup.totals(reader)['session_cnt'], model.ExperimentRollup.totals()['session_cnt'])
@@ -5,9 +5,12 @@
 import os
 import time
 import shlex
+import shutil
 import signal
+import fnmatch
 import logging
 import argparse
+import tempfile
 import subprocess as sp
 
 import nimsutil
@@ -15,6 +18,8 @@ import nimsutil
 log = logging.getLogger('datasyncer')
 
 RSYNC_CMD = 'rsync -a --del %s:%s %s'
+FIND_CMD = "find %s -type f %s-printf '%%P\\t%%s\\t%%T@\\n'"
+LISTING_SLACK = 300     # seconds of overlap between listings, to allow for clock skew between hosts
 
 
 class DataSyncer(object):
@@ -39,15 +44,124 @@ class DataSyncer(object):
                 time.sleep(self.sleep_time)
 
 
+class IncrementalDataSyncer(DataSyncer):
+
+    """
+    Sync by listing changes, instead of having rsync compare the whole tree on every run.
+
+    A manifest of (path, size, mtime) of the synced files is kept in manifest_path. Each run lists only the files whose
+    ctime is more recent than the previous listing, and transfers those that differ from the manifest, in batches.
+    Every reconcile_time seconds the whole tree is listed instead, which also catches files that were deleted or moved
+    in with an old ctime. Without a data_host, data_path is a local directory, e.g., an NFS mount.
+    """
+
+    def __init__(self, data_host, data_path, sync_path, sleep_time, manifest_path, data_glob='', reconcile_time=3600, batch_size=1000):
+        super(IncrementalDataSyncer, self).__init__(data_host, data_path, sync_path, sleep_time)
+        self.data_host = data_host
+        self.data_path = data_path
+        self.sync_path = sync_path
+        self.data_glob = data_glob
+        self.manifest_path = manifest_path
+        self.reconcile_time = reconcile_time
+        self.batch_size = batch_size
+        self.manifest = self.read_manifest()
+        self.listed_time = None
+        self.reconciled_time = None
+
+    def run(self):
+        while self.alive:
+            try:
+                self.sync()
+            except (sp.CalledProcessError, EnvironmentError) as e:
+                log.warning('Error while syncing remote files (%s)' % e)
+            finally:
+                time.sleep(self.sleep_time)
+
+    def sync(self):
+        """List what changed, transfer it in batches, and return the numbers of files transferred and deleted."""
+        start = time.time()
+        full = self.reconciled_time is None or start - self.reconciled_time >= self.reconcile_time
+        listing = self.list_files(None if full else self.listed_time - LISTING_SLACK)
+        changed = sorted(path for path, entry in listing.iteritems() if self.manifest.get(path) != entry)
+        for i in range(0, len(changed), self.batch_size):
+            batch = changed[i:i + self.batch_size]
+            self.transfer(batch)
+            self.manifest.update((path, listing[path]) for path in batch)
+            self.write_manifest()
+        deleted = set(self.manifest) - set(listing) if full else set()
+        for path in deleted:
+            if os.path.exists(os.path.join(self.sync_path, path)):
+                os.remove(os.path.join(self.sync_path, path))
+            del self.manifest[path]
+        if deleted:
+            self.write_manifest()
+        if full:
+            self.reconciled_time = start
+        self.listed_time = start
+        log.debug('%s files synced: %d transferred, %d deleted' % ('All' if full else 'Changed', len(changed), len(deleted)))
+        return len(changed), len(deleted)
+
+    def list_files(self, since=None):
+        """Return {relative path: (size, mtime)} of the source files, only those with a ctime after since, if given."""
+        listing = {}
+        if self.data_host:
+            newer = '-newerct @%d ' % since if since else ''
+            output = sp.check_output(['ssh', self.data_host, FIND_CMD % (self.data_path, newer)])
+            for line in output.splitlines():
+                path, size, mtime = line.rsplit('\t', 2)
+                listing[path] = (int(size), mtime)
+        else:
+            for dirpath, dirnames, filenames in os.walk(self.data_path):
+                for filename in filenames:
+                    filepath = os.path.join(dirpath, filename)
+                    stat = os.lstat(filepath)
+                    if since is None or stat.st_ctime >= since:
+                        listing[os.path.relpath(filepath, self.data_path)] = (stat.st_size, repr(stat.st_mtime))
+        if self.data_glob:
+            listing = dict((path, entry) for path, entry in listing.iteritems() if fnmatch.fnmatch(path.split('/')[0], self.data_glob))
+        return listing
+
+    def transfer(self, paths):
+        if self.data_host:
+            with tempfile.NamedTemporaryFile() as files_from:
+                files_from.writelines(path + '\n' for path in paths)
+                files_from.flush()
+                sp.check_call(['rsync', '-a', '--files-from=%s' % files_from.name, '%s:%s/' % (self.data_host, self.data_path), self.sync_path],
+                        stdout=open('/dev/null', 'w'), stderr=sp.STDOUT)
+        else:
+            for path in paths:
+                dest_path = os.path.join(self.sync_path, path)
+                temp_path = os.path.join(nimsutil.make_joined_path(os.path.dirname(dest_path)), '.' + os.path.basename(path))
+                shutil.copy2(os.path.join(self.data_path, path), temp_path)
+                os.rename(temp_path, dest_path)
+
+    def read_manifest(self):
+        manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as fd:
+                for line in fd:
+                    size, mtime, path = line.rstrip('\n').split('\t', 2)
+                    manifest[path] = (int(size), mtime)
+        return manifest
+
+    def write_manifest(self):
+        with open(self.manifest_path + '.tmp', 'w') as fd:
+            fd.writelines('%d\t%s\t%s\n' % (size, mtime, path) for path, (size, mtime) in sorted(self.manifest.iteritems()))
+        os.rename(self.manifest_path + '.tmp', self.manifest_path)
+
+
 class ArgumentParser(argparse.ArgumentParser):
 
     def __init__(self):
         super(ArgumentParser, self).__init__()
         self.add_argument('sync_path', help='path to syncing area')
-        self.add_argument('data_host', help='username@hostname of data source')
+        self.add_argument('data_host', help='username@hostname of data source (empty for a local source in incremental mode)')
         self.add_argument('data_path', help='path to data source')
         self.add_argument('sleep_time', type=int, help='time to sleep between rsyncs')
         self.add_argument('data_glob', nargs='?', help='glob format for files to move', default='')
+        self.add_argument('-i', '--incremental', action='store_true', help='sync only files listed as changed')
+        self.add_argument('-r', '--reconcile', type=int, default=3600, help='time between full syncs in incremental mode (default: 3600)')
+        self.add_argument('-b', '--batchsize', type=int, default=1000, help='maximum number of files per transfer in incremental mode (default: 1000)')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
@@ -59,7 +173,12 @@ if __name__ == '__main__':
     data_path = os.path.join(args.data_path, args.data_glob) if args.data_glob else args.data_path
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
 
-    syncer = DataSyncer(args.data_host, data_path, args.sync_path, args.sleep_time)
+    if args.incremental:
+        manifest_path = os.path.join(os.path.dirname(__file__), '.%s.manifest' % args.sync_path.strip('/').replace('/', '_'))
+        syncer = IncrementalDataSyncer(args.data_host, args.data_path, args.sync_path, args.sleep_time, manifest_path,
+                args.data_glob, args.reconcile, args.batchsize)
+    else:
+        syncer = DataSyncer(args.data_host, data_path, args.sync_path, args.sleep_time)
 
     def term_handler(signum, stack):
         syncer.halt()
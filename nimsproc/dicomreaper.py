@@ -4,41 +4,165 @@
 #           Reno Bowen
 
 import os
+import zlib
 import time
 import shutil
 import signal
+import struct
+import fnmatch
 import logging
 import tarfile
+import cStringIO
 import argparse
 import datetime
-import collections
+import threading
+import multiprocessing.pool
+import Queue
 
 import scu
+import dimse
 import nimsutil
-import nimsdata
+import reaperstate
 
 log = logging.getLogger('dicomreaper')
 
+MOVE_BATCH_SIZE = 100   # SOPInstanceUIDs per IMAGE level C-MOVE, to keep requests and command lines reasonable
+
+
+class AcquisitionArchiver(object):
+
+    """
+    Build the tgz of each acquisition of a series incrementally, as its images arrive.
+
+    Only the header of each image is read, up to its AcquisitionNumber, before it is compressed into its archive, so
+    nothing is left to do once the last image has arrived. Archives are flushed after every image, so that the images
+    completed before a crash can be salvaged. Archives of a part after the first, i.e., of images that arrived after
+    their acquisition was handed off, are numbered, e.g., <exam>_<series>_<acq>_2_dicoms.tgz.
+    """
+
+    def __init__(self, series_path, exam_id, series_id, part=1):
+        self.series_path = series_path
+        self.exam_id = exam_id
+        self.series_id = series_id
+        self.part = part
+        self.archives = {}
+        self.uids = set()
+        self.lock = threading.Lock()
+
+    def add(self, filename, data):
+        """Add the contents of a DICOM file to the archive of its acquisition. Return False if unreadable."""
+        try:
+            uid, acq_no, timestamp = nimsutil.dicomutil.acquisition_info(cStringIO.StringIO(data))
+        except (nimsutil.dicomutil.DicomError, struct.error):
+            return False
+        uid = uid or filename
+        if self.part > 1:
+            arcdir = '%s_%s_%s_%d_dicoms' % (self.exam_id, self.series_id, acq_no, self.part)
+        else:
+            arcdir = '%s_%s_%s_dicoms' % (self.exam_id, self.series_id, acq_no)
+        with self.lock:
+            if uid in self.uids:
+                return True
+            archive = self.archives.get(acq_no)
+            if not archive:
+                archive = self.archives[acq_no] = tarfile.open(os.path.join(self.series_path, arcdir + '.tgz'), 'w:gz', compresslevel=6)
+                tarinfo = tarfile.TarInfo(arcdir)
+                tarinfo.type, tarinfo.mode, tarinfo.mtime = tarfile.DIRTYPE, 0755, time.time()
+                archive.addfile(tarinfo)
+            tarinfo = tarfile.TarInfo('%s/%s.dcm' % (arcdir, filename))
+            tarinfo.size, tarinfo.mode = len(data), 0644
+            tarinfo.mtime = int(timestamp.strftime('%s')) if timestamp else time.time()
+            archive.addfile(tarinfo, cStringIO.StringIO(data))
+            archive.fileobj.flush()
+            self.uids.add(uid)
+        return True
+
+    def add_files(self):
+        """Archive and remove the loose DICOM files in series_path, e.g., as written by movescu."""
+        for filepath in [os.path.join(self.series_path, fn) for fn in os.listdir(self.series_path) if not fn.endswith(('.tgz', '.partial'))]:
+            with open(filepath, 'rb') as fd:
+                if not self.add(os.path.basename(filepath), fd.read()):
+                    log.warning('Discarding unreadable %s' % filepath)
+            os.remove(filepath)
+
+    def salvage(self):
+        """Re-archive the complete images of archives that were cut short, e.g., by a crash."""
+        for filename in [fn for fn in os.listdir(self.series_path) if fn.endswith('.tgz')]:
+            partial_path = os.path.join(self.series_path, filename + '.partial')
+            os.rename(os.path.join(self.series_path, filename), partial_path)
+            try:
+                with tarfile.open(partial_path, 'r|gz') as archive:
+                    for member in archive:
+                        if member.isfile():
+                            data = archive.extractfile(member).read()
+                            if len(data) == member.size:
+                                self.add(os.path.basename(member.name)[:-len('.dcm')], data)
+            except (tarfile.TarError, IOError, EOFError, zlib.error, struct.error):
+                pass    # end of the salvageable images
+            os.remove(partial_path)
+
+    def close(self):
+        with self.lock:
+            for archive in self.archives.itervalues():
+                archive.close()
+            self.archives = {}
+
+
+def tar_into_acquisitions(series_path, exam_id, series_id, part=1):
+    """Archive the DICOM files and partial archives in series_path into one complete tgz per acquisition."""
+    archiver = AcquisitionArchiver(series_path, exam_id, series_id, part)
+    archiver.salvage()
+    archiver.add_files()
+    archiver.close()
+
+
+def hand_off(reap_path, sort_stage):
+    """Move a reaped directory into the sort stage, hidden until it is complete."""
+    stage_dir = os.path.basename(reap_path)
+    shutil.move(reap_path, os.path.join(sort_stage, '.' + stage_dir))
+    os.rename(os.path.join(sort_stage, '.' + stage_dir), os.path.join(sort_stage, stage_dir))
+
 
 class DicomReaper(object):
 
-    def __init__(self, id_, scu, pat_id, discard_ids, reap_path, sort_path, datetime_file, sleep_time):
+    """
+    Reaper that polls the scanner for new exams and series, and retrieves each series once its image count is stable.
+
+    Series are retrieved in the background with the SCUs in move_scus, one C-MOVE in flight per SCU, so the number of
+    SCUs caps the load on the scanner. Each SCU needs its own move destination and return port. Compression of a
+    retrieved series does not hold an SCU, and so overlaps with the next retrieval. Without move_scus, series are
+    retrieved one at a time in the foreground with scu.
+    """
+
+    def __init__(self, id_, scu, pat_id, discard_ids, reap_path, sort_path, state, sleep_time, move_scus=None):
         self.id_ = id_
         self.scu = scu
+        self.move_scus = Queue.Queue()
+        for scu_ in move_scus or [scu]:
+            self.move_scus.put(scu_)
+        self.pool = multiprocessing.pool.ThreadPool(2 * len(move_scus)) if move_scus else None
         self.pat_id = pat_id
         self.discard_ids = discard_ids
         self.reap_stage = nimsutil.make_joined_path(reap_path)
         self.sort_stage = nimsutil.make_joined_path(sort_path)
-        self.datetime_file = datetime_file
+        self.state = state
         self.sleep_time = sleep_time
-
-        self.current_exam_datetime = nimsutil.get_reference_datetime(self.datetime_file)
-        self.monitored_exams = collections.deque()
         self.alive = True
 
-        # delete any files left behind from a previous run
+        self.current_exam_datetime = self.state.get_reference_datetime()
+        if not self.current_exam_datetime:
+            self.current_exam_datetime = datetime.datetime.now()
+            self.state.set_reference_datetime(self.current_exam_datetime)
+        self.exams = {}
+        for exam_id, exam_datetime, exam_uid, exam_pat_id in self.state.exams():
+            exam = Exam(exam_id, exam_pat_id, exam_datetime, self, exam_uid)
+            exam.load()
+            self.exams[exam.key] = exam
+
+        # delete any files left behind from a previous run, except partially retrieved series
+        reap_paths = self.state.reap_paths()
         for item in os.listdir(self.reap_stage):
-            if item.startswith(self.id_):
+            if item.startswith(self.id_) and os.path.join(self.reap_stage, item) not in reap_paths:
                 shutil.rmtree(os.path.join(self.reap_stage, item))
         for item in os.listdir(self.sort_stage):
             if item.startswith('.' + self.id_):
@@ -48,41 +172,68 @@ class DicomReaper(object):
         self.alive = False
 
     def run(self):
+        """
+        Monitor every exam that is not yet retired; there is no limit on how many.
+
+        An exam is retired once all of its series are reaped and a newer exam exists, or once it has vanished from the
+        scanner. Exams and series are kept in the reaper state, so a restart resumes exactly where the reaper stopped.
+        """
         while self.alive:
             outstanding_exams = self.get_outstanding_exams()
-            n_monitored_exams = len(self.monitored_exams)
-            n_outstanding_exams = len(outstanding_exams)
-
-            if n_monitored_exams > 0 and n_outstanding_exams > 0 and self.monitored_exams[0].id_ != outstanding_exams[0].id_:
-                vanished_exam = self.monitored_exams.popleft()
-                log.warning('Dropping    %s (assumed deleted from scanner)' % vanished_exam)
-                continue
-
-            if n_monitored_exams > 1 and n_outstanding_exams > 1 and self.monitored_exams[1].id_ != outstanding_exams[1].id_:
-                vanished_exam = self.monitored_exams.pop()
-                log.warning('Dropping    %s (assumed deleted from scanner)' % vanished_exam)
-                continue
-
-            next_exam = None
-            if n_monitored_exams < 2 and n_monitored_exams < n_outstanding_exams:
-                next_exam = outstanding_exams[n_monitored_exams]
-                self.monitored_exams.append(next_exam)
-            elif n_monitored_exams == 2 and n_monitored_exams < n_outstanding_exams:
-                if not any([series.needs_reaping for series in self.monitored_exams[0].series_dict.itervalues()]):
-                    self.monitored_exams.popleft()
-                    next_exam = outstanding_exams[n_monitored_exams]
-                    self.monitored_exams.append(next_exam)
-                    self.current_exam_datetime = self.monitored_exams[0].datetime
-                    nimsutil.update_reference_datetime(self.datetime_file, self.current_exam_datetime)
-
-            if next_exam:
-                log.info('New         %s' % self.monitored_exams[-1])
-
-            for exam in self.monitored_exams:
-                if not self.alive: return
+            if outstanding_exams:   # don't take a failed query for an empty scanner
+                outstanding_keys = set(exam.key for exam in outstanding_exams)
+                for exam in [exam for exam in self.exams.values() if exam.key not in outstanding_keys and not exam.in_flight]:
+                    log.warning('Dropping    %s (assumed deleted from scanner)' % exam)
+                    self.retire(exam)
+
+            for exam in outstanding_exams:
+                if exam.key not in self.exams and not self.state.is_retired(exam.id_, exam.datetime):
+                    log.info('New         %s' % exam)
+                    self.state.add_exam(exam.id_, exam.datetime, exam.uid, exam.pat_id)
+                    self.exams[exam.key] = exam
+
+            for exam in sorted(self.exams.itervalues(), key=lambda exam: exam.datetime):
+                if not self.alive: break
                 exam.reap()
 
-            time.sleep(self.sleep_time)
+            if outstanding_exams:
+                for exam in [exam for exam in self.exams.values() if exam.datetime < outstanding_exams[-1].datetime and exam.is_done]:
+                    log.debug('Retiring    %s' % exam)
+                    self.retire(exam)
+
+            if self.alive:
+                time.sleep(self.sleep_time)
+        if self.pool:
+            self.pool.close()
+            self.pool.join()    # let retrievals in flight finish
+        self.scu.close()
+        while not self.move_scus.empty():
+            self.move_scus.get().close()
+
+    def retire(self, exam):
+        """Stop monitoring an exam, and advance the reference datetime to the oldest exam still monitored."""
+        self.state.retire_exam(exam.id_, exam.datetime)
+        del self.exams[exam.key]
+        reference_datetime = min([e.datetime for e in self.exams.itervalues()] or [exam.datetime])
+        if reference_datetime > self.current_exam_datetime:
+            self.current_exam_datetime = reference_datetime
+            self.state.set_reference_datetime(reference_datetime)
+
+    def retrieve(self, series):
+        """Retrieve a series in the background, or right away without move_scus."""
+        series.in_flight = True
+        if self.pool:
+            self.pool.apply_async(self._retrieve, (series,))
+        else:
+            self._retrieve(series)
+
+    def _retrieve(self, series):
+        try:
+            series.retrieve(self.move_scus)
+        except Exception:
+            log.exception('Failed      %s' % series)
+        finally:
+            series.in_flight = False
 
     def get_outstanding_exams(self):
         query_params = {'StudyDate': self.current_exam_datetime.strftime('%Y%m%d-')}    # this should really be 'datetime - 1 day'
@@ -92,27 +243,48 @@ class DicomReaper(object):
         exam_list = []
         for resp in response_list:
             datetime_obj = datetime.datetime.strptime(resp.StudyDate + resp.StudyTime, '%Y%m%d%H%M%S')
-            exam_list.append(Exam(resp.StudyID, resp.PatientID, datetime_obj, self))
+            exam_list.append(Exam(resp.StudyID, resp.PatientID, datetime_obj, self, resp.get('StudyInstanceUID')))
         exam_list = [exam for exam in exam_list if exam.datetime >= self.current_exam_datetime]
         return sorted(exam_list, key=lambda exam: exam.datetime)
 
 
 class Exam(object):
 
-    def __init__(self, id_, pat_id, datetime_, reaper):
+    def __init__(self, id_, pat_id, datetime_, reaper, uid=None):
         self.id_ = id_
         self.pat_id = pat_id
         self.datetime = datetime_
         self.reaper = reaper
+        self.uid = uid
         self.series_dict = {}
 
     def __str__(self):
         return 'Exam %s %s (%s)' % (self.id_, self.datetime, self.pat_id)
 
+    @property
+    def key(self):
+        return (self.id_, self.datetime)
+
+    @property
+    def in_flight(self):
+        return any(series.in_flight for series in self.series_dict.itervalues())
+
+    @property
+    def is_done(self):
+        return not any(series.needs_reaping for series in self.series_dict.itervalues())
+
+    def load(self):
+        """Restore the series of this exam from the reaper state."""
+        for id_, uid, image_count, reaped, reap_path in self.reaper.state.series(self.id_, self.datetime):
+            series = Series(self, self.reaper, id_, uid, image_count)
+            series.needs_reaping = not reaped
+            series.reap_path = reap_path
+            self.series_dict[id_] = series
+
     def reap(self):
         """An exam must be reaped at least twice, since newly encountered series are not immediately reaped."""
         log.debug('Monitoring  %s' % self)
-        updated_series_list = self.get_series_list() if self.pat_id.strip('/').lower() not in reaper.discard_ids else []
+        updated_series_list = self.get_series_list() if self.pat_id.strip('/').lower() not in self.reaper.discard_ids else []
         for updated_series in updated_series_list:
             if not self.reaper.alive: break
             if updated_series.id_ in self.series_dict:
@@ -120,6 +292,7 @@ class Exam(object):
             else:
                 log.info('New         %s' % updated_series)
                 self.series_dict[updated_series.id_] = updated_series
+                updated_series.save()
 
     def get_series_list(self):
         responses = self.reaper.scu.find(scu.SeriesQuery(StudyID=self.id_))
@@ -138,46 +311,211 @@ class Series(object):
         self.uid = uid
         self.image_count = image_count
         self.needs_reaping = True
+        self.in_flight = False
+        self.reap_path = None
+        self.archiver = None
 
     def __str__(self):
         return '%s, Series %s, %d images' % (self.exam, self.id_, self.image_count)
 
     def reap(self, new_image_count):
+        if self.in_flight:
+            return
         if new_image_count > self.image_count:
             self.image_count = new_image_count
             self.needs_reaping = True
+            self.save()
             log.info('Monitoring  %s' % self)
         elif self.needs_reaping: # image count has stopped increasing
-            log.info('Reaping     %s' % self)
+            self.reaper.retrieve(self)
+
+    def retrieve(self, move_scus):
+        """
+        Move the series into its own directory with the next free SCU, then compress it and hand it off.
+
+        The images of an incomplete retrieval are kept, and the next attempt only moves the missing ones. With a
+        NativeSCU, images are archived as they arrive; files written by movescu are archived after each move.
+        """
+        log.info('Reaping     %s' % self)
+        if self.reap_path and not os.path.isdir(self.reap_path):
+            self.reap_path = None
+        if not self.reap_path:
             stage_dir = '%s_%s_%s_%s' % (self.reaper.id_, self.exam.id_, self.id_, datetime.datetime.now().strftime('%s'))
-            reap_path = nimsutil.make_joined_path(self.reaper.reap_stage, stage_dir)
-            reap_count = self.reaper.scu.move(scu.SeriesQuery(SeriesInstanceUID=self.uid), reap_path)
-            if reap_count == self.image_count:
-                self.tar_into_acquisitions(reap_path)
-                shutil.move(reap_path, os.path.join(self.reaper.sort_stage, '.' + stage_dir))
-                os.rename(os.path.join(self.reaper.sort_stage, '.' + stage_dir), os.path.join(self.reaper.sort_stage, stage_dir))
-                self.needs_reaping = False
-                log.info('Reaped      %s' % self)
-            else:
-                shutil.rmtree(reap_path)
-                log.warning('Incomplete  %s, %d reaped' % (self, reap_count))
-
-    def tar_into_acquisitions(self, series_path):
-        dcm_dict = {}
-        log.info('Compressing %s' % self)
-        for filepath in [os.path.join(series_path, filename) for filename in os.listdir(series_path)]:
-            #dcm = nimsutil.dicomutil.DicomAcquisition(filepath)
-            dcm = nimsdata.nimsdicom.NIMSDicom(filepath)
-            os.utime(filepath, (int(dcm.timestamp.strftime('%s')), int(dcm.timestamp.strftime('%s'))))
-            dcm_dict.setdefault(dcm.acq_no, []).append(filepath)
-        for acq_no, acq_paths in dcm_dict.iteritems():
-            arcdir_path = os.path.join(series_path, '%s_%s_%s_dicoms' % (self.exam.id_, self.id_, acq_no))
-            os.mkdir(arcdir_path)
-            for filepath in acq_paths:
-                os.rename(filepath, '%s.dcm' % os.path.join(arcdir_path, os.path.basename(filepath)))
-            with tarfile.open('%s.tgz' % arcdir_path, 'w:gz', compresslevel=6) as archive:
-                archive.add(arcdir_path, arcname=os.path.basename(arcdir_path))
-            shutil.rmtree(arcdir_path)
+            self.reap_path = nimsutil.make_joined_path(self.reaper.reap_stage, stage_dir)
+            self.archiver = AcquisitionArchiver(self.reap_path, self.exam.id_, self.id_)
+            self.save()
+        elif not self.archiver:     # resuming a retrieval from before a restart
+            self.archiver = AcquisitionArchiver(self.reap_path, self.exam.id_, self.id_)
+            self.archiver.salvage()
+            self.archiver.add_files()
+        scu_ = move_scus.get()
+        try:
+            for query in self.missing_queries(scu_, self.archiver.uids):
+                scu_.move(query, self.reap_path, self.archiver.add)
+                self.archiver.add_files()
+        finally:
+            move_scus.put(scu_)
+        reap_count = len(self.archiver.uids)
+        if reap_count >= self.image_count:
+            self.archiver.close()
+            hand_off(self.reap_path, self.reaper.sort_stage)
+            self.reap_path = self.archiver = None
+            self.needs_reaping = False
+            self.save()
+            log.info('Reaped      %s' % self)
+        else:
+            log.warning('Incomplete  %s, %d reaped' % (self, reap_count))
+
+    def save(self):
+        self.reaper.state.save_series(self.exam.id_, self.exam.datetime, self.id_, self.uid, self.image_count, not self.needs_reaping, self.reap_path)
+
+    def missing_queries(self, scu_, received):
+        """
+        Return C-MOVE queries for the images not yet received.
+
+        The missing images are determined with an IMAGE level C-FIND. If the scanner does not answer it, the whole
+        series is moved again.
+        """
+        series_query = scu.SeriesQuery(SeriesInstanceUID=self.uid)
+        if not received:
+            return [series_query]
+        keys = {'SeriesInstanceUID': self.uid}
+        if self.exam.uid:
+            keys['StudyInstanceUID'] = self.exam.uid
+        available = set(resp.SOPInstanceUID for resp in scu_.find(scu.ImageQuery(SOPInstanceUID='', **keys)) if resp.get('SOPInstanceUID'))
+        if not available:
+            log.warning('Resuming    %s, no IMAGE level response, moving all images' % self)
+            return [series_query]
+        missing = sorted(available - received)
+        log.info('Resuming    %s, %d images missing' % (self, len(missing)))
+        return [scu.ImageQuery(SOPInstanceUID='\\'.join(missing[i:i+MOVE_BATCH_SIZE]), **keys) for i in range(0, len(missing), MOVE_BATCH_SIZE)]
+
+
+class PushedAcquisition(object):
+
+    def __init__(self, receiver, series_uid, exam_id, series_id, acq_no, pat_id, image_count, part=1):
+        self.series_uid = series_uid
+        self.exam_id = exam_id
+        self.series_id = series_id
+        self.acq_no = acq_no
+        self.pat_id = pat_id
+        self.image_count = image_count
+        self.part = part
+        self.received = 0
+        self.last_time = time.time()
+        stage_dir = '%s_%s_%s_%s_%d_%s' % (receiver.id_, exam_id, series_id, acq_no, part, datetime.datetime.now().strftime('%s'))
+        self.path = nimsutil.make_joined_path(receiver.reap_stage, stage_dir)
+        self.archiver = AcquisitionArchiver(self.path, exam_id, series_id, part)
+
+    def __str__(self):
+        part = ', Part %d' % self.part if self.part > 1 else ''
+        return 'Exam %s, Series %s, Acquisition %s%s (%s), %d images' % (self.exam_id, self.series_id, self.acq_no, part, self.pat_id, self.received)
+
+    def is_complete(self, idle_time):
+        return (self.image_count and self.received >= self.image_count) or time.time() - self.last_time > idle_time
+
+
+class DicomReceiver(object):
+
+    """
+    Reaper that receives images pushed by the scanner as a storage SCP, instead of polling for them.
+
+    Images are grouped by series and acquisition, and archived, as they arrive. An acquisition is complete once as many images have
+    arrived as its ImagesInAcquisition announces, or when no image has arrived for idle_time seconds. Images that
+    arrive after their acquisition was handed off form a new, numbered archive, which the sorter adds to the same
+    dataset next to the earlier ones.
+    """
+
+    tags = dict((keyword, dimse.KEYWORDS[keyword][0]) for keyword in
+            ['StudyID', 'PatientID', 'SeriesInstanceUID', 'SeriesNumber', 'AcquisitionNumber', 'ImagesInAcquisition'])
+
+    def __init__(self, id_, port, ae_title, pat_id, discard_ids, reap_path, sort_path, idle_time, sleep_time):
+        self.id_ = id_
+        self.pat_id = pat_id
+        self.discard_ids = discard_ids
+        self.reap_stage = nimsutil.make_joined_path(reap_path)
+        self.sort_stage = nimsutil.make_joined_path(sort_path)
+        self.idle_time = idle_time
+        self.sleep_time = sleep_time
+        self.acquisitions = {}
+        self.parts = {}     # number of parts handed off, by (series uid, acquisition number)
+        self.lock = threading.Lock()
+        self.completed = threading.Event()
+        self.alive = True
+        self.scp = _ReceiverSCP(self, port, ae_title)
+
+    def halt(self):
+        self.alive = False
+        self.completed.set()
+
+    def run(self):
+        self.recover()
+        self.scp.start()
+        log.info('Listening on port %s' % self.scp.server_address[1])
+        while self.alive:
+            self.completed.wait(min(self.sleep_time, self.idle_time))
+            self.completed.clear()
+            with self.lock:
+                completed = [acq for acq in self.acquisitions.itervalues() if acq.is_complete(self.idle_time)]
+                for acq in completed:
+                    del self.acquisitions[(acq.series_uid, acq.acq_no)]
+                    self.parts[(acq.series_uid, acq.acq_no)] = acq.part
+            for acq in completed:
+                acq.archiver.close()
+                hand_off(acq.path, self.sort_stage)
+                log.info('Reaped      %s' % acq)
+        self.scp.stop()
+
+    def recover(self):
+        """Hand off acquisitions left behind by a previous run; their images were already acknowledged to the scanner."""
+        for item in os.listdir(self.reap_stage):
+            if item.startswith(self.id_ + '_'):
+                fields = item[len(self.id_)+1:].split('_')
+                if len(fields) == 4:    # staged before parts were numbered
+                    fields.insert(3, '1')
+                if len(fields) != 5 or not fields[3].isdigit():
+                    log.warning('Ignoring    %s (not a pushed acquisition)' % item)
+                    continue
+                exam_id, series_id, acq_no, part, timestamp = fields
+                log.info('Recovering  Exam %s, Series %s, Acquisition %s, Part %s' % (exam_id, series_id, acq_no, part))
+                tar_into_acquisitions(os.path.join(self.reap_stage, item), exam_id, series_id, int(part))
+                hand_off(os.path.join(self.reap_stage, item), self.sort_stage)
+        for item in os.listdir(self.sort_stage):
+            if item.startswith('.' + self.id_):
+                shutil.rmtree(os.path.join(self.sort_stage, item))
+
+    def store(self, association, sop_class, sop_instance, transfer_syntax, data):
+        values = nimsutil.dicomutil.read_data_set(data, transfer_syntax, self.tags.values())
+        values = dict((keyword, values.get(tag, '').rstrip('\x00 ')) for keyword, tag in self.tags.iteritems())
+        pat_id = values['PatientID']
+        if pat_id.strip('/').lower() in self.discard_ids or (self.pat_id and not fnmatch.fnmatch(pat_id, self.pat_id)):
+            return dimse.SUCCESS
+        key = (values['SeriesInstanceUID'], values['AcquisitionNumber'] or '0')
+        with self.lock:     # the scanner sends over one association at a time anyway
+            acq = self.acquisitions.get(key)
+            if not acq:
+                acq = PushedAcquisition(self, key[0], values['StudyID'], values['SeriesNumber'], key[1], pat_id,
+                        int(values['ImagesInAcquisition'] or 0), self.parts.get(key, 0) + 1)
+                self.acquisitions[key] = acq
+                log.info('New         %s' % acq)
+            contents = dimse.part10(sop_class, sop_instance, transfer_syntax, data, association.calling_aet)
+            if not acq.archiver.add(dimse.instance_filename(sop_class, sop_instance), contents):
+                return dimse.UNABLE_TO_PROCESS
+            acq.received += 1
+            acq.last_time = time.time()
+            if acq.is_complete(self.idle_time):
+                self.completed.set()
+        return dimse.SUCCESS
+
+
+class _ReceiverSCP(dimse.SCP):
+
+    def __init__(self, receiver, port, ae_title):
+        dimse.SCP.__init__(self, port, ae_title)
+        self.receiver = receiver
+
+    def on_store(self, association, sop_class, sop_instance, transfer_syntax, data):
+        return self.receiver.store(association, sop_class, sop_instance, transfer_syntax, data)
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -192,6 +530,11 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('-d', '--discard', default='discard', help='space-separated list of Patient IDs to discard')
         self.add_argument('-p', '--patid', help='glob for Patient IDs to reap (default: "*")')
         self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to sleep before checking for new data')
+        self.add_argument('-n', '--native', action='store_true', help='use the built-in DICOM implementation instead of DCMTK')
+        self.add_argument('-m', '--movedest', action='append', default=[], metavar='AET:PORT',
+                help='additional move destination, as configured on the scanner, for concurrent retrievals (repeatable)')
+        self.add_argument('-r', '--receive', action='store_true', help='receive images pushed by the scanner on the return port instead of polling')
+        self.add_argument('-i', '--idletime', type=int, default=60, help='seconds without new images after which a pushed acquisition is complete')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
@@ -202,10 +545,18 @@ if __name__ == '__main__':
     host, port, return_port = args.dicomserver.split(':')
 
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
-    scu_ = scu.SCU(host, port, return_port, args.aet, args.aec)
-    datetime_file = os.path.join(os.path.dirname(__file__), '.%s.datetime' % args.aec)
-
-    reaper = DicomReaper(args.aec, scu_, args.patid, args.discard.split(), args.reap_path, args.sort_path, datetime_file, args.sleeptime)
+    if args.receive:
+        reaper = DicomReceiver(args.aec, return_port, args.aet, args.patid, args.discard.split(), args.reap_path, args.sort_path, args.idletime, args.sleeptime)
+    else:
+        scu_class = scu.NativeSCU if args.native else scu.SCU
+        move_dests = [(args.aet, return_port)] + [md.split(':') for md in args.movedest]
+        move_scus = [scu_class(host, port, move_port, args.aet, args.aec, move_aet) for move_aet, move_port in move_dests]
+        state = reaperstate.ReaperState(os.path.join(os.path.dirname(__file__), '.%s.sqlite' % args.aec))
+        datetime_file = os.path.join(os.path.dirname(__file__), '.%s.datetime' % args.aec)
+        if not state.get_reference_datetime() and os.path.exists(datetime_file):    # carry over from before the state store
+            state.set_reference_datetime(nimsutil.get_reference_datetime(datetime_file))
+        reaper = DicomReaper(args.aec, scu_class(host, port, return_port, args.aet, args.aec), args.patid, args.discard.split(),
+                args.reap_path, args.sort_path, state, args.sleeptime, move_scus)
 
     def term_handler(signum, stack):
         reaper.halt()
@@ -0,0 +1,550 @@
+"""
+dimse implements the parts of the DICOM upper layer protocol and the DIMSE-C services that NIMS needs.
+
+An Association is established either by requesting it from a peer, as an SCU does, or by accepting one on a socket, as
+the SCP classes below do. Messages are exchanged as a dict of command fields plus an optional encoded data set. Only the
+little endian transfer syntaxes are negotiated for queries; data sets of stored instances are written out as received.
+"""
+
+import os
+import socket
+import select
+import struct
+import logging
+import threading
+import SocketServer
+
+import nimsutil
+from nimsutil.dicomutil import IMPLICIT_VR_LITTLE_ENDIAN, EXPLICIT_VR_LITTLE_ENDIAN, EXPLICIT_VR_BIG_ENDIAN
+
+log = logging.getLogger('dicomreaper.dimse')
+
+APPLICATION_CONTEXT = '1.2.840.10008.3.1.1.1'
+IMPLEMENTATION_CLASS_UID = '2.25.204037458450684664196209721236285504179'
+IMPLEMENTATION_VERSION = 'NIMS'
+
+VERIFICATION = '1.2.840.10008.1.1'
+STUDY_ROOT_FIND = '1.2.840.10008.5.1.4.1.2.2.1'
+STUDY_ROOT_MOVE = '1.2.840.10008.5.1.4.1.2.2.2'
+
+# file name prefixes of stored instances, as used by DCMTK's storescp and movescu
+MODALITY_PREFIXES = {
+        '1.2.840.10008.5.1.4.1.1.4': 'MR',
+        '1.2.840.10008.5.1.4.1.1.4.1': 'MR',
+        '1.2.840.10008.5.1.4.1.1.7': 'SC',
+        '1.2.840.10008.5.1.4.1.1.66': 'RAW',
+        }
+
+A_ASSOCIATE_RQ, A_ASSOCIATE_AC, A_ASSOCIATE_RJ, P_DATA_TF, A_RELEASE_RQ, A_RELEASE_RP, A_ABORT = range(1, 8)
+
+C_STORE_RQ, C_STORE_RSP = 0x0001, 0x8001
+C_FIND_RQ, C_FIND_RSP = 0x0020, 0x8020
+C_MOVE_RQ, C_MOVE_RSP = 0x0021, 0x8021
+C_ECHO_RQ, C_ECHO_RSP = 0x0030, 0x8030
+
+SUCCESS = 0x0000
+PENDING = (0xFF00, 0xFF01)
+UNABLE_TO_PROCESS = 0xC000
+UNRECOGNIZED_OPERATION = 0x0211
+NO_DATA_SET = 0x0101
+
+AFFECTED_SOP_CLASS_UID = 0x00000002
+COMMAND_FIELD = 0x00000100
+MESSAGE_ID = 0x00000110
+MESSAGE_ID_RESPONDED_TO = 0x00000120
+MOVE_DESTINATION = 0x00000600
+PRIORITY = 0x00000700
+DATA_SET_TYPE = 0x00000800
+STATUS = 0x00000900
+AFFECTED_SOP_INSTANCE_UID = 0x00001000
+REMAINING = 0x00001020
+COMPLETED = 0x00001021
+FAILED = 0x00001022
+WARNING = 0x00001023
+
+COMMAND_VRS = {
+        0x00000000: 'UL', AFFECTED_SOP_CLASS_UID: 'UI', COMMAND_FIELD: 'US', MESSAGE_ID: 'US',
+        MESSAGE_ID_RESPONDED_TO: 'US', MOVE_DESTINATION: 'AE', PRIORITY: 'US', DATA_SET_TYPE: 'US', STATUS: 'US',
+        AFFECTED_SOP_INSTANCE_UID: 'UI', REMAINING: 'US', COMPLETED: 'US', FAILED: 'US', WARNING: 'US',
+        0x00001030: 'AE', 0x00001031: 'US',
+        }
+
+KEYWORDS = {
+        'SpecificCharacterSet':             (0x00080005, 'CS'),
+        'SOPClassUID':                      (0x00080016, 'UI'),
+        'SOPInstanceUID':                   (0x00080018, 'UI'),
+        'StudyDate':                        (0x00080020, 'DA'),
+        'SeriesDate':                       (0x00080021, 'DA'),
+        'StudyTime':                        (0x00080030, 'TM'),
+        'SeriesTime':                       (0x00080031, 'TM'),
+        'AccessionNumber':                  (0x00080050, 'SH'),
+        'QueryRetrieveLevel':               (0x00080052, 'CS'),
+        'RetrieveAETitle':                  (0x00080054, 'AE'),
+        'Modality':                         (0x00080060, 'CS'),
+        'StudyDescription':                 (0x00081030, 'LO'),
+        'SeriesDescription':                (0x0008103E, 'LO'),
+        'PatientName':                      (0x00100010, 'PN'),
+        'PatientID':                        (0x00100020, 'LO'),
+        'ProtocolName':                     (0x00181030, 'LO'),
+        'StudyInstanceUID':                 (0x0020000D, 'UI'),
+        'SeriesInstanceUID':                (0x0020000E, 'UI'),
+        'StudyID':                          (0x00200010, 'SH'),
+        'SeriesNumber':                     (0x00200011, 'IS'),
+        'AcquisitionNumber':                (0x00200012, 'IS'),
+        'InstanceNumber':                   (0x00200013, 'IS'),
+        'ImagesInAcquisition':              (0x00201002, 'IS'),
+        'NumberOfStudyRelatedInstances':    (0x00201208, 'IS'),
+        'NumberOfSeriesRelatedInstances':   (0x00201209, 'IS'),
+        }
+TAGS = dict((tag, (keyword, vr)) for keyword, (tag, vr) in KEYWORDS.iteritems())
+
+
+class DIMSEError(Exception):
+    pass
+
+
+def encode_element(tag, vr, value):
+    """Encode one element in implicit VR little endian."""
+    if vr == 'US':
+        value = struct.pack('<H', value)
+    elif vr == 'UL':
+        value = struct.pack('<L', value)
+    else:
+        value = str(value)
+        if len(value) % 2:
+            value += '\x00' if vr == 'UI' else ' '
+    return struct.pack('<HHL', tag >> 16, tag & 0xFFFF, len(value)) + value
+
+
+def encode_command(fields):
+    """Encode a dict of command fields, keyed by tag, as a command set."""
+    elements = ''.join(encode_element(tag, COMMAND_VRS[tag], value) for tag, value in sorted(fields.iteritems()))
+    return encode_element(0x00000000, 'UL', len(elements)) + elements
+
+
+def decode_command(data):
+    fields = {}
+    for tag, value in nimsutil.dicomutil.read_data_set(data).iteritems():
+        vr = COMMAND_VRS.get(tag)
+        if vr == 'US':
+            fields[tag] = struct.unpack('<H', value)[0]
+        elif vr == 'UL':
+            fields[tag] = struct.unpack('<L', value)[0]
+        else:
+            fields[tag] = value.rstrip('\x00 ')
+    return fields
+
+
+def encode_data_set(values):
+    """Encode a dict of values, keyed by keyword, as an implicit VR little endian data set."""
+    elements = [(KEYWORDS[keyword], value) for keyword, value in values.iteritems()]
+    return ''.join(encode_element(tag, vr, '' if value is None else value) for (tag, vr), value in sorted(elements))
+
+
+def decode_data_set(data, transfer_syntax=IMPLICIT_VR_LITTLE_ENDIAN):
+    """Return a sorted list of (tag, vr, keyword, value) for the elements of a data set that have a known keyword."""
+    elements = []
+    for tag, value in sorted(nimsutil.dicomutil.read_data_set(data, transfer_syntax).iteritems()):
+        if tag in TAGS:
+            keyword, vr = TAGS[tag]
+            elements.append((tag, vr, keyword, value.rstrip('\x00 ')))
+    return elements
+
+
+def part10(sop_class, sop_instance, transfer_syntax, data, source_aet=''):
+    """Return the contents of a DICOM file for a data set as received, i.e., with a file meta information header."""
+    def element(tag, vr, value):
+        if vr == 'OB':
+            return struct.pack('<HH2sHL', tag >> 16, tag & 0xFFFF, vr, 0, len(value)) + value
+        if len(value) % 2:
+            value += '\x00' if vr == 'UI' else ' '
+        return struct.pack('<HH2sH', tag >> 16, tag & 0xFFFF, vr, len(value)) + value
+    meta = ''.join([
+            element(0x00020001, 'OB', '\x00\x01'),
+            element(0x00020002, 'UI', sop_class),
+            element(0x00020003, 'UI', sop_instance),
+            element(0x00020010, 'UI', transfer_syntax),
+            element(0x00020012, 'UI', IMPLEMENTATION_CLASS_UID),
+            element(0x00020013, 'SH', IMPLEMENTATION_VERSION),
+            ] + ([element(0x00020016, 'AE', source_aet)] if source_aet else []))
+    return '\x00' * 128 + 'DICM' + struct.pack('<HH2sHL', 0x0002, 0x0000, 'UL', 4, len(meta)) + meta + data
+
+
+def instance_filename(sop_class, sop_instance):
+    return '%s.%s' % (MODALITY_PREFIXES.get(sop_class, 'UN'), sop_instance)
+
+
+def _item(item_type, data):
+    return struct.pack('>BBH', item_type, 0, len(data)) + data
+
+
+def _items(data):
+    """Yield (item type, item data) for a sequence of PDU items."""
+    offset = 0
+    while offset + 4 <= len(data):
+        item_type, length = struct.unpack('>BxH', data[offset:offset+4])
+        yield item_type, data[offset+4:offset+4+length]
+        offset += 4 + length
+
+
+def _user_information(max_pdu):
+    return _item(0x50, _item(0x51, struct.pack('>L', max_pdu)) + _item(0x52, IMPLEMENTATION_CLASS_UID) + _item(0x55, IMPLEMENTATION_VERSION))
+
+
+def _peer_max_pdu(items):
+    for item_type, item_data in items:
+        if item_type == 0x50:
+            for sub_type, sub_data in _items(item_data):
+                if sub_type == 0x51:
+                    return struct.unpack('>L', sub_data)[0]
+    return 0
+
+
+class Association(object):
+
+    """
+    An established association, over which DIMSE messages are sent and received.
+
+    contexts maps accepted presentation context ids to (abstract syntax, transfer syntax).
+    """
+
+    def __init__(self, sock, calling_aet, called_aet, contexts, max_pdu, timeout=None):
+        self.sock = sock
+        self.calling_aet = calling_aet
+        self.called_aet = called_aet
+        self.contexts = contexts
+        self.max_pdu = max_pdu or 1048576
+        self.message_id = 0
+        self.sock.settimeout(timeout)
+
+    def __str__(self):
+        return 'Association %s -> %s' % (self.calling_aet, self.called_aet)
+
+    @classmethod
+    def request(cls, host, port, calling_aet, called_aet, abstract_syntaxes,
+            transfer_syntaxes=(IMPLICIT_VR_LITTLE_ENDIAN,), timeout=None, max_pdu=65536):
+        """Connect to a peer and negotiate one presentation context per abstract syntax."""
+        sock = socket.create_connection((host, int(port)), timeout)
+        items = _item(0x10, APPLICATION_CONTEXT)
+        proposed = {}
+        for i, abstract_syntax in enumerate(abstract_syntaxes):
+            pc_id = 2 * i + 1
+            proposed[pc_id] = abstract_syntax
+            sub_items = _item(0x30, abstract_syntax) + ''.join(_item(0x40, ts) for ts in transfer_syntaxes)
+            items += _item(0x20, struct.pack('>B3x', pc_id) + sub_items)
+        items += _user_information(max_pdu)
+        try:
+            _send_pdu(sock, A_ASSOCIATE_RQ, struct.pack('>H2x16s16s32x', 1, called_aet.ljust(16), calling_aet.ljust(16)) + items)
+            pdu_type, data = _read_pdu(sock)
+        except:
+            sock.close()
+            raise
+        if pdu_type != A_ASSOCIATE_AC:
+            sock.close()
+            raise DIMSEError('association with %s rejected (PDU type %d)' % (called_aet, pdu_type))
+        contexts = {}
+        items = list(_items(data[68:]))
+        for item_type, item_data in items:
+            if item_type == 0x21 and ord(item_data[2]) == 0:       # accepted
+                pc_id = ord(item_data[0])
+                transfer_syntax = [sub_data for sub_type, sub_data in _items(item_data[4:]) if sub_type == 0x40][0]
+                contexts[pc_id] = (proposed[pc_id], transfer_syntax.rstrip('\x00 '))
+        return cls(sock, calling_aet, called_aet, contexts, _peer_max_pdu(items), timeout)
+
+    @classmethod
+    def accept(cls, sock, transfer_syntaxes, abstract_syntaxes=None, timeout=None, max_pdu=65536):
+        """
+        Accept an association requested on a connected socket.
+
+        Presentation contexts are accepted for any abstract syntax, unless abstract_syntaxes is given, with the first of
+        transfer_syntaxes that the peer offers. Contexts offering none of them, or lacking an abstract syntax, are
+        rejected.
+        """
+        sock.settimeout(timeout)
+        pdu_type, data = _read_pdu(sock)
+        if pdu_type != A_ASSOCIATE_RQ:
+            raise DIMSEError('expected A-ASSOCIATE-RQ, got PDU type %d' % pdu_type)
+        called_aet, calling_aet = data[4:20].strip(), data[20:36].strip()
+        contexts = {}
+        items = list(_items(data[68:]))
+        ac_items = _item(0x10, APPLICATION_CONTEXT)
+        for item_type, item_data in items:
+            if item_type == 0x20:
+                pc_id = ord(item_data[0])
+                sub_items = list(_items(item_data[4:]))
+                abstract_syntax = ([sd.rstrip('\x00 ') for st, sd in sub_items if st == 0x30] or [None])[0]
+                offered = [sd.rstrip('\x00 ') for st, sd in sub_items if st == 0x40]
+                transfer_syntax = ([ts for ts in transfer_syntaxes if ts in offered] or [None])[0]
+                if abstract_syntax is None:
+                    result = 1      # user rejection, of a malformed context
+                elif abstract_syntaxes is not None and abstract_syntax not in abstract_syntaxes:
+                    result = 3      # abstract syntax not supported
+                elif transfer_syntax is None:
+                    result = 4      # transfer syntaxes not supported
+                else:
+                    contexts[pc_id] = (abstract_syntax, transfer_syntax)
+                    result = 0
+                # the transfer syntax of a rejected context is not significant, but the sub-item is still required
+                ac_items += _item(0x21, struct.pack('>BxBx', pc_id, result) + _item(0x40, transfer_syntax or transfer_syntaxes[0]))
+        ac_items += _user_information(max_pdu)
+        _send_pdu(sock, A_ASSOCIATE_AC, data[:68] + ac_items)
+        return cls(sock, calling_aet, called_aet, contexts, _peer_max_pdu(items), timeout)
+
+    def is_idle(self):
+        """Return True if the peer has not released, aborted or closed the association in the meantime."""
+        try:
+            return not select.select([self.sock], [], [], 0)[0]
+        except (socket.error, ValueError):
+            return False
+
+    def context_id(self, abstract_syntax):
+        for pc_id, (syntax, transfer_syntax) in self.contexts.iteritems():
+            if syntax == abstract_syntax:
+                return pc_id
+        raise DIMSEError('%s: no accepted presentation context for %s' % (self, abstract_syntax))
+
+    def next_message_id(self):
+        self.message_id = self.message_id % 0xFFFF + 1
+        return self.message_id
+
+    def send_message(self, pc_id, fields, data=None):
+        """Send a command set, and data set if given, fragmented to fit the peer's maximum PDU length."""
+        fields[DATA_SET_TYPE] = NO_DATA_SET if data is None else 0x0000
+        fragment_size = self.max_pdu - 6
+        for payload, flags in [(encode_command(fields), 0x01)] + ([(data, 0x00)] if data is not None else []):
+            for offset in range(0, max(len(payload), 1), fragment_size):
+                fragment = payload[offset:offset+fragment_size]
+                last = 0x02 if offset + fragment_size >= len(payload) else 0x00
+                _send_pdu(self.sock, P_DATA_TF, struct.pack('>LBB', len(fragment) + 2, pc_id, flags | last) + fragment)
+
+    def receive_message(self):
+        """
+        Return (presentation context id, command fields, data set or None) of the next message.
+
+        None is returned if the peer releases the association, which is then closed.
+        """
+        command, data = [], []
+        fields = None
+        while True:
+            pdu_type, pdu_data = _read_pdu(self.sock)
+            if pdu_type == A_RELEASE_RQ:
+                _send_pdu(self.sock, A_RELEASE_RP, '\x00' * 4)
+                self.close()
+                return None
+            elif pdu_type == A_ABORT:
+                self.close()
+                raise DIMSEError('%s aborted by peer' % self)
+            elif pdu_type != P_DATA_TF:
+                self.abort()
+                raise DIMSEError('%s: unexpected PDU type %d' % (self, pdu_type))
+            offset = 0
+            while offset < len(pdu_data):
+                length, pc_id, flags = struct.unpack('>LBB', pdu_data[offset:offset+6])
+                (command if flags & 0x01 else data).append(pdu_data[offset+6:offset+4+length])
+                offset += 4 + length
+                if flags & 0x03 == 0x03:
+                    fields = decode_command(''.join(command))
+                    if fields.get(DATA_SET_TYPE) == NO_DATA_SET:
+                        return pc_id, fields, None
+                elif flags & 0x03 == 0x02:
+                    return pc_id, fields, ''.join(data)
+
+    def receive_response(self, message_id):
+        while True:
+            message = self.receive_message()
+            if message is None:
+                raise DIMSEError('%s released by peer' % self)
+            pc_id, fields, data = message
+            if fields.get(MESSAGE_ID_RESPONDED_TO) == message_id:
+                return fields, data
+            log.debug('%s: ignoring response to message %s' % (self, fields.get(MESSAGE_ID_RESPONDED_TO)))
+
+    def c_echo(self):
+        message_id = self.next_message_id()
+        self.send_message(self.context_id(VERIFICATION), {AFFECTED_SOP_CLASS_UID: VERIFICATION, COMMAND_FIELD: C_ECHO_RQ, MESSAGE_ID: message_id})
+        return self.receive_response(message_id)[0].get(STATUS)
+
+    def c_find(self, sop_class, identifier):
+        """Return the final status and a list of encoded matches for an encoded identifier."""
+        message_id = self.next_message_id()
+        self.send_message(self.context_id(sop_class),
+                {AFFECTED_SOP_CLASS_UID: sop_class, COMMAND_FIELD: C_FIND_RQ, MESSAGE_ID: message_id, PRIORITY: 0}, identifier)
+        matches = []
+        while True:
+            fields, data = self.receive_response(message_id)
+            if fields.get(STATUS) not in PENDING:
+                return fields.get(STATUS), matches
+            if data is not None:
+                matches.append(data)
+
+    def c_move(self, sop_class, identifier, destination):
+        """Return the final status and the numbers of completed, failed and warning sub-operations."""
+        message_id = self.next_message_id()
+        self.send_message(self.context_id(sop_class),
+                {AFFECTED_SOP_CLASS_UID: sop_class, COMMAND_FIELD: C_MOVE_RQ, MESSAGE_ID: message_id, PRIORITY: 0,
+                    MOVE_DESTINATION: destination}, identifier)
+        while True:
+            fields, data = self.receive_response(message_id)
+            if fields.get(STATUS) not in PENDING:
+                return fields.get(STATUS), fields.get(COMPLETED, 0), fields.get(FAILED, 0), fields.get(WARNING, 0)
+            log.debug('%s: %d sub-operations remaining' % (self, fields.get(REMAINING, 0)))
+
+    def c_store(self, sop_class, sop_instance, data):
+        message_id = self.next_message_id()
+        self.send_message(self.context_id(sop_class),
+                {AFFECTED_SOP_CLASS_UID: sop_class, COMMAND_FIELD: C_STORE_RQ, MESSAGE_ID: message_id, PRIORITY: 0,
+                    AFFECTED_SOP_INSTANCE_UID: sop_instance}, data)
+        return self.receive_response(message_id)[0].get(STATUS)
+
+    def release(self):
+        try:
+            _send_pdu(self.sock, A_RELEASE_RQ, '\x00' * 4)
+            while _read_pdu(self.sock)[0] not in (A_RELEASE_RP, A_ABORT):
+                pass
+        except (socket.error, DIMSEError):
+            pass
+        self.close()
+
+    def abort(self):
+        try:
+            _send_pdu(self.sock, A_ABORT, '\x00' * 4)
+        except socket.error:
+            pass
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+
+def _send_pdu(sock, pdu_type, data):
+    sock.sendall(struct.pack('>BxL', pdu_type, len(data)) + data)
+
+
+def _read_pdu(sock):
+    pdu_type, length = struct.unpack('>BxL', _recv(sock, 6))
+    return pdu_type, _recv(sock, length)
+
+
+def _recv(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1048576))
+        if not chunk:
+            raise DIMSEError('connection closed by peer')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+class _AssociationHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            association = Association.accept(self.request, self.server.transfer_syntaxes, self.server.abstract_syntaxes,
+                    self.server.association_timeout)
+        except (socket.error, DIMSEError) as ex:
+            log.warning('Failed to accept association from %s: %s' % (self.client_address[0], ex))
+            return
+        log.debug('Accepted    %s' % association)
+        try:
+            while True:
+                message = association.receive_message()
+                if message is None:
+                    break
+                self.server.dispatch(association, *message)
+        except (socket.error, DIMSEError) as ex:
+            log.warning('%s: %s' % (association, ex))
+            association.close()
+
+
+class SCP(SocketServer.ThreadingTCPServer):
+
+    """
+    Base class of service class providers; each association is served in its own thread.
+
+    Subclasses implement on_store(), on_find() and on_move() for the services they provide. Verification is always
+    provided.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+    transfer_syntaxes = (EXPLICIT_VR_LITTLE_ENDIAN, IMPLICIT_VR_LITTLE_ENDIAN, EXPLICIT_VR_BIG_ENDIAN)
+    abstract_syntaxes = None
+
+    def __init__(self, port, ae_title='', host='', timeout=None):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, int(port)), _AssociationHandler)
+        self.ae_title = ae_title
+        self.association_timeout = timeout
+        self.thread = None
+
+    def start(self):
+        """Serve associations in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def dispatch(self, association, pc_id, fields, data):
+        command = fields.get(COMMAND_FIELD)
+        sop_class = association.contexts[pc_id][0]
+        response = {AFFECTED_SOP_CLASS_UID: sop_class, COMMAND_FIELD: command | 0x8000, MESSAGE_ID_RESPONDED_TO: fields.get(MESSAGE_ID)}
+        if command == C_ECHO_RQ:
+            response[STATUS] = SUCCESS
+        elif command == C_STORE_RQ:
+            response[AFFECTED_SOP_INSTANCE_UID] = fields.get(AFFECTED_SOP_INSTANCE_UID)
+            try:
+                response[STATUS] = self.on_store(association, sop_class, fields.get(AFFECTED_SOP_INSTANCE_UID), association.contexts[pc_id][1], data)
+            except (IOError, OSError) as ex:
+                log.warning('%s: failed to store %s: %s' % (association, fields.get(AFFECTED_SOP_INSTANCE_UID), ex))
+                response[STATUS] = UNABLE_TO_PROCESS
+        elif command == C_FIND_RQ:
+            for match in self.on_find(association, sop_class, data):
+                pending = dict(response)
+                pending[STATUS] = PENDING[0]
+                association.send_message(pc_id, pending, match)
+            response[STATUS] = SUCCESS
+        elif command == C_MOVE_RQ:
+            completed, failed, warning = self.on_move(association, sop_class, data, fields.get(MOVE_DESTINATION))
+            response.update({STATUS: SUCCESS if not failed else 0xB000, COMPLETED: completed, FAILED: failed, WARNING: warning, REMAINING: 0})
+        else:
+            response[STATUS] = UNRECOGNIZED_OPERATION
+        association.send_message(pc_id, response)
+
+    def on_store(self, association, sop_class, sop_instance, transfer_syntax, data):
+        return UNRECOGNIZED_OPERATION
+
+    def on_find(self, association, sop_class, identifier):
+        return []
+
+    def on_move(self, association, sop_class, identifier, destination):
+        return 0, 0, 0
+
+
+class StorageSCP(SCP):
+
+    """
+    Storage SCP that writes received instances, as DICOM files named like DCMTK names them, into dest_path.
+
+    If sink is set, it is called with the file name and contents of each instance instead. dest_path and sink may be
+    changed between associations, e.g., to receive the sub-operations of each C-MOVE separately.
+    """
+
+    def __init__(self, port, dest_path='.', ae_title='', host='', timeout=None):
+        SCP.__init__(self, port, ae_title, host, timeout)      # SocketServer classes are old-style
+        self.dest_path = dest_path
+        self.sink = None
+
+    def on_store(self, association, sop_class, sop_instance, transfer_syntax, data):
+        filename = instance_filename(sop_class, sop_instance)
+        contents = part10(sop_class, sop_instance, transfer_syntax, data, association.calling_aet)
+        if self.sink:
+            self.sink(filename, contents)
+        else:
+            with open(os.path.join(self.dest_path, filename), 'wb') as fd:
+                fd.write(contents)
+        return SUCCESS
+
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+Offline bulk import of historical DICOM and PFile archives.
+
+The source tree is left untouched: files are hard-linked (or copied) into the Dataset.relpath layout under nims_path.
+Completed directories are appended to a checkpoint file, so an interrupted import resumes where it stopped.
+"""
+
+import os
+import stat
+import time
+import errno
+import shutil
+import signal
+import logging
+import argparse
+import datetime
+import multiprocessing
+import multiprocessing.pool
+
+import sqlalchemy
+import transaction
+
+import nimsutil
+import nimsdata
+from nimsgears import model
+
+import sorter
+
+log = logging.getLogger('importer')
+
+
+def list_directory(dirpath):
+    """Return (dirpath, subdirectory names, file names) for one directory, not following symlinks."""
+    dirnames, filenames = [], []
+    try:
+        entries = os.listdir(dirpath)
+    except OSError as e:
+        log.warning('Cannot list %s: %s' % (dirpath, e.strerror))
+        return dirpath, dirnames, filenames
+    for entry in entries:
+        if entry.startswith('.'):
+            continue
+        try:
+            mode = os.lstat(os.path.join(dirpath, entry)).st_mode
+        except OSError:
+            continue
+        if stat.S_ISDIR(mode):
+            dirnames.append(entry)
+        elif stat.S_ISREG(mode):
+            filenames.append(entry)
+    return dirpath, sorted(dirnames), sorted(filenames)
+
+
+def scan_tree(root_path, threads):
+    """
+    Yield (dirpath, filenames) for every directory under root_path, breadth first.
+
+    Each level of the tree is listed by a pool of threads, which hides the per-directory latency of network file
+    systems. Directories are yielded in a deterministic order.
+    """
+    pool = multiprocessing.pool.ThreadPool(threads)
+    frontier = [root_path]
+    try:
+        while frontier:
+            next_frontier = []
+            for dirpath, dirnames, filenames in pool.imap(list_directory, frontier):
+                next_frontier += [os.path.join(dirpath, dn) for dn in dirnames]
+                yield dirpath, filenames
+            frontier = next_frontier
+    finally:
+        pool.terminate()
+
+
+class Importer(object):
+
+    def __init__(self, db_uri, source_path, nims_path, checkpoint_path, copy=False, jobs=4, scan_threads=8):
+        super(Importer, self).__init__()
+        self.source_path = os.path.abspath(source_path)
+        self.nims_path = nimsutil.make_joined_path(nims_path)
+        self.checkpoint_path = checkpoint_path
+        self.copy = copy
+        self.scan_threads = scan_threads
+        self.alive = True
+        self.pool = multiprocessing.Pool(jobs)      # fork before the db engine exists
+        model.init_model(sqlalchemy.create_engine(db_uri))
+
+    def halt(self):
+        self.alive = False
+
+    def run(self):
+        done = set()
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as checkpoint:
+                done = set(line.rstrip('\n') for line in checkpoint)
+            log.info('Resuming import of %s, %d directories already done' % (self.source_path, len(done)))
+        counts = dict(imported=0, duplicate=0, unparsable=0, conflicting=0)
+        start = time.time()
+        with open(self.checkpoint_path, 'a') as checkpoint:
+            for dirpath, filenames in scan_tree(self.source_path, self.scan_threads):
+                if not self.alive:
+                    break
+                relpath = os.path.relpath(dirpath, self.source_path)
+                if not filenames or relpath in done:
+                    continue
+                self.import_directory(dirpath, filenames, counts)
+                checkpoint.write(relpath + '\n')
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+                log.info('Imported %s: %d files so far (%d duplicates, %d unparsable, %d conflicting), %.1f files/s'
+                        % (relpath, counts['imported'], counts['duplicate'], counts['unparsable'], counts['conflicting'],
+                            sum(counts.itervalues()) / (time.time() - start)))
+        self.pool.terminate()
+
+    def import_directory(self, dirpath, filenames, counts):
+        """
+        Import one directory, resolving each dataset once, with a single commit.
+
+        Datasets and their containers are resolved through the model, as by the sorter, so that subjects are matched,
+        primary datasets picked, and ancestry and rollups kept, in one place; the cache of Dataset.from_mrfile spares
+        the queries for datasets seen before. Clashing file names are checked before anything is recorded, so that a
+        group of files that cannot be placed is skipped without undoing the rest of the directory.
+        """
+        filenames, aux_paths = sorter.split_aux_files(dirpath, filenames)
+        file_groups = {}
+        file_instances = {}
+        filepaths = [os.path.join(dirpath, fn) for fn in filenames]
+        for filepath, dataset_key, instances in self.pool.imap_unordered(sorter.inspect_file, filepaths, chunksize=16):
+            if dataset_key:
+                file_groups.setdefault(dataset_key, []).append(filepath)
+                file_instances[filepath] = instances
+            else:
+                log.debug('Skipping unparsable %s' % filepath)
+                counts['unparsable'] += 1
+        for group_paths in file_groups.itervalues():
+            group_paths.sort()
+            try:
+                mrfile = nimsdata.parse(group_paths[0])
+            except nimsdata.NIMSDataError:
+                counts['unparsable'] += len(group_paths)
+                continue
+            dataset = model.Dataset.from_mrfile(mrfile, self.nims_path, commit=False)
+            instances = [i for fp in group_paths for i in file_instances[fp]]
+            new_uids = dataset.new_instance_uids(instances)
+            new_paths = [fp for fp in group_paths if any(uid in new_uids for uid, digest in file_instances[fp])]
+            counts['duplicate'] += len(group_paths) - len(new_paths)
+            if not new_paths:
+                continue
+            dataset_path = os.path.join(self.nims_path, dataset.relpath)
+            filepaths = []
+            for filepath in new_paths:
+                filename = os.path.basename(filepath)
+                filepaths += [filepath] + aux_paths.get(os.path.splitext(filename)[0] if dataset.compressed else filename, [])
+            names = sorter.place_files(dataset_path, filepaths)
+            if names is None:
+                log.error('Not importing %d files of %s for %s' % (len(new_paths), dirpath, dataset.relpath))
+                counts['conflicting'] += len(new_paths)
+                continue
+            dataset.add_instances(instances)
+            counts['imported'] += len(new_paths)
+            for filepath in filepaths:
+                self.import_file(filepath, os.path.join(dataset_path, names[filepath]))
+            dataset.add_files(self.nims_path, [names[fp] for fp in filepaths])
+            dataset.updatetime = datetime.datetime.now()
+            if dataset.is_trash or dataset.container.is_trash:
+                dataset.untrash()
+        transaction.commit()
+
+    def import_file(self, filepath, dest_path):
+        """
+        Link or copy a file to its place in a dataset directory, as chosen by sorter.place_files.
+
+        Archives often reuse file names across directories, so a clashing name is numbered before its conventional
+        suffix. A file that is already present with identical content, e.g., from an import that was interrupted before
+        its commit, is reused.
+        """
+        if os.path.exists(dest_path):
+            return
+        if self.copy:
+            shutil.copy2(filepath, dest_path)
+        else:
+            try:
+                os.link(filepath, dest_path)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                shutil.copy2(filepath, dest_path)   # different file system or link limit
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super(ArgumentParser, self).__init__()
+        self.add_argument('db_uri', help='database URI')
+        self.add_argument('source_path', help='root of the archive to import')
+        self.add_argument('nims_path', help='data destination')
+        self.add_argument('-c', '--checkpoint', help='checkpoint file for resuming (default: nims_path/.import_<source>)')
+        self.add_argument('-C', '--copy', action='store_true', help='copy files instead of hard-linking them')
+        self.add_argument('-j', '--jobs', type=int, default=4, help='number of processes for parsing headers (default: 4)')
+        self.add_argument('-t', '--threads', type=int, default=8, help='number of threads for scanning directories (default: 8)')
+        self.add_argument('-f', '--logfile', help='path to log file')
+        self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
+        self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
+
+
+if __name__ == '__main__':
+    args = ArgumentParser().parse_args()
+    nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
+    checkpoint = args.checkpoint or os.path.join(args.nims_path, '.import_' + os.path.basename(os.path.abspath(args.source_path)))
+    importer = Importer(args.db_uri, args.source_path, args.nims_path, checkpoint, args.copy, args.jobs, args.threads)
+
+    def term_handler(signum, stack):
+        importer.halt()
+        log.info('Receieved SIGTERM - shutting down...')
+    signal.signal(signal.SIGTERM, term_handler)
+
+    importer.run()
+    log.warning('Process halted')
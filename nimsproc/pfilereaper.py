@@ -5,12 +5,15 @@
 import re
 import os
 import glob
+import gzip
 import time
 import shutil
 import signal
 import logging
 import argparse
+import sqlite3
 import datetime
+import hashlib
 
 import nimsutil
 import nimsdata
@@ -20,7 +23,7 @@ log = logging.getLogger('pfilereaper')
 
 class PFileReaper(object):
 
-    def __init__(self, id_, pat_id, discard_ids, data_path, reap_path, sort_path, datetime_file, sleep_time):
+    def __init__(self, id_, pat_id, discard_ids, data_path, reap_path, sort_path, datetime_file, header_cache, sleep_time, tail=False):
         super(PFileReaper, self).__init__()
         self.id_ = id_
         self.pat_id = pat_id
@@ -29,7 +32,10 @@ class PFileReaper(object):
         self.reap_stage = nimsutil.make_joined_path(reap_path)
         self.sort_stage = nimsutil.make_joined_path(sort_path)
         self.datetime_file = datetime_file
+        self.headers = header_cache
         self.sleep_time = sleep_time
+        self.tail = tail
+        self.tails = {}
 
         self.current_file_timestamp = nimsutil.get_reference_datetime(self.datetime_file)
         self.monitored_files = {}
@@ -56,6 +62,11 @@ class PFileReaper(object):
                 log.warning(e)
             else:
                 reap_files = sorted(filter(lambda f: f.mod_time >= self.current_file_timestamp, reap_files), key=lambda f: f.mod_time)
+                for path in set(self.monitored_files) - set(rf.path for rf in reap_files):
+                    self.headers.forget(path)
+                for path in set(self.tails) - set(rf.path for rf in reap_files):   # vanished while tailing
+                    if self.tails[path]: self.tails[path].abort()
+                    del self.tails[path]
                 for rf in reap_files:
                     if rf.path in self.monitored_files:
                         mf = self.monitored_files[rf.path]
@@ -66,10 +77,12 @@ class PFileReaper(object):
                                 self.current_file_timestamp = rf.mod_time
                         elif mf.needs_reaping:
                             log.info('Monitoring  %s' % rf)
+                            if self.tail: rf.tail()
                         elif rf.size == mf.size:
                             rf.needs_reaping = False
                     else:
                         log.info('Discovered  %s' % rf)
+                        if self.tail: rf.tail()
                 self.monitored_files = dict(zip([rf.path for rf in reap_files], reap_files))
             finally:
                 time.sleep(self.sleep_time)
@@ -82,10 +95,12 @@ class ReapPFile(object):
         self.basename = os.path.basename(path)
         self.reaper = reaper
         self.pat_id = None
-        self.size = os.path.getsize(path)
-        self.mod_time = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.mod_time = datetime.datetime.fromtimestamp(stat.st_mtime)
         self.needs_reaping = True
-        self.pfile = None
+        self.series_uid = None
 
     def __repr__(self):
         return '<ReapPFile %s, %d, %s, %s>' % (self.basename, self.size, self.mod_time, self.needs_reaping)
@@ -94,34 +109,72 @@ class ReapPFile(object):
         info = ' (%s) %s_%s_%s' % (self.pat_id, self.exam, self.series, self.acq) if self.pat_id else ''
         return '%s [%s]%s' % (self.basename, nimsutil.hrsize(self.size), info)
 
+    def inspect(self):
+        """Parse the header, and return whether this PFile is to be reaped."""
+        header = self.reaper.headers.get(self.path, self.size, self.mtime)
+        self.pat_id = header['patient_id']
+        self.exam = header['exam_no']
+        self.series = header['series_no']
+        self.acq = header['acq_no']
+        self.series_uid = header['series_uid']
+        if self.pat_id.strip('/').lower() in self.reaper.discard_ids:
+            log.info('Discarding  %s' % self)
+            return False
+        if self.reaper.pat_id and not re.match(self.reaper.pat_id.replace('*','.*'), self.pat_id):
+            log.info('Ignoring    %s' % self)
+            return False
+        return True
+
+    def tail(self):
+        """Compress what has been written of a growing PFile so far, starting as soon as its header is readable."""
+        if self.path not in self.reaper.tails:
+            try:
+                wanted = self.inspect()
+            except nimsdata.nimsraw.NIMSPFileError:
+                return  # header not complete yet
+            if wanted:
+                stage_dir = '%s_%s' % (self.reaper.id_, datetime.datetime.now().strftime('%s.%f'))
+                reap_path = nimsutil.make_joined_path(self.reaper.reap_stage, stage_dir)
+                self.reaper.tails[self.path] = PFileTail(self.path, os.path.join(reap_path, self.basename + '.gz'))
+                log.info('Tailing     %s' % self)
+            else:
+                self.reaper.tails[self.path] = None
+        tail = self.reaper.tails[self.path]
+        if tail:
+            try:
+                tail.update()
+            except IOError as e:
+                log.warning('Error while tailing %s (%s)' % (self, e))
+                tail.abort()
+                del self.reaper.tails[self.path]
+
     def reap(self):
+        tail = self.reaper.tails.pop(self.path, None)
         try:
             log.info('Inspecting  %s' % self)
-            self.pfile = nimsdata.nimsraw.NIMSPFile(self.path)
+            wanted = self.inspect()
         except nimsdata.nimsraw.NIMSPFileError as e:
-            self.needs_reaping = False
+            wanted = False
             log.warning('Skipping    %s (%s)' % (self, str(e)))
+        if not wanted:
+            self.needs_reaping = False
+            if tail: tail.abort()
             return
+        if tail:
+            reap_path = os.path.dirname(tail.gzpath)
+            stage_dir = os.path.basename(reap_path)
         else:
-            self.pat_id = self.pfile.patient_id
-            self.exam = self.pfile.exam_no
-            self.series = self.pfile.series_no
-            self.acq = self.pfile.acq_no
             stage_dir = '%s_%s' % (self.reaper.id_, datetime.datetime.now().strftime('%s.%f'))
             reap_path = nimsutil.make_joined_path(self.reaper.reap_stage, stage_dir)
-            aux_reap_files = [arf for arf in glob.glob(self.path + '_*') if self.is_aux_file(arf)]
-        if self.pat_id.strip('/').lower() in reaper.discard_ids:
-            self.needs_reaping = False
-            log.info('Discarding  %s' % self)
-            return
-        if self.reaper.pat_id and not re.match(self.reaper.pat_id.replace('*','.*'), self.pat_id):
-            self.needs_reaping = False
-            log.info('Ignoring    %s' % self)
-            return
+        aux_reap_files = [arf for arf in glob.glob(self.path + '_*') if self.is_aux_file(arf)]
 
         try:
             log.info('Reaping     %s' % self)
-            shutil.copy2(self.path, reap_path)
+            digest_size = tail.finish() if tail else None
+            if not digest_size:
+                if tail: log.warning('Reaping     %s in full (changed in place while tailing)' % self)
+                digest_size = nimsutil.gzip_copy(self.path, os.path.join(reap_path, self.basename + '.gz'), 0o644)
+            nimsutil.write_manifest(reap_path, {self.basename + '.gz': digest_size})
             for arf in aux_reap_files:
                 shutil.copy2(arf, os.path.join(reap_path, '_' + os.path.basename(arf)))
                 log.info('Reaping     %s' % '_' + os.path.basename(arf))
@@ -131,21 +184,115 @@ class ReapPFile(object):
         except (shutil.Error, IOError):
             log.warning('Error while reaping %s' % self)
         else:
-            log.info('Compressing %s' % self)
-            nimsutil.gzip_inplace(os.path.join(reap_path, self.basename), 0o644)
             shutil.move(reap_path, os.path.join(self.reaper.sort_stage, '.' + stage_dir))
             os.rename(os.path.join(self.reaper.sort_stage, '.' + stage_dir), os.path.join(self.reaper.sort_stage, stage_dir))
             self.needs_reaping = False
             log.info('Reaped      %s' % self)
 
     def is_aux_file(self, filepath):
-        if open(filepath).read(32) == self.pfile._hdr.series.series_uid:
+        if open(filepath).read(32) == self.series_uid:
             return True
+        stat = os.stat(filepath)
         try:
-            return (nimsdata.nimsraw.NIMSPFile(filepath)._hdr.series.series_uid == self.pfile._hdr.series.series_uid)
+            return self.reaper.headers.get(filepath, stat.st_size, stat.st_mtime)['series_uid'] == self.series_uid
         except nimsdata.nimsraw.NIMSPFileError:
             return False
 
+
+class HeaderCache(object):
+
+    """
+    Persistent cache of the PFile header fields used by the reaper, keyed by path, size and modification time.
+
+    A file is parsed again only once its size or mtime changes, which keeps polling a large directory on a slow file
+    system cheap. Files that cannot be parsed are cached as such.
+    """
+
+    fields = ('patient_id', 'exam_no', 'series_no', 'acq_no', 'series_uid')
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS header (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, error TEXT, %s)'
+                % ', '.join(self.fields))
+        self.db.commit()
+
+    def get(self, path, size, mtime):
+        """Return the header fields of a PFile as a dict, or raise NIMSPFileError if it cannot be parsed."""
+        row = self.db.execute('SELECT error, %s FROM header WHERE path = ? AND size = ? AND mtime = ?' % ', '.join(self.fields),
+                (path, size, mtime)).fetchone()
+        if row is None:
+            try:
+                pfile = nimsdata.nimsraw.NIMSPFile(path)
+            except nimsdata.nimsraw.NIMSPFileError as e:
+                row = (str(e),) + (None,) * len(self.fields)
+            else:
+                row = (None, pfile.patient_id, pfile.exam_no, pfile.series_no, pfile.acq_no, sqlite3.Binary(pfile._hdr.series.series_uid))
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO header VALUES (?, ?, ?, %s)' % ', '.join('?' * (len(self.fields) + 1)),
+                        (path, size, mtime) + row)
+        if row[0] is not None:
+            raise nimsdata.nimsraw.NIMSPFileError(row[0])
+        header = dict(zip(self.fields, row[1:]))
+        header['series_uid'] = str(header['series_uid'])
+        return header
+
+    def forget(self, path):
+        """Drop the entries of a PFile and its auxiliary files."""
+        with self.db:
+            self.db.execute('DELETE FROM header WHERE path = ? OR substr(path, 1, ?) = ?', (path, len(path) + 1, path + '_'))
+
+
+class PFileTail(object):
+
+    """
+    Copy, compress and hash a PFile incrementally while it is being acquired.
+
+    PFiles grow append-only during a scan, so everything up to the current end of file can be compressed before the
+    scan ends. The leading bytes are kept and compared again at the end; if the file shrank or its header was
+    rewritten in place, finish() returns None and the file must be reaped in full.
+    """
+
+    head_size = 1048576
+
+    def __init__(self, path, gzpath):
+        self.path = path
+        self.gzpath = gzpath
+        self.gzfile = gzip.open(gzpath, 'wb', compresslevel=4)
+        self.hash_ = hashlib.sha1()
+        self.size = 0
+        self.head = ''
+
+    def update(self):
+        """Compress whatever has been appended since the last update."""
+        with open(self.path, 'rb') as pathfile:
+            pathfile.seek(self.size)
+            for chunk in iter(lambda: pathfile.read(1048576), ''):
+                if len(self.head) < self.head_size:
+                    self.head += chunk[:self.head_size - len(self.head)]
+                self.hash_.update(chunk)
+                self.size += len(chunk)
+                self.gzfile.write(chunk)
+            self.gzfile.flush()
+
+    def finish(self):
+        """Compress the final chunk, and return the SHA-1 digest and size of the PFile, or None if inconsistent."""
+        self.update()
+        self.gzfile.close()
+        with open(self.path, 'rb') as pathfile:
+            consistent = os.fstat(pathfile.fileno()).st_size == self.size and pathfile.read(len(self.head)) == self.head
+        if not consistent:
+            os.remove(self.gzpath)
+            return None
+        shutil.copystat(self.path, self.gzpath)
+        os.chmod(self.gzpath, 0o644)
+        return self.hash_.digest(), self.size
+
+    def abort(self):
+        self.gzfile.close()
+        shutil.rmtree(os.path.dirname(self.gzpath), ignore_errors=True)
+
+
 class ArgumentParser(argparse.ArgumentParser):
 
     def __init__(self):
@@ -156,6 +303,7 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('-p', '--patid', help='glob for patient IDs to reap (default: "*")')
         self.add_argument('-d', '--discard', default='discard', help='space-separated list of Patient IDs to discard')
         self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to sleep before checking for new data')
+        self.add_argument('-t', '--tail', action='store_true', help='compress PFiles incrementally while they are acquired')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
@@ -167,8 +315,10 @@ if __name__ == '__main__':
     reaper_id = args.data_path.strip('/').replace('/', '_')
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
     datetime_file = os.path.join(os.path.dirname(__file__), '.%s.datetime' % reaper_id)
+    header_cache = HeaderCache(os.path.join(os.path.dirname(__file__), '.%s.headers' % reaper_id))
 
-    reaper = PFileReaper(reaper_id, args.patid, args.discard.split(), args.data_path, args.reap_path, args.sort_path, datetime_file, args.sleeptime)
+    reaper = PFileReaper(reaper_id, args.patid, args.discard.split(), args.data_path, args.reap_path, args.sort_path, datetime_file,
+            header_cache, args.sleeptime, args.tail)
 
     def term_handler(signum, stack):
         reaper.halt()
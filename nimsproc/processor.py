@@ -75,10 +75,11 @@ class Processor(object):
 
     def reset_all(self):
         """Reset all running of failed jobs to pending."""
-        job_query = Job.query.filter((Job.status == u'running') | (Job.status == u'failed'))
+        job_query = Job.query_with_containers().filter((Job.status == u'running') | (Job.status == u'failed'))
         if self.task:
             job_query = job_query.filter(Job.task==self.task)
-        for job in job_query.all():
+        job_rows = job_query.all()
+        for job in [row.Job for row in job_rows]:
             job.status = u'pending'
             job.activity = u'reset to pending'
             log.info(u'%d %s %s' % (job.id, job, job.activity))
@@ -156,9 +157,9 @@ class Pipeline(threading.Thread):
                         for f in physio_files:
                             shutil.copy2(f, arcdir_path)
                         filename = '%s_physio.tgz' % self.job.data_container.name
-                        dataset.filenames = [filename]
                         with tarfile.open(os.path.join(self.nims_path, dataset.relpath, filename), 'w:gz', compresslevel=6) as archive:
                             archive.add(arcdir_path, arcname=os.path.basename(arcdir_path))
+                        dataset.add_files(self.nims_path, [filename])
                         try:
                             reg_filename = '%s_physio_regressors.csv.gz' % self.job.data_container.name
                             physio.write_regressors(os.path.join(self.nims_path, dataset.relpath, reg_filename))
@@ -166,7 +167,7 @@ class Pipeline(threading.Thread):
                             self.job.activity = u'error generating regressors from physio data'
                             log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
                         else:
-                            dataset.filenames += [reg_filename]
+                            dataset.add_files(self.nims_path, [reg_filename])
                 else:
                     self.job.activity = u'invalid physio found and discarded'
                     log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
@@ -214,11 +215,9 @@ class DicomPipeline(Pipeline):
 
                 conv_ds.kind = u'derived'
                 conv_ds.container = self.job.data_container
-                filenames = []
                 for f in outputdir_list:
-                    filenames.append(f)
                     shutil.copy2(os.path.join(outputdir, f), os.path.join(self.nims_path, conv_ds.relpath))
-                conv_ds.filenames = filenames
+                conv_ds.sync_files(self.nims_path)
                 transaction.commit()
 
             if conv_type == 'nifti':
@@ -231,7 +230,7 @@ class DicomPipeline(Pipeline):
                 log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
                 pyramid_ds.kind = u'web'
                 pyramid_ds.container = self.job.data_container
-                pyramid_ds.filenames = os.listdir(os.path.join(self.nims_path, pyramid_ds.relpath))
+                pyramid_ds.sync_files(self.nims_path)
                 transaction.commit()
 
         DBSession.add(self.job)
@@ -262,7 +261,9 @@ class PFilePipeline(Pipeline):
             if pf is not None:
                 criteria = pf.prep_convert()
                 if criteria != None:
-                    q = Epoch.query.filter(Epoch.session==self.job.data_container.session)
+                    q = (Epoch.query
+                            .filter(Epoch.session==self.job.data_container.session)
+                            .options(sqlalchemy.orm.subqueryload_all(Epoch.datasets, Dataset.files)))
                     for fieldname,value in criteria.iteritems():
                         q = q.filter(getattr(Epoch,fieldname)==unicode(value))
                     epochs = [e for e in q.all() if e!=self.job.data_container]
@@ -283,11 +284,9 @@ class PFilePipeline(Pipeline):
                 DBSession.add(self.job.data_container)
                 dataset.kind = u'derived'
                 dataset.container = self.job.data_container
-                filenames = []
                 for f in outputdir_list:
-                    filenames.append(f)
                     shutil.copy2(os.path.join(outputdir, f), os.path.join(self.nims_path, dataset.relpath))
-                dataset.filenames = filenames
+                dataset.sync_files(self.nims_path)
                 transaction.commit()
 
                 pyramid_ds = Dataset.at_path(self.nims_path, u'img_pyr')
@@ -299,7 +298,7 @@ class PFilePipeline(Pipeline):
                 log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
                 pyramid_ds.kind = u'web'
                 pyramid_ds.container = self.job.data_container
-                pyramid_ds.filenames = os.listdir(os.path.join(self.nims_path, pyramid_ds.relpath))
+                pyramid_ds.sync_files(self.nims_path)
                 transaction.commit()
 
         DBSession.add(self.job)
@@ -0,0 +1,89 @@
+"""
+ReaperState persists what the DICOM reaper knows in an sqlite database: the exams it monitors, their series with image
+counts and reap status, and the reference datetime from which it queries the scanner.
+
+Exams are identified by their StudyID and datetime, series by their SeriesInstanceUID. All methods may be called from
+any thread.
+"""
+
+import sqlite3
+import datetime
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exam (
+    id TEXT NOT NULL,
+    datetime TEXT NOT NULL,
+    uid TEXT,
+    pat_id TEXT,
+    retired INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (id, datetime));
+CREATE TABLE IF NOT EXISTS series (
+    uid TEXT PRIMARY KEY,
+    exam_id TEXT NOT NULL,
+    exam_datetime TEXT NOT NULL,
+    id TEXT,
+    image_count INTEGER NOT NULL,
+    reaped INTEGER NOT NULL DEFAULT 0,
+    reap_path TEXT);
+CREATE INDEX IF NOT EXISTS series_exam ON series (exam_id, exam_datetime);
+CREATE TABLE IF NOT EXISTS reference (
+    key TEXT PRIMARY KEY,
+    value TEXT);
+"""
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class ReaperState(object):
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            with self.db:   # commits, or rolls back on error
+                return self.db.execute(sql, params).fetchall()
+
+    def get_reference_datetime(self):
+        rows = self.execute('SELECT value FROM reference WHERE key = ?', ('datetime',))
+        return datetime.datetime.strptime(rows[0][0], DATETIME_FORMAT) if rows else None
+
+    def set_reference_datetime(self, datetime_):
+        self.execute('INSERT OR REPLACE INTO reference (key, value) VALUES (?, ?)', ('datetime', datetime_.strftime(DATETIME_FORMAT)))
+
+    def exams(self):
+        """Return (id, datetime, uid, pat_id) of the exams not yet retired, oldest first."""
+        rows = self.execute('SELECT id, datetime, uid, pat_id FROM exam WHERE retired = 0 ORDER BY datetime')
+        return [(id_, datetime.datetime.strptime(dt, DATETIME_FORMAT), uid, pat_id) for id_, dt, uid, pat_id in rows]
+
+    def is_retired(self, exam_id, exam_datetime):
+        return bool(self.execute('SELECT 1 FROM exam WHERE id = ? AND datetime = ? AND retired = 1',
+                (exam_id, exam_datetime.strftime(DATETIME_FORMAT))))
+
+    def add_exam(self, exam_id, exam_datetime, uid, pat_id):
+        self.execute('INSERT OR IGNORE INTO exam (id, datetime, uid, pat_id) VALUES (?, ?, ?, ?)',
+                (exam_id, exam_datetime.strftime(DATETIME_FORMAT), uid, pat_id))
+
+    def retire_exam(self, exam_id, exam_datetime):
+        """Mark an exam as done, and forget its series."""
+        dt = exam_datetime.strftime(DATETIME_FORMAT)
+        with self.lock:
+            with self.db:
+                self.db.execute('UPDATE exam SET retired = 1 WHERE id = ? AND datetime = ?', (exam_id, dt))
+                self.db.execute('DELETE FROM series WHERE exam_id = ? AND exam_datetime = ?', (exam_id, dt))
+
+    def series(self, exam_id, exam_datetime):
+        """Return (id, uid, image_count, reaped, reap_path) of the series of an exam."""
+        return self.execute('SELECT id, uid, image_count, reaped, reap_path FROM series WHERE exam_id = ? AND exam_datetime = ?',
+                (exam_id, exam_datetime.strftime(DATETIME_FORMAT)))
+
+    def save_series(self, exam_id, exam_datetime, series_id, uid, image_count, reaped, reap_path):
+        self.execute('INSERT OR REPLACE INTO series (uid, exam_id, exam_datetime, id, image_count, reaped, reap_path) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (uid, exam_id, exam_datetime.strftime(DATETIME_FORMAT), series_id, image_count, int(reaped), reap_path))
+
+    def reap_paths(self):
+        """Return the reap directories of partially retrieved series."""
+        return set(row[0] for row in self.execute('SELECT reap_path FROM series WHERE reap_path IS NOT NULL'))
@@ -3,13 +3,17 @@
 # @author:  Gunnar Schaefer
 
 import os
+import glob
 import time
 import shlex
 import shutil
 import signal
 import logging
 import argparse
+import datetime
+import tempfile
 import subprocess
+import multiprocessing.pool
 
 import nimsutil
 
@@ -17,53 +21,129 @@ log = logging.getLogger('restager')
 
 
 class Restager(object):
-    def __init__(self, source_stage, data_host, reap_stage, sort_stage, sleep_time):
+
+    """
+    Ship items from the source stage into the sort stage of a data host, in batches.
+
+    Each batch of up to batch_size items, oldest first, is split into up to `streams` parts, which are transferred in
+    parallel by rsync, each driven by a manifest of item names, into directories in the remote reap stage. The whole
+    batch is then moved into the remote sort stage with a single ssh command. Without a data_host, reap_stage and
+    sort_stage are local paths, and items are copied and renamed locally.
+    """
+
+    def __init__(self, source_stage, data_host, reap_stage, sort_stage, sleep_time, batch_size=100, streams=4):
         super(Restager, self).__init__()
         self.source_stage = source_stage
+        self.data_host = data_host
+        self.reap_stage = reap_stage
+        self.sort_stage = sort_stage
         self.sleep_time = sleep_time
+        self.batch_size = batch_size
+        self.streams = streams
         self.alive = True
 
-        self.scp_cmd = 'rsync -a %%s %s:%s' % (data_host, reap_stage)
-        self.move_cmd = 'ssh %s \'mv %s/%%s %s\'' % (data_host, reap_stage, sort_stage)
         self.setup_cmd = 'ssh %s \'mkdir -p %s %s; rm -rf %s/*\'' % (data_host, reap_stage, sort_stage, reap_stage)
+        self.move_cmd = 'ssh %s \'mv %s/%%s_*/* %s && rmdir %s/%%s_*\'' % (data_host, reap_stage, sort_stage, reap_stage)
+        self.discard_cmd = 'ssh %s \'rm -rf %s/%%s_*\'' % (data_host, reap_stage)
 
     def halt(self):
         self.alive = False
 
     def run(self):
         try:
-            subprocess.check_call(shlex.split(self.setup_cmd))
-        except subprocess.CalledProcessError:
+            self.setup()
+        except (subprocess.CalledProcessError, EnvironmentError):
             self.alive = False
             log.error('Cannot set up remote staging area')
 
+        pool = multiprocessing.pool.ThreadPool(self.streams)
         while self.alive:
-            stage_contents = [os.path.join(self.source_stage, sc) for sc in os.listdir(self.source_stage)]
-            if stage_contents:
-                item_path = min(stage_contents, key=os.path.getmtime)
-                try:
-                    log.info('Restaging %s' % os.path.basename(item_path))
-                    subprocess.check_call(shlex.split(self.scp_cmd % item_path))
-                    subprocess.check_call(shlex.split(self.move_cmd % os.path.basename(item_path)))
-                except subprocess.CalledProcessError:
-                    log.info('Failed to restage %s' % os.path.basename(item_path))
-                else:
-                    if os.path.isdir(item_path):
-                        shutil.rmtree(item_path)
-                    else:
-                        os.remove(item_path)
-                    log.info('Restaged  %s' % os.path.basename(item_path))
+            item_paths = self.pending_items()
+            if item_paths:
+                if not self.restage(item_paths[:self.batch_size], pool):
+                    time.sleep(self.sleep_time)
             else:
                 log.debug('Waiting for work...')
                 time.sleep(self.sleep_time)
+        pool.close()
+
+    def setup(self):
+        if self.data_host:
+            subprocess.check_call(shlex.split(self.setup_cmd))
+        else:
+            nimsutil.make_joined_path(self.sort_stage)
+            shutil.rmtree(self.reap_stage, ignore_errors=True)
+            nimsutil.make_joined_path(self.reap_stage)
+
+    def pending_items(self):
+        """Return the paths of the items in the source stage, oldest first, skipping any still being handed off."""
+        stage_contents = [os.path.join(self.source_stage, sc) for sc in os.listdir(self.source_stage) if not sc.startswith('.')]
+        return sorted(stage_contents, key=os.path.getmtime)
+
+    def restage(self, item_paths, pool):
+        """Restage one batch of items, and delete them from the source stage once they are in place."""
+        batch_id = 'restage_%s' % datetime.datetime.now().strftime('%s.%f')
+        streams = min(self.streams, len(item_paths))
+        parts = [(item_paths[i::streams], '%s_%d' % (batch_id, i)) for i in range(streams)]
+        log.info('Restaging %d items in %d streams, %s...' % (len(item_paths), streams, os.path.basename(item_paths[0])))
+        try:
+            pool.map(self.transfer, parts)
+            self.move_into_place(batch_id)
+        except (subprocess.CalledProcessError, EnvironmentError, shutil.Error) as e:
+            log.warning('Failed to restage %d items, %s... (%s)' % (len(item_paths), os.path.basename(item_paths[0]), e))
+            self.discard(batch_id)
+            return False
+        for item_path in item_paths:
+            if os.path.isdir(item_path):
+                shutil.rmtree(item_path)
+            else:
+                os.remove(item_path)
+        log.info('Restaged  %d items, %s...' % (len(item_paths), os.path.basename(item_paths[0])))
+        return True
+
+    def transfer(self, part):
+        """Transfer some items into a new directory in the reap stage."""
+        item_paths, dirname = part
+        if self.data_host:
+            with tempfile.NamedTemporaryFile() as manifest:
+                manifest.writelines(os.path.basename(ip) + '\n' for ip in item_paths)
+                manifest.flush()
+                subprocess.check_call(['rsync', '-a', '-r', '--files-from=%s' % manifest.name, self.source_stage + '/',
+                        '%s:%s/' % (self.data_host, os.path.join(self.reap_stage, dirname))])
+        else:
+            dest_path = nimsutil.make_joined_path(self.reap_stage, dirname)
+            for item_path in item_paths:
+                if os.path.isdir(item_path):
+                    shutil.copytree(item_path, os.path.join(dest_path, os.path.basename(item_path)))
+                else:
+                    shutil.copy2(item_path, dest_path)
+
+    def move_into_place(self, batch_id):
+        """Move all items of a batch from the reap stage into the sort stage."""
+        if self.data_host:
+            subprocess.check_call(shlex.split(self.move_cmd % (batch_id, batch_id)))
+        else:
+            for dir_path in glob.glob(os.path.join(self.reap_stage, batch_id + '_*')):
+                for item in os.listdir(dir_path):
+                    os.rename(os.path.join(dir_path, item), os.path.join(self.sort_stage, item))
+                os.rmdir(dir_path)
+
+    def discard(self, batch_id):
+        if self.data_host:
+            subprocess.call(shlex.split(self.discard_cmd % batch_id))
+        else:
+            for dir_path in glob.glob(os.path.join(self.reap_stage, batch_id + '_*')):
+                shutil.rmtree(dir_path)
 
 
 class ArgumentParser(argparse.ArgumentParser):
     def __init__(self):
         super(ArgumentParser, self).__init__()
         self.add_argument('source_stage', help='path to source staging area')
-        self.add_argument('data_host', help='username@hostname of data destination')
+        self.add_argument('data_host', help='username@hostname of data destination (empty for a local destination)')
         self.add_argument('remote_stage', help='path to destination staging area')
+        self.add_argument('-b', '--batchsize', type=int, default=100, help='maximum number of items per transfer (default: 100)')
+        self.add_argument('-j', '--streams', type=int, default=4, help='number of parallel transfer streams (default: 4)')
         self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to sleep before checking for new data')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
@@ -75,10 +155,10 @@ if __name__ == "__main__":
 
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
     source_stage = nimsutil.make_joined_path(args.source_stage, 'sort')
-    reap_stage = nimsutil.make_joined_path(args.remote_stage, 'reap')
-    sort_stage = nimsutil.make_joined_path(args.remote_stage, 'sort')
+    reap_stage = os.path.join(args.remote_stage, 'reap')
+    sort_stage = os.path.join(args.remote_stage, 'sort')
 
-    restager = Restager(source_stage, args.data_host, reap_stage, sort_stage, args.sleeptime)
+    restager = Restager(source_stage, args.data_host, reap_stage, sort_stage, args.sleeptime, args.batchsize, args.streams)
 
     def term_handler(signum, stack):
         restager.halt()
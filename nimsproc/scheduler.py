@@ -23,11 +23,13 @@ log = logging.getLogger('scheduler')
 
 class Scheduler(object):
 
-    def __init__(self, db_uri, nims_path, sleeptime, cooltime):
+    def __init__(self, db_uri, nims_path, sleeptime, cooltime, archive_age=30):
         super(Scheduler, self).__init__()
         self.nims_path = nims_path
         self.sleeptime = sleeptime
         self.cooltime = datetime.timedelta(seconds=cooltime)
+        self.archive_age = datetime.timedelta(days=archive_age)
+        self.next_archive_time = 0
 
         self.alive = True
         init_model(sqlalchemy.create_engine(db_uri))
@@ -38,8 +40,13 @@ class Scheduler(object):
 
     def run(self):
         while self.alive:
+            # keep the job queue small
+            if self.archive_age and time.time() > self.next_archive_time:
+                self.archive_jobs()
+
             # relaunch jobs that need rerun
-            for job in Job.query.filter((Job.status != u'running') & (Job.status != u'abandoned') & (Job.needs_rerun == True)).all():
+            job_rows = Job.query_with_containers().filter((Job.status != u'running') & (Job.status != u'abandoned') & (Job.needs_rerun == True)).all()
+            for job in [row.Job for row in job_rows]:
                 job.status = u'pending'
                 job.activity = u'reset to pending'
                 log.info(u'Reset       %s to pending' % job)
@@ -70,13 +77,13 @@ class Scheduler(object):
                         with tarfile.open('%s.tgz' % arcdir_path, 'w:gz', compresslevel=6) as archive:
                             archive.add(arcdir_path, arcname=os.path.basename(arcdir_path))
                         shutil.rmtree(arcdir_path)
-                        ds.filenames = os.listdir(dataset_path)
+                        ds.sync_files(self.nims_path)
                         ds.compressed = True
                         transaction.commit()
                     elif ds.filetype == nimsdata.nimsraw.NIMSPFile.filetype:
                         for pfilepath in [os.path.join(dataset_path, f) for f in os.listdir(dataset_path) if not f.startswith('_')]:
                             nimsutil.gzip_inplace(pfilepath, 0o644)
-                        ds.filenames = os.listdir(dataset_path)
+                        ds.sync_files(self.nims_path)
                         ds.compressed = True
                         transaction.commit()
                     DBSession.add(dc)
@@ -99,6 +106,20 @@ class Scheduler(object):
             else:
                 time.sleep(self.sleeptime)
 
+    def archive_jobs(self):
+        """Move jobs done or abandoned more than archive_age ago into the job history, and do so again in an hour."""
+        before = datetime.datetime.now() - self.archive_age
+        archived_cnt = 0
+        while self.alive:
+            batch_cnt = Job.archive(before)
+            transaction.commit()
+            if not batch_cnt:
+                break
+            archived_cnt += batch_cnt
+        if archived_cnt:
+            log.info('Archived    %d jobs' % archived_cnt)
+        self.next_archive_time = time.time() + 3600
+
     def reset_all(self):
         """Reset all scheduling data containers to dirty."""
         for dc in DataContainer.query.filter_by(scheduling=True).all():
@@ -116,6 +137,7 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('nims_path', help='data location')
         self.add_argument('-s', '--sleeptime', type=int, default=10, help='time to sleep between db queries')
         self.add_argument('-c', '--cooltime', type=int, default=30, help='time to let data cool before processing')
+        self.add_argument('-a', '--archiveage', type=int, default=30, help='days after which finished jobs are archived (0: never)')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
@@ -124,7 +146,7 @@ class ArgumentParser(argparse.ArgumentParser):
 if __name__ == '__main__':
     args = ArgumentParser().parse_args()
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
-    scheduler = Scheduler(args.db_uri, args.nims_path, args.sleeptime, args.cooltime)
+    scheduler = Scheduler(args.db_uri, args.nims_path, args.sleeptime, args.cooltime, args.archiveage)
 
     def term_handler(signum, stack):
         scheduler.halt()
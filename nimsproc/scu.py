@@ -5,7 +5,8 @@
 SCU is a module that wraps the findscu and movescu commands, which are part of DCMTK.
 
 Usage involves the instantiation of an SCU object, which maintains knowledge of the caller and callee (data requester
-and data source, respectively).
+and data source, respectively). NativeSCU provides the same interface without DCMTK, speaking DICOM itself over a
+persistent association.
 
 Specific Query objects are constructed (e.g., SeriesQuery, if you intend to search for or move a series) and passed to
 the find() or move() methods of an SCU object.
@@ -13,9 +14,12 @@ the find() or move() methods of an SCU object.
 
 import re
 import shlex
+import socket
 import logging
 import subprocess
 
+import dimse
+
 log = logging.getLogger('dicomreaper.scu')
 
 RESPONSE_RE = re.compile("""
@@ -25,6 +29,13 @@ W: # Used TransferSyntax: (?P<transfer_syntax>.+)
 DICOM_CV_RE = re.compile(""".*\((?P<idx_0>[0-9a-f]{4}),(?P<idx_1>[0-9a-f]{4})\) (?P<type>\w{2}) (?P<value>.+)#[ ]*(?P<length>\d+),[ ]*(?P<n_elems>\d+) (?P<label>\w+)\n""")
 MOVE_OUTPUT_RE = re.compile('.*Completed Suboperations +: ([a-zA-Z0-9]+)', re.DOTALL)
 
+# keys returned by NativeSCU.find() in addition to those queried for, as requested from the scanner by default
+RETURN_KEYS = {
+        'STUDY': ['StudyDate', 'StudyTime', 'StudyID', 'PatientID', 'StudyInstanceUID'],
+        'SERIES': ['SeriesNumber', 'SeriesInstanceUID', 'ImagesInAcquisition'],
+        'IMAGE': ['SOPInstanceUID', 'InstanceNumber', 'AcquisitionNumber'],
+        }
+
 
 class SCU(object):
 
@@ -32,15 +43,17 @@ class SCU(object):
     SCU stores information required to communicate with the scanner during calls to find() and move().
 
     Instantiated with the host, port, and aet of the scanner, as well as the aec of the calling machine. Incoming port
-    is optional (default=port).
+    is optional (default=port). The move destination AE title defaults to the calling AE title; the scanner must map it
+    to the return port.
     """
 
-    def __init__(self, host, port, return_port, aet, aec):
+    def __init__(self, host, port, return_port, aet, aec, move_aet=None):
         self.host = host
         self.port = port
         self.return_port = return_port
         self.aet = aet
         self.aec = aec
+        self.move_aet = move_aet or aet
 
     def find(self, query):
         """ Construct a findscu query. Return a list of Response objects. """
@@ -53,13 +66,18 @@ class SCU(object):
             log.debug(ex)
             output and log.debug(output)
         if output and re.search('DIMSE Status .* Success', output):
-            return [Response(match_obj.groupdict()) for match_obj in RESPONSE_RE.finditer(output)]
+            return [Response(match_obj.group('transfer_syntax'), [DicomCV(cv_match.groupdict()) for cv_match in DICOM_CV_RE.finditer(match_obj.group('dicom_cvs'))])
+                    for match_obj in RESPONSE_RE.finditer(output)]
         else:
             return []
 
-    def move(self, query, dest_path='.'):
-        """Construct a movescu query. Return the count of images successfully transferred."""
-        cmd = 'movescu --verbose -od %s +P %s %s' % (dest_path, self.return_port, self.query_string(query))
+    def move(self, query, dest_path='.', sink=None):
+        """
+        Construct a movescu query. Return the count of images successfully transferred.
+
+        movescu always writes the images into dest_path; sink is only supported by NativeSCU.
+        """
+        cmd = 'movescu --verbose -od %s +P %s -aem %s %s' % (dest_path, self.return_port, self.move_aet, self.query_string(query))
         log.debug(cmd)
         output = ''
         try:
@@ -77,6 +95,84 @@ class SCU(object):
         """Convert a query into a string to be appended to a findscu or movescu call."""
         return '-S -aet %s -aec %s %s %s %s' % (self.aet, self.aec, query, self.host, str(self.port))
 
+    def close(self):
+        pass
+
+
+class NativeSCU(SCU):
+
+    """
+    SCU that speaks DICOM itself, rather than running DCMTK commands.
+
+    The association with the scanner is kept open between calls and is re-established if the scanner has dropped it.
+    Images moved by the scanner are received by a storage SCP, which listens on the return port for the lifetime of the
+    NativeSCU.
+    """
+
+    def __init__(self, host, port, return_port, aet, aec, move_aet=None, timeout=300):
+        super(NativeSCU, self).__init__(host, port, return_port, aet, aec, move_aet)
+        self.timeout = timeout
+        self.association = None
+        self.storage_scp = None
+
+    def find(self, query):
+        """Send a C-FIND request. Return a list of Response objects, or an empty list if the query failed."""
+        identifier = dict((key, None) for key in RETURN_KEYS.get(query.retrieve_level, []))
+        identifier.update(query.kwargs, QueryRetrieveLevel=query.retrieve_level)
+        result = self.request(lambda assoc: assoc.c_find(dimse.STUDY_ROOT_FIND, dimse.encode_data_set(identifier)))
+        if result is None or result[0] != dimse.SUCCESS:
+            log.debug('C-FIND %r failed: %s' % (query, result and '0x%04X' % result[0]))
+            return []
+        return [Response.from_data_set(data) for data in result[1]]
+
+    def move(self, query, dest_path='.', sink=None):
+        """
+        Send a C-MOVE request, receiving the images into dest_path. Return the count of images transferred.
+
+        If sink is given, it is called with the file name and contents of each image as it arrives, instead.
+        """
+        if not self.storage_scp:
+            try:
+                self.storage_scp = dimse.StorageSCP(self.return_port, dest_path, self.move_aet, timeout=self.timeout).start()
+            except socket.error as ex:
+                log.warning('Cannot listen on return port %s: %s' % (self.return_port, ex))
+                return 0
+        self.storage_scp.dest_path = dest_path
+        self.storage_scp.sink = sink
+        identifier = dict(query.kwargs, QueryRetrieveLevel=query.retrieve_level)
+        result = self.request(lambda assoc: assoc.c_move(dimse.STUDY_ROOT_MOVE, dimse.encode_data_set(identifier), self.move_aet))
+        if result is None:
+            return 0
+        status, completed, failed, warning = result
+        log.debug('C-MOVE %r: status 0x%04X, %d completed, %d failed, %d warning' % (query, status, completed, failed, warning))
+        return completed
+
+    def request(self, operation):
+        """Run operation on the association, establishing it first if needed. Return None on failure."""
+        for attempt in range(2):
+            if self.association and not self.association.is_idle():
+                self.association.close()
+                self.association = None
+            try:
+                if not self.association:
+                    self.association = dimse.Association.request(self.host, self.port, self.aet, self.aec,
+                            [dimse.VERIFICATION, dimse.STUDY_ROOT_FIND, dimse.STUDY_ROOT_MOVE], timeout=self.timeout)
+                return operation(self.association)
+            except (socket.error, dimse.DIMSEError) as ex:
+                log.debug('%s (attempt %d)' % (ex, attempt + 1))
+                if self.association:
+                    self.association.abort()
+                    self.association = None
+        return None
+
+    def close(self):
+        if self.association:
+            self.association.release()
+            self.association = None
+        if self.storage_scp:
+            self.storage_scp.stop()
+            self.storage_scp = None
+
 
 class Query(object):
 
@@ -134,13 +230,21 @@ class Response(dict):
     completion of dictionary elements as members.
     """
 
-    def __init__(self, response_dict):
+    def __init__(self, transfer_syntax, dicom_cv_list):
         dict.__init__(self)
-        self.transfer_syntax = response_dict['transfer_syntax']
-        self.dicom_cv_list = [DicomCV(match_obj.groupdict()) for match_obj in DICOM_CV_RE.finditer(response_dict['dicom_cvs'])]
+        self.transfer_syntax = transfer_syntax
+        self.dicom_cv_list = dicom_cv_list
         for cv in self.dicom_cv_list:
             self[cv.label] = cv.value
 
+    @classmethod
+    def from_data_set(cls, data, transfer_syntax=dimse.IMPLICIT_VR_LITTLE_ENDIAN):
+        """Construct a Response from an encoded C-FIND response identifier."""
+        cvs = [DicomCV({'idx_0': '%04x' % (tag >> 16), 'idx_1': '%04x' % (tag & 0xFFFF), 'type': vr, 'value': value,
+                'length': str(len(value)), 'n_elems': '1', 'label': keyword})
+                for tag, vr, keyword, value in dimse.decode_data_set(data, transfer_syntax)]
+        return cls(transfer_syntax, cvs)
+
     def __dir__(self):
         """Return list of dictionary elements for tab completion in utilities like iPython."""
         return [k for (k, v) in self.items()]
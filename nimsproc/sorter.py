@@ -7,9 +7,11 @@ import os
 import time
 import shutil
 import signal
+import filecmp
 import logging
 import argparse
 import datetime
+import multiprocessing
 
 import sqlalchemy
 import transaction
@@ -21,9 +23,63 @@ from nimsgears import model
 log = logging.getLogger('sorter')
 
 
+def instance_digests(filepath, mrfile):
+    """Return (packed uid, digest) pairs for the instances in a file, keyed by SOPInstanceUID or PFile series uid."""
+    if mrfile.filetype == nimsdata.nimsdicom.NIMSDicom.filetype:
+        return [(str(nimsutil.pack_dicom_uid(uid)) if uid else digest, digest) for uid, digest in nimsutil.dicomutil.instance_digests(filepath)]
+    else:
+        manifest = nimsutil.read_manifest(os.path.dirname(filepath))    # digest recorded by the reaper, if any
+        digest = manifest[os.path.basename(filepath)][0] if os.path.basename(filepath) in manifest else nimsutil.file_digest(filepath)
+        return [(str(nimsutil.pack_dicom_uid(mrfile.series_uid)), digest)]
+
+
+def split_aux_files(dirpath, filenames):
+    """Return the main files in a directory, and a dict of the paths of the auxiliary files that belong to each."""
+    filenames = [fn for fn in filenames if fn != nimsutil.MANIFEST_FILENAME]
+    aux_paths = {}
+    for aux_file in filter(lambda fn: fn.startswith('_'), filenames):
+        main_file = aux_file.lstrip('_').rpartition('_')[0]
+        aux_paths[main_file] = aux_paths.get(main_file, []) + [os.path.join(dirpath, aux_file)]
+    return filter(lambda fn: not fn.startswith('_'), filenames), aux_paths
+
+
+def inspect_file(filepath):
+    """Return the key of the dataset that a file belongs to and its instance digests, or None if unparsable."""
+    try:
+        mrfile = nimsdata.parse(filepath)
+    except nimsdata.NIMSDataError:
+        return filepath, None, None
+    else:
+        return filepath, (mrfile.series_uid, mrfile.acq_no, mrfile.filetype), instance_digests(filepath, mrfile)
+
+
+def place_files(dataset_path, filepaths):
+    """
+    Return {filepath: name in dataset_path} for files about to be added to a dataset, or None if one cannot be placed.
+
+    Files never replace one another: a taken name gets a number before its conventional suffix, so that, e.g., a
+    follow-up archive of an acquisition is kept next to the first one. A name taken by identical content is reused.
+    PFiles and auxiliary files cannot be renamed without breaking how they are found, and cannot be placed if taken.
+    """
+    names = {}
+    for filepath in filepaths:
+        filename = name = os.path.basename(filepath)
+        i = 0
+        while name and (name in names.values() or os.path.exists(os.path.join(dataset_path, name))):
+            if name not in names.values() and filecmp.cmp(filepath, os.path.join(dataset_path, name), shallow=False):
+                break
+            i += 1
+            name = nimsutil.numbered_filename(filename, i)
+        if not name:
+            log.error('%s is taken in %s by different content' % (filename, dataset_path))
+            return None
+        names[filepath] = name
+    return names
+
+
 class Sorter(object):
 
-    def __init__(self, db_uri, sort_path, preserve_path, nims_path, dir_mode, sleep_time):
+    def __init__(self, db_uri, sort_path, preserve_path, nims_path, dir_mode, sleep_time, jobs=1):
         super(Sorter, self).__init__()
         self.sort_path = nimsutil.make_joined_path(sort_path)
         self.preserve_path = nimsutil.make_joined_path(preserve_path) if preserve_path else None
@@ -31,6 +87,7 @@ class Sorter(object):
         self.dir_mode = dir_mode
         self.sleep_time = sleep_time
         self.alive = True
+        self.pool = multiprocessing.Pool(jobs) if jobs > 1 else None   # fork before the db engine exists
         model.init_model(sqlalchemy.create_engine(db_uri))
 
     def halt(self):
@@ -45,42 +102,110 @@ class Sorter(object):
                 sort_path = min(stage_contents, key=os.path.getmtime)   # oldest first
                 log.info('Sorting %s' % os.path.basename(sort_path))
                 for dirpath, dirnames, filenames in os.walk(sort_path, topdown=False):
-                    aux_paths = {}
-                    for aux_file in filter(lambda fn: fn.startswith('_'), filenames):
-                        main_file = aux_file.lstrip('_').rpartition('_')[0]
-                        aux_paths[main_file] = aux_paths.get(main_file, []) + [os.path.join(dirpath, aux_file)]
-                    filenames = filter(lambda fn: not fn.startswith('_'), filenames)
+                    filenames, aux_paths = split_aux_files(dirpath, filenames)
                     if self.dir_mode and filenames and not dirnames:    # at lowest sub-directory
                         self.sort_directory(dirpath, filenames, aux_paths)
+                    elif self.pool:
+                        self.sort_file_groups(dirpath, filenames, aux_paths)
                     else:
                         self.sort_files(dirpath, filenames, aux_paths)
                 log.info('Sorted  %s' % os.path.basename(sort_path))
             else:
                 log.debug('Waiting for work...')
                 time.sleep(self.sleep_time)
+        if self.pool:
+            self.pool.terminate()
+
+    def preserve_file(self, filepath):
+        if self.preserve_path:
+            preserve_path = nimsutil.make_joined_path(self.preserve_path, os.path.dirname(os.path.relpath(filepath, self.sort_path)))
+            shutil.move(filepath, os.path.join(preserve_path, os.path.basename(filepath)))
+
+    def move_files(self, filepaths, dataset, manifest):
+        """Move files into the directory of a dataset and record them; return False if they were preserved instead."""
+        dataset_path = os.path.join(self.nims_path, dataset.relpath)
+        names = place_files(dataset_path, filepaths)
+        if names is None:
+            for filepath in filepaths:
+                self.preserve_file(filepath)
+            return False
+        for filepath in filepaths:
+            shutil.move(filepath, os.path.join(dataset_path, names[filepath]))
+        digests = dict((names[fp], manifest[os.path.basename(fp)]) for fp in filepaths if os.path.basename(fp) in manifest)
+        dataset.add_files(self.nims_path, [names[fp] for fp in filepaths], digests)
+        return True
 
     def sort_files(self, dirpath, filenames, aux_paths):
+        manifest = nimsutil.read_manifest(dirpath)
         for filepath, filename in [(os.path.join(dirpath, fn), fn) for fn in filenames]:
             log.debug('Sorting %s' % filename)
             try:
                 mrfile = nimsdata.parse(filepath)
             except nimsdata.NIMSDataError:
-                if self.preserve_path:
-                    preserve_path = nimsutil.make_joined_path(self.preserve_path, os.path.dirname(os.path.relpath(filepath, self.sort_path)))
-                    shutil.move(filepath, os.path.join(preserve_path, filename))
+                self.preserve_file(filepath)
             else:
                 dataset = model.Dataset.from_mrfile(mrfile, self.nims_path)
-                new_filenames = [filename]
-                shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, filename))
-                for aux_path in aux_paths.get(os.path.splitext(filename)[0] if dataset.compressed else filename, []):
-                    new_filenames.append(os.path.basename(aux_path))
-                    shutil.move(aux_path, os.path.join(self.nims_path, dataset.relpath, os.path.basename(aux_path)))
-                dataset.filenames = set(dataset.filenames + new_filenames)
+                if not dataset.add_instances(instance_digests(filepath, mrfile)):
+                    log.info('Dropping duplicate %s' % filename)
+                    transaction.commit()
+                    continue
+                filepaths = [filepath] + aux_paths.get(os.path.splitext(filename)[0] if dataset.compressed else filename, [])
+                if not self.move_files(filepaths, dataset, manifest):
+                    transaction.abort()
+                    continue
                 dataset.updatetime = datetime.datetime.now()
-                dataset.untrash()
+                if dataset.is_trash or dataset.container.is_trash:
+                    dataset.untrash()
                 transaction.commit()
         shutil.rmtree(dirpath)
 
+    def sort_file_groups(self, dirpath, filenames, aux_paths):
+        """
+        Sort files in bulk, one dataset at a time.
+
+        Headers are parsed and instances digested in the worker pool, and files are grouped by the dataset they belong
+        to. Each dataset is then resolved once, all of its files with new content are moved, and the database is
+        updated with a single commit.
+        """
+        manifest = nimsutil.read_manifest(dirpath)
+        file_groups = {}
+        file_instances = {}
+        filepaths = [os.path.join(dirpath, fn) for fn in filenames]
+        for filepath, dataset_key, instances in self.pool.imap_unordered(inspect_file, filepaths, chunksize=16):
+            if dataset_key:
+                file_groups.setdefault(dataset_key, []).append(filepath)
+                file_instances[filepath] = instances
+            else:
+                self.preserve_file(filepath)
+        for group_paths in file_groups.itervalues():
+            log.debug('Sorting %s and %d more' % (os.path.basename(group_paths[0]), len(group_paths) - 1))
+            try:
+                mrfile = nimsdata.parse(group_paths[0])
+            except nimsdata.NIMSDataError:
+                for filepath in group_paths:
+                    self.preserve_file(filepath)
+                continue
+            dataset = model.Dataset.from_mrfile(mrfile, self.nims_path)
+            new_uids = dataset.add_instances([i for fp in group_paths for i in file_instances[fp]])
+            new_paths = [fp for fp in group_paths if any(uid in new_uids for uid, digest in file_instances[fp])]
+            if len(new_paths) < len(group_paths):
+                log.info('Dropping %d duplicates for %s' % (len(group_paths) - len(new_paths), dataset.relpath))
+            if not new_paths:
+                transaction.commit()
+                continue
+            filepaths = []
+            for filepath in new_paths:
+                filename = os.path.basename(filepath)
+                filepaths += [filepath] + aux_paths.get(os.path.splitext(filename)[0] if dataset.compressed else filename, [])
+            if not self.move_files(filepaths, dataset, manifest):
+                transaction.abort()
+                continue
+            dataset.updatetime = datetime.datetime.now()
+            if dataset.is_trash or dataset.container.is_trash:
+                dataset.untrash()
+            transaction.commit()
+        shutil.rmtree(dirpath)
+
     def sort_directory(self, dirpath, filenames, aux_paths):
         log.debug('Sorting %s in directory mode' % os.path.basename(dirpath))
         try:
@@ -92,13 +217,21 @@ class Sorter(object):
                     shutil.move(os.path.join(dirpath, filename), os.path.join(preserve_path, filename))
         else:
             dataset = model.Dataset.from_mrfile(mrfile, self.nims_path)
-            for filepath, aux_paths in [(os.path.join(dirpath, filename), aux_paths.get(filename, [])) for filename in filenames]:
-                shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, os.path.basename(filepath)))
-                for aux_path in aux_paths:
-                    shutil.move(aux_path, os.path.join(self.nims_path, dataset.relpath, os.path.basename(aux_path)))
-            dataset.updatetime = datetime.datetime.now()
-            dataset.untrash()
-            transaction.commit()
+            file_instances = dict((fn, instance_digests(os.path.join(dirpath, fn), mrfile)) for fn in filenames)
+            new_uids = dataset.add_instances([i for instances in file_instances.itervalues() for i in instances])
+            new_filenames = [fn for fn in filenames if any(uid in new_uids for uid, digest in file_instances[fn])]
+            if len(new_filenames) < len(filenames):
+                log.info('Dropping %d duplicates for %s' % (len(filenames) - len(new_filenames), dataset.relpath))
+            filepaths = [fp for fn in new_filenames for fp in [os.path.join(dirpath, fn)] + aux_paths.get(fn, [])]
+            if not filepaths:
+                transaction.commit()
+            elif self.move_files(filepaths, dataset, nimsutil.read_manifest(dirpath)):
+                dataset.updatetime = datetime.datetime.now()
+                if dataset.is_trash or dataset.container.is_trash:
+                    dataset.untrash()
+                transaction.commit()
+            else:
+                transaction.abort()
         shutil.rmtree(dirpath)
 
 
@@ -113,6 +246,7 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('-t', '--toplevel', action='store_true', help='handle toplevel files')
         self.add_argument('-p', '--preserve_path', help='preserve unsortable files here')
         self.add_argument('-s', '--sleeptime', type=int, default=10, help='time to sleep before checking for new files')
+        self.add_argument('-j', '--jobs', type=int, default=1, help='number of processes for parsing headers in bulk (default: 1)')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
@@ -121,7 +255,7 @@ class ArgumentParser(argparse.ArgumentParser):
 if __name__ == '__main__':
     args = ArgumentParser().parse_args()
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
-    sorter = Sorter(args.db_uri, args.sort_path, args.preserve_path, args.nims_path, args.dirmode, args.sleeptime)
+    sorter = Sorter(args.db_uri, args.sort_path, args.preserve_path, args.nims_path, args.dirmode, args.sleeptime, args.jobs)
 
     def term_handler(signum, stack):
         sorter.halt()
@@ -0,0 +1,71 @@
+"""Tests of IncrementalDataSyncer against a local source directory."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import datasyncer
+
+
+class TestIncrementalDataSyncer(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.path, 'data')
+        self.sync_path = os.path.join(self.path, 'sync')
+        self.manifest_path = os.path.join(self.path, 'manifest')
+        for relpath in ['physio_1/ECG.dat', 'physio_1/PPG.dat', 'physio_2/ECG.dat', 'other/notes.txt']:
+            self.write(relpath, relpath)
+        self.syncer = self.new_syncer()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def new_syncer(self, reconcile_time=3600):
+        return datasyncer.IncrementalDataSyncer(None, self.data_path, self.sync_path, 0, self.manifest_path, 'physio_*',
+                reconcile_time, batch_size=2)
+
+    def write(self, relpath, content):
+        filepath = os.path.join(self.data_path, relpath)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, 'w') as fd:
+            fd.write(content)
+
+    def read(self, relpath):
+        with open(os.path.join(self.sync_path, relpath)) as fd:
+            return fd.read()
+
+    def test_initial_sync(self):
+        self.assertEqual(self.syncer.sync(), (3, 0))
+        self.assertEqual(sorted(os.listdir(self.sync_path)), ['physio_1', 'physio_2'])
+        self.assertEqual(self.read('physio_1/PPG.dat'), 'physio_1/PPG.dat')
+
+    def test_only_changes_are_transferred(self):
+        self.syncer.sync()
+        with open(os.path.join(self.sync_path, 'physio_1/ECG.dat'), 'w') as fd:
+            fd.write('left alone')
+        self.write('physio_1/PPG.dat', 'grown since the last sync')
+        self.write('physio_3/ECG.dat', 'new')
+        self.assertEqual(self.syncer.sync(), (2, 0))
+        self.assertEqual(self.read('physio_1/ECG.dat'), 'left alone')
+        self.assertEqual(self.read('physio_1/PPG.dat'), 'grown since the last sync')
+        self.assertEqual(self.read('physio_3/ECG.dat'), 'new')
+
+    def test_manifest_survives_restart(self):
+        self.syncer.sync()
+        self.assertEqual(self.new_syncer().sync(), (0, 0))
+
+    def test_deletions_wait_for_reconciliation(self):
+        self.syncer.sync()
+        os.remove(os.path.join(self.data_path, 'physio_2/ECG.dat'))
+        self.assertEqual(self.syncer.sync(), (0, 0))
+        self.assertTrue(os.path.exists(os.path.join(self.sync_path, 'physio_2/ECG.dat')))
+        self.syncer.reconcile_time = 0
+        self.assertEqual(self.syncer.sync(), (0, 1))
+        self.assertFalse(os.path.exists(os.path.join(self.sync_path, 'physio_2/ECG.dat')))
+
+
+if __name__ == '__main__':
+    unittest.main()
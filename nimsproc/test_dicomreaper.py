@@ -0,0 +1,78 @@
+"""Tests of the DicomReceiver, with images pushed over a local association as the scanner would."""
+
+import os
+import time
+import shutil
+import tarfile
+import tempfile
+import unittest
+import threading
+
+import dimse
+import dicomreaper
+
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+
+
+class TestDicomReceiver(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.sort_stage = os.path.join(self.path, 'sort')
+        self.receiver = dicomreaper.DicomReceiver('NIMS', 0, 'NIMS', None, ['discard'], os.path.join(self.path, 'reap'),
+                self.sort_stage, 60, 0.1)
+        self.thread = threading.Thread(target=self.receiver.run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.receiver.halt()
+        self.thread.join()
+        shutil.rmtree(self.path)
+
+    def push(self, instance_numbers, image_count):
+        association = dimse.Association.request('localhost', self.receiver.scp.server_address[1], 'SCANNER', 'NIMS', [MR_IMAGE_STORAGE])
+        for i in instance_numbers:
+            image = {
+                    'SOPClassUID': MR_IMAGE_STORAGE,
+                    'SOPInstanceUID': '1.2.3.4.2.%d' % i,
+                    'StudyInstanceUID': '1.2.3.4',
+                    'SeriesInstanceUID': '1.2.3.4.2',
+                    'StudyID': '1234',
+                    'PatientID': 'lab/experiment',
+                    'SeriesNumber': '2',
+                    'AcquisitionNumber': '1',
+                    'ImagesInAcquisition': str(image_count),
+                    'InstanceNumber': str(i),
+                    }
+            self.assertEqual(association.c_store(MR_IMAGE_STORAGE, image['SOPInstanceUID'], dimse.encode_data_set(image)), dimse.SUCCESS)
+        association.release()
+
+    def wait_for_hand_offs(self, count):
+        deadline = time.time() + 10
+        while len([item for item in os.listdir(self.sort_stage) if not item.startswith('.')]) < count and time.time() < deadline:
+            time.sleep(0.05)
+
+    def archived_images(self):
+        """Return {archive name: names of the images in it} of everything handed off."""
+        archives = {}
+        for item in os.listdir(self.sort_stage):
+            for filename in os.listdir(os.path.join(self.sort_stage, item)):
+                with tarfile.open(os.path.join(self.sort_stage, item, filename)) as archive:
+                    archives[filename] = sorted(os.path.basename(m.name) for m in archive if m.isfile())
+        return archives
+
+    def test_late_images_are_archived_apart(self):
+        self.push([1, 2], 2)
+        self.wait_for_hand_offs(1)
+        self.push([3], 2)   # arrives after its acquisition was handed off
+        self.receiver.idle_time = 0
+        self.wait_for_hand_offs(2)
+        archives = self.archived_images()
+        self.assertEqual(sorted(archives), ['1234_2_1_2_dicoms.tgz', '1234_2_1_dicoms.tgz'])
+        self.assertEqual(len(archives['1234_2_1_dicoms.tgz']), 2)
+        self.assertEqual(len(archives['1234_2_1_2_dicoms.tgz']), 1)
+        self.assertEqual(len(set(archives['1234_2_1_dicoms.tgz'] + archives['1234_2_1_2_dicoms.tgz'])), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
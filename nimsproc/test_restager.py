@@ -0,0 +1,61 @@
+"""Tests of the batched Restager against a local destination standing in for the data host."""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing.pool
+
+import restager
+
+
+class TestRestager(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source_stage = os.path.join(self.path, 'source')
+        os.mkdir(self.source_stage)
+        for i, item in enumerate(['NIMS_1_1', 'NIMS_1_2', 'NIMS_1_3']):
+            os.mkdir(os.path.join(self.source_stage, item))
+            with open(os.path.join(self.source_stage, item, '1_%d_1_dicoms.tgz' % (i + 1)), 'w') as fd:
+                fd.write(item)
+            os.utime(os.path.join(self.source_stage, item), (time.time() - 10 + i, time.time() - 10 + i))
+        with open(os.path.join(self.source_stage, 'P12345.7.gz'), 'w') as fd:
+            fd.write('pfile')
+        os.mkdir(os.path.join(self.source_stage, '.NIMS_1_4'))     # still being handed off
+        self.reap_stage = os.path.join(self.path, 'dest', 'reap')
+        self.sort_stage = os.path.join(self.path, 'dest', 'sort')
+        self.restager = restager.Restager(self.source_stage, None, self.reap_stage, self.sort_stage, 0, batch_size=3, streams=2)
+        self.restager.setup()
+        self.pool = multiprocessing.pool.ThreadPool(2)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.path)
+
+    def test_pending_items(self):
+        items = [os.path.basename(ip) for ip in self.restager.pending_items()]
+        self.assertEqual(items, ['NIMS_1_1', 'NIMS_1_2', 'NIMS_1_3', 'P12345.7.gz'])
+
+    def test_restage_batch(self):
+        item_paths = self.restager.pending_items()
+        self.assertTrue(self.restager.restage(item_paths[:3], self.pool))
+        self.assertEqual(sorted(os.listdir(self.sort_stage)), ['NIMS_1_1', 'NIMS_1_2', 'NIMS_1_3'])
+        self.assertEqual(os.listdir(os.path.join(self.sort_stage, 'NIMS_1_2')), ['1_2_1_dicoms.tgz'])
+        self.assertEqual(os.listdir(self.reap_stage), [])
+        self.assertEqual(sorted(os.listdir(self.source_stage)), ['.NIMS_1_4', 'P12345.7.gz'])
+        self.assertTrue(self.restager.restage(self.restager.pending_items(), self.pool))
+        self.assertEqual(sorted(os.listdir(self.sort_stage)), ['NIMS_1_1', 'NIMS_1_2', 'NIMS_1_3', 'P12345.7.gz'])
+
+    def test_failed_batch_is_kept(self):
+        item_paths = self.restager.pending_items()
+        shutil.rmtree(item_paths[1])    # vanishes before the transfer
+        self.assertFalse(self.restager.restage(item_paths[:3], self.pool))
+        self.assertEqual(os.listdir(self.sort_stage), [])
+        self.assertEqual(os.listdir(self.reap_stage), [])
+        self.assertEqual(sorted(os.listdir(self.source_stage)), ['.NIMS_1_4', 'NIMS_1_1', 'NIMS_1_3', 'P12345.7.gz'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+"""Tests of NativeSCU against an in-process stand-in for the scanner's query/retrieve SCP."""
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import scu
+import dimse
+import nimsutil
+
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+
+
+class StandInSCP(dimse.SCP):
+
+    """Query/retrieve SCP serving a fixed list of images; C-MOVE destinations are looked up in destinations."""
+
+    def __init__(self, images, destinations):
+        dimse.SCP.__init__(self, 0, 'SCANNER', 'localhost')
+        self.images = images
+        self.destinations = destinations
+        self.connections = []
+
+    def matches(self, identifier):
+        keys = dict((keyword, value) for tag, vr, keyword, value in dimse.decode_data_set(identifier))
+        level = keys.pop('QueryRetrieveLevel')
+        unique_key = {'STUDY': 'StudyInstanceUID', 'SERIES': 'SeriesInstanceUID', 'IMAGE': 'SOPInstanceUID'}[level]
+        matches = {}
+        for image in self.images:
+            if all(not value or image.get(key) in value.split('\\') or (value.endswith('-') and image.get(key) >= value[:-1])
+                    for key, value in keys.iteritems()):
+                matches.setdefault(image[unique_key], []).append(image)
+        return keys, matches
+
+    def on_find(self, association, sop_class, identifier):
+        keys, matches = self.matches(identifier)
+        for images in sorted(matches.itervalues()):
+            response = dict((key, images[0].get(key)) for key in keys)
+            if 'ImagesInAcquisition' in keys:
+                response['ImagesInAcquisition'] = len(images)
+            yield dimse.encode_data_set(response)
+
+    def on_move(self, association, sop_class, identifier, destination):
+        host, port = self.destinations[destination]
+        images = [image for images in self.matches(identifier)[1].itervalues() for image in images]
+        store_association = dimse.Association.request(host, port, 'SCANNER', destination, [MR_IMAGE_STORAGE])
+        completed = sum(store_association.c_store(MR_IMAGE_STORAGE, image['SOPInstanceUID'], dimse.encode_data_set(image)) == dimse.SUCCESS
+                for image in images)
+        store_association.release()
+        return completed, len(images) - completed, 0
+
+
+class CountingHandler(dimse._AssociationHandler):
+
+    def handle(self):
+        self.server.connections.append(self.request)
+        dimse._AssociationHandler.handle(self)
+
+
+class TestNativeSCU(unittest.TestCase):
+
+    def setUp(self):
+        self.images = []
+        for series_no, image_count in [(1, 3), (2, 5)]:
+            for i in range(image_count):
+                self.images.append({
+                        'SOPClassUID': MR_IMAGE_STORAGE,
+                        'SOPInstanceUID': '1.2.3.4.%d.%d' % (series_no, i + 1),
+                        'StudyInstanceUID': '1.2.3.4',
+                        'SeriesInstanceUID': '1.2.3.4.%d' % series_no,
+                        'StudyDate': '20130102',
+                        'StudyTime': '093000',
+                        'StudyID': '1234',
+                        'PatientID': 'lab/experiment',
+                        'SeriesNumber': str(series_no),
+                        'InstanceNumber': str(i + 1),
+                        })
+        self.return_port = self.free_port()
+        self.scp = StandInSCP(self.images, {'NIMS': ('localhost', self.return_port)})
+        self.scp.RequestHandlerClass = CountingHandler
+        self.scp.start()
+        self.scu = scu.NativeSCU('localhost', self.scp.server_address[1], self.return_port, 'NIMS', 'SCANNER', timeout=10)
+        self.dest_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.scu.close()
+        self.scp.stop()
+        shutil.rmtree(self.dest_path)
+
+    def free_port(self):
+        scp = dimse.StorageSCP(0, host='localhost')
+        port = scp.server_address[1]
+        scp.server_close()
+        return port
+
+    def test_find_study(self):
+        responses = self.scu.find(scu.StudyQuery(StudyDate='20130101-'))
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(responses[0].StudyID, '1234')
+        self.assertEqual(responses[0].PatientID, 'lab/experiment')
+        self.assertEqual(responses[0].StudyTime, '093000')
+
+    def test_find_series(self):
+        responses = self.scu.find(scu.SeriesQuery(StudyID='1234'))
+        self.assertEqual(sorted((r.SeriesNumber, int(r.ImagesInAcquisition)) for r in responses), [('1', 3), ('2', 5)])
+
+    def test_find_no_match(self):
+        self.assertEqual(self.scu.find(scu.StudyQuery(StudyDate='20140101-')), [])
+
+    def test_move_series(self):
+        self.assertEqual(self.scu.move(scu.SeriesQuery(SeriesInstanceUID='1.2.3.4.2'), self.dest_path), 5)
+        filenames = sorted(os.listdir(self.dest_path))
+        self.assertEqual(filenames, ['MR.1.2.3.4.2.%d' % i for i in range(1, 6)])
+        with open(os.path.join(self.dest_path, filenames[0]), 'rb') as fd:
+            tags = nimsutil.dicomutil.read_tags(fd, [nimsutil.dicomutil.SOP_INSTANCE_UID])
+        self.assertEqual(tags[nimsutil.dicomutil.SOP_INSTANCE_UID], '1.2.3.4.2.1')
+
+    def test_move_instances(self):
+        query = scu.ImageQuery(SeriesInstanceUID='1.2.3.4.2', SOPInstanceUID='1.2.3.4.2.2\\1.2.3.4.2.4')
+        self.assertEqual(self.scu.move(query, self.dest_path), 2)
+        self.assertEqual(sorted(os.listdir(self.dest_path)), ['MR.1.2.3.4.2.2', 'MR.1.2.3.4.2.4'])
+
+    def test_association_is_reused(self):
+        for i in range(3):
+            self.scu.find(scu.StudyQuery(StudyDate='20130101-'))
+        self.scu.move(scu.SeriesQuery(SeriesInstanceUID='1.2.3.4.1'), self.dest_path)
+        self.assertEqual(len(self.scp.connections), 1)
+
+    def test_reconnect_after_drop(self):
+        self.scu.find(scu.StudyQuery(StudyDate='20130101-'))
+        self.scp.connections[0].shutdown(socket.SHUT_RDWR)     # the scanner drops the idle association
+        self.assertEqual(len(self.scu.find(scu.StudyQuery(StudyDate='20130101-'))), 1)
+        self.assertEqual(len(self.scp.connections), 2)
+
+
+
+class TestAssociationAccept(unittest.TestCase):
+
+    def setUp(self):
+        self.scp = dimse.SCP(0, 'NIMS', 'localhost').start()
+        self.port = self.scp.server_address[1]
+
+    def tearDown(self):
+        self.scp.stop()
+
+    def test_unsupported_transfer_syntax_is_rejected(self):
+        association = dimse.Association.request('localhost', self.port, 'SCANNER', 'NIMS', [dimse.VERIFICATION],
+                transfer_syntaxes=('1.2.840.10008.1.2.4.50',))
+        self.assertEqual(association.contexts, {})
+        association.abort()
+        association = dimse.Association.request('localhost', self.port, 'SCANNER', 'NIMS', [dimse.VERIFICATION],
+                transfer_syntaxes=('1.2.840.10008.1.2.4.50', nimsutil.dicomutil.IMPLICIT_VR_LITTLE_ENDIAN))
+        self.assertEqual(association.contexts, {1: (dimse.VERIFICATION, nimsutil.dicomutil.IMPLICIT_VR_LITTLE_ENDIAN)})
+        self.assertEqual(association.c_echo(), dimse.SUCCESS)
+        association.release()
+
+    def test_context_without_abstract_syntax_is_rejected(self):
+        sock = socket.create_connection(('localhost', self.port), 10)
+        contexts = (dimse._item(0x20, '\x01\x00\x00\x00' + dimse._item(0x40, nimsutil.dicomutil.IMPLICIT_VR_LITTLE_ENDIAN))
+                + dimse._item(0x20, '\x03\x00\x00\x00'))
+        dimse._send_pdu(sock, dimse.A_ASSOCIATE_RQ, '\x00\x01\x00\x00' + 'NIMS'.ljust(16) + 'SCANNER'.ljust(16) + '\x00' * 32
+                + dimse._item(0x10, dimse.APPLICATION_CONTEXT) + contexts + dimse._user_information(65536))
+        pdu_type, data = dimse._read_pdu(sock)
+        sock.close()
+        self.assertEqual(pdu_type, dimse.A_ASSOCIATE_AC)
+        results = dict((ord(item_data[0]), ord(item_data[2])) for item_type, item_data in dimse._items(data[68:]) if item_type == 0x21)
+        self.assertEqual(results, {1: 1, 3: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
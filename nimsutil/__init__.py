@@ -1,3 +1,4 @@
 # @author:  Gunnar Schaefer
 
 from nimsutil import *
+import dicomutil
@@ -0,0 +1,189 @@
+"""
+Minimal, header-only DICOM reading.
+
+Parsing a complete DICOM file is expensive when only a handful of tags are needed. read_tags() reads the data set
+sequentially and stops as soon as all requested tags have been passed, so pixel data is never read.
+"""
+
+import struct
+import hashlib
+import tarfile
+import datetime
+
+SOP_INSTANCE_UID = 0x00080018
+STUDY_DATE = 0x00080020
+SERIES_DATE = 0x00080021
+ACQUISITION_DATE = 0x00080022
+STUDY_TIME = 0x00080030
+SERIES_TIME = 0x00080031
+ACQUISITION_TIME = 0x00080032
+STUDY_INSTANCE_UID = 0x0020000D
+SERIES_INSTANCE_UID = 0x0020000E
+STUDY_ID = 0x00200010
+SERIES_NUMBER = 0x00200011
+ACQUISITION_NUMBER = 0x00200012
+
+IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
+EXPLICIT_VR_BIG_ENDIAN = '1.2.840.10008.1.2.2'
+DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1.99'
+
+LONG_VRS = set(['OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'SQ', 'SV', 'UC', 'UN', 'UR', 'UT', 'UV'])
+UNDEFINED_LENGTH = 0xFFFFFFFF
+ITEM = 0xFFFEE000
+ITEM_DELIMITER = 0xFFFEE00D
+SEQUENCE_DELIMITER = 0xFFFEE0DD
+
+
+class DicomError(Exception):
+    pass
+
+
+class _Stream(object):
+
+    """Sequential reader over a file-like object, with already consumed bytes pushed back in front."""
+
+    def __init__(self, fileobj, prefix=''):
+        self.fileobj = fileobj
+        self.prefix = prefix
+
+    def read(self, size):
+        if self.prefix:
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+            if len(data) < size and self.fileobj:
+                data += self.fileobj.read(size - len(data))
+            return data
+        return self.fileobj.read(size) if self.fileobj else ''
+
+    def skip(self, size):
+        while size > 0:
+            chunk = self.read(min(size, 1048576))
+            if not chunk:
+                raise DicomError('unexpected end of data')
+            size -= len(chunk)
+
+
+def _read_element_header(stream, explicit, endian):
+    header = stream.read(8)
+    if len(header) < 8:
+        return None, None
+    group, element = struct.unpack(endian + 'HH', header[:4])
+    tag = group << 16 | element
+    if explicit and group != 0xFFFE:
+        if header[4:6] in LONG_VRS:
+            length = struct.unpack(endian + 'L', stream.read(4))[0]
+        else:
+            length = struct.unpack(endian + 'H', header[6:8])[0]
+    else:
+        length = struct.unpack(endian + 'L', header[4:8])[0]
+    return tag, length
+
+
+def _skip_sequence(stream, explicit, endian):
+    """Skip the items of an undefined length sequence, up to and including its delimiter."""
+    while True:
+        tag, length = _read_element_header(stream, False, endian)
+        if tag is None or tag == SEQUENCE_DELIMITER:
+            return
+        if tag == ITEM and length == UNDEFINED_LENGTH:
+            _read_data_set(stream, explicit, endian)
+        elif length != UNDEFINED_LENGTH:
+            stream.skip(length)
+
+
+def _read_data_set(stream, explicit, endian, wanted=(), last_tag=None, values=None, raw=False):
+    """
+    Read elements until an item delimiter, the end of the data, or a tag beyond last_tag; wanted=None reads all.
+
+    Values are stripped of their padding, unless raw is set, which is needed for binary values.
+    """
+    while True:
+        tag, length = _read_element_header(stream, explicit, endian)
+        if tag is None or tag == ITEM_DELIMITER or (last_tag is not None and tag > last_tag):
+            return values
+        if length == UNDEFINED_LENGTH:
+            _skip_sequence(stream, explicit, endian)
+        elif wanted is None or tag in wanted:
+            values[tag] = stream.read(length) if raw else stream.read(length).rstrip('\x00 ')
+        else:
+            stream.skip(length)
+
+
+def read_tags(fileobj, tags):
+    """
+    Return a dict of the raw string values of the requested tags that are present in a DICOM file.
+
+    Tags are given as integers, e.g., 0x00080018 for SOPInstanceUID. Only the file meta information and the
+    elements up to the highest requested tag are read.
+    """
+    wanted = set(tags)
+    preamble = fileobj.read(132)
+    if preamble[128:132] == 'DICM':
+        stream = _Stream(fileobj)
+        tag, length = _read_element_header(stream, True, '<')
+        if tag != 0x00020000:
+            raise DicomError('missing file meta information group length')
+        meta = {}
+        _read_data_set(_Stream(None, stream.read(struct.unpack('<L', stream.read(length))[0])), True, '<', set([0x00020010]), None, meta)
+        transfer_syntax = meta.get(0x00020010, IMPLICIT_VR_LITTLE_ENDIAN)
+    else:
+        stream = _Stream(fileobj, preamble)     # no preamble, the data set starts right away
+        transfer_syntax = IMPLICIT_VR_LITTLE_ENDIAN
+    if transfer_syntax == DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN:
+        raise DicomError('deflated transfer syntax not supported')
+    explicit = transfer_syntax != IMPLICIT_VR_LITTLE_ENDIAN
+    endian = '>' if transfer_syntax == EXPLICIT_VR_BIG_ENDIAN else '<'
+    return _read_data_set(stream, explicit, endian, wanted, max(wanted), {})
+
+
+def read_data_set(data, transfer_syntax=IMPLICIT_VR_LITTLE_ENDIAN, tags=None):
+    """
+    Return a dict of the raw byte values of the top-level elements of an encoded data set, skipping sequences.
+
+    All elements are read, unless tags is given, in which case reading stops after the highest requested tag.
+    """
+    explicit = transfer_syntax != IMPLICIT_VR_LITTLE_ENDIAN
+    endian = '>' if transfer_syntax == EXPLICIT_VR_BIG_ENDIAN else '<'
+    wanted = set(tags) if tags else None
+    return _read_data_set(_Stream(None, data), explicit, endian, wanted, wanted and max(wanted), {}, True)
+
+
+def acquisition_info(fileobj):
+    """
+    Return (SOPInstanceUID, AcquisitionNumber, timestamp) of a DICOM file, reading its header only up to group 0020.
+
+    The timestamp is taken from the acquisition, series or study date and time, whichever is present first, and is
+    None if there is none. The acquisition number is 0 if absent.
+    """
+    values = read_tags(fileobj, [SOP_INSTANCE_UID, STUDY_DATE, SERIES_DATE, ACQUISITION_DATE, STUDY_TIME, SERIES_TIME,
+            ACQUISITION_TIME, ACQUISITION_NUMBER])
+    timestamp = None
+    for date_tag, time_tag in [(ACQUISITION_DATE, ACQUISITION_TIME), (SERIES_DATE, SERIES_TIME), (STUDY_DATE, STUDY_TIME)]:
+        if values.get(date_tag):
+            time_ = values.get(time_tag, '').replace(':', '')[:6].ljust(6, '0')
+            try:
+                timestamp = datetime.datetime.strptime(values[date_tag][:8] + time_, '%Y%m%d%H%M%S')
+                break
+            except ValueError:
+                pass
+    acq_no = values.get(ACQUISITION_NUMBER, '').strip()
+    return values.get(SOP_INSTANCE_UID), int(acq_no) if acq_no.isdigit() else 0, timestamp
+
+
+def instance_digest(data):
+    """Return (SOPInstanceUID, SHA-1 digest) for the bytes of one DICOM file; the uid is None if unreadable."""
+    try:
+        uid = read_tags(_Stream(None, data), [SOP_INSTANCE_UID]).get(SOP_INSTANCE_UID)
+    except (DicomError, struct.error):
+        uid = None
+    return uid, hashlib.sha1(data).digest()
+
+
+def instance_digests(path):
+    """Return a list of (SOPInstanceUID, SHA-1 digest) for a DICOM file or a tar archive of DICOM files."""
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path, 'r:*') as archive:
+            return [instance_digest(archive.extractfile(member).read()) for member in archive if member.isfile()]
+    else:
+        with open(path, 'rb') as fd:
+            return [instance_digest(fd.read())]
@@ -151,7 +151,8 @@ def get_epochs(username, group_name, exp_name, session_name, trash=False):
              .join(Experiment, Subject.experiment)
              .join(ResearchGroup, Experiment.owner)
              .filter(ResearchGroup.gid.ilike(unicode(group_name)))
-             .filter(Experiment.name.ilike(unicode(exp_name))))
+             .filter(Experiment.name.ilike(unicode(exp_name)))
+             .options(sqlalchemy.orm.contains_eager(Epoch.session)))
         if not '%' in sp[0]:
             q = q.filter(Session.exam==int(sp[2]))
         if not trash:
@@ -165,6 +166,10 @@ def get_epochs(username, group_name, exp_name, session_name, trash=False):
         epoch_names = []
     return epoch_names
 
+def datafile_mtime(datafile):
+    """Return the modification time of a file listed by get_datasets, from the db if recorded there."""
+    return time.mktime(datafile[4].timetuple()) if datafile[4] else os.path.getmtime(datafile[1])
+
 @memoize()
 def get_datasets(username, group_name, exp_name, session_name, epoch_name, datapath, trash=False):
     # FIXME: we should explicitly set the epoch name
@@ -177,14 +182,15 @@ def get_datasets(username, group_name, exp_name, session_name, epoch_name, datap
     if len(esp)>2 or '%' in epoch_name:
         q = (Dataset.query
              .join(Epoch, Dataset.container)
-             .join(Session, Epoch.session)
-             .join(Subject, Session.subject)
-             .join(Experiment, Subject.experiment)
-             .join(ResearchGroup, Experiment.owner)
+             .join(Session, Dataset.session)
+             .join(Experiment, Dataset.experiment)
+             .join(ResearchGroup, Dataset.research_group)
              .join(Access)
              .join(User, Access.user)
              .filter(ResearchGroup.gid.ilike(unicode(group_name)))
-             .filter(Experiment.name.ilike(unicode(exp_name))))
+             .filter(Experiment.name.ilike(unicode(exp_name)))
+             .add_entity(Epoch)     # each dataset with its epoch, in one round trip
+             .options(sqlalchemy.orm.subqueryload(Dataset.files)))
         if not '%' in exam:
             q = q.filter(Session.exam==int(exam))
         if len(esp)>1 and not '%' in esp[1]:
@@ -201,7 +207,7 @@ def get_datasets(username, group_name, exp_name, session_name, epoch_name, datap
         if '%' in epoch_name:
             # return a flat structure with legacy-style filenames
             datafiles = []
-            for d in q.all():
+            for d, epoch in q.all():
                 # The 'series_container_acq_description' name isn't guaranteed to be unique. Sometimes there are multiple
                 # files with different "extensions". We'll find the extensions here.
                 if len(d.filenames) > 1:
@@ -209,18 +215,20 @@ def get_datasets(username, group_name, exp_name, session_name, epoch_name, datap
                 else:
                     ext_start_ind = len(d.filenames[0].split('.')[0])
                 #print 'DATASET ' + str(d)
-                for f in d.filenames:
+                for df in d.files:
+                    f = df.name
                     if len(epoch_name)>1 and epoch_name[1]=='t':
                         if d.filetype==u'nifti':
-                            display_name = '%04d_%02d_%s%s' % (d.container.series, d.container.acq, d.container.scan_type, f[ext_start_ind:])
-                            datafiles.append((display_name.encode(), os.path.join(datapath,d.relpath,f).encode()))
+                            display_name = '%04d_%02d_%s%s' % (epoch.series, epoch.acq, epoch.scan_type, f[ext_start_ind:])
+                            datafiles.append((display_name.encode(), os.path.join(datapath,d.relpath,f).encode(), df.size, df.uncompressed_size, df.mtime))
                     else:
-                        display_name = '%04d_%02d_%s%s' % (d.container.series, d.container.acq, d.container.description, f[ext_start_ind:])
-                        datafiles.append((display_name.encode(), os.path.join(datapath,d.relpath,f).encode()))
+                        display_name = '%04d_%02d_%s%s' % (epoch.series, epoch.acq, epoch.description, f[ext_start_ind:])
+                        datafiles.append((display_name.encode(), os.path.join(datapath,d.relpath,f).encode(), df.size, df.uncompressed_size, df.mtime))
                     #print '   FILENAME=' + f + ' DISPLAY_NAME=' + display_name
         else:
             # Use the filename on disk
-            datafiles = [(f.encode(), os.path.join(datapath,d.relpath,f).encode()) for d in q.all() for f in d.filenames]
+            datafiles = [(df.name.encode(), os.path.join(datapath,d.relpath,df.name).encode(), df.size, df.uncompressed_size, df.mtime)
+                    for d, epoch in q.all() for df in d.files]
     else:
         datafiles = []
     return datafiles
@@ -289,19 +297,22 @@ class Nimsfs(fuse.LoggingMixIn, fuse.Operations):
                 sz = 1
                 if len(cur_path) == 6:
                     files = get_datasets(username, cur_path[1], cur_path[2], cur_path[3], cur_path[4], self.datapath)
-                    fname = next((f[1] for f in files if f[0]==cur_path[5]), None)
-                    if fname:
-                        sz = os.path.getsize(fname)
-                        ts = os.path.getmtime(fname)
+                    # sizes and times come from the db; only files recorded before they were tracked need a stat
+                    datafile = next((f for f in files if f[0]==cur_path[5]), None)
+                    if datafile:
+                        sz = datafile[2] if datafile[2] is not None else os.path.getsize(datafile[1])
+                        at = ct = mt = datafile_mtime(datafile)
                     elif cur_path[5].endswith('ugz'):
                         # Check to see if we're being asked about a gzipped file
                         fn = cur_path[5][:-3] +'gz'
-                        fname = next((f[1] for f in files if f[0]==fn), None)
-                        if fname:
-                            ts = os.path.getmtime(fname)
+                        datafile = next((f for f in files if f[0]==fn), None)
+                        if datafile:
+                            at = ct = mt = datafile_mtime(datafile)
+                        if datafile and datafile[3] is not None:
+                            sz = datafile[3]
+                        elif datafile:
                             # Apparently there's no way to get the uncompressed size except by reading the last four bytes.
-                            # TODO: consider saving this (as well as the timestamp) in the db.
-                            with open(fname, 'r') as fp:
+                            with open(datafile[1], 'r') as fp:
                                 fp.seek(-4,2)
                                 sz = struct.unpack('<I',fp.read())[0]
                         else:
@@ -6,6 +6,8 @@
 import os
 import re
 import gzip
+import heapq
+import fnmatch
 import shutil
 import string
 import tarfile
@@ -71,11 +73,15 @@ def parse_patient_id(patient_id, known_ids):
     Accept a NIMS-formatted patient id and return lab id and experiment id.
 
     We use fuzzy matching to find the best matching known lab id. If we can't
-    do so with high confidence, the lab id is set to 'unknown'.
+    do so with high confidence, the lab id is set to 'unknown'. known_ids can
+    be a list of lab ids or a CloseMatcher built from them.
     """
     subj_code, dummy, lab_info = patient_id.strip(string.punctuation + string.whitespace).lower().rpartition('@')
     lab_id, dummy, exp_id = (clean_string(z[0]) or z[1] for z in zip(lab_info.partition('/'), ('unknown', '', 'untitled')))
-    lab_id_matches = difflib.get_close_matches(lab_id, known_ids, cutoff=0.8)
+    if isinstance(known_ids, CloseMatcher):
+        lab_id_matches = known_ids.get_close_matches(lab_id)
+    else:
+        lab_id_matches = difflib.get_close_matches(lab_id, known_ids, cutoff=0.8)
     if len(lab_id_matches) == 1:
         lab_id = lab_id_matches[0]
     else:
@@ -84,6 +90,85 @@ def parse_patient_id(patient_id, known_ids):
     return (unicode(subj_code), unicode(lab_id), unicode(exp_id))
 
 
+class CloseMatcher(object):
+
+    """
+    Reusable replacement for difflib.get_close_matches() against a slowly changing set of possibilities.
+
+    Possibilities are bucketed by length, so that only those that can pass difflib's length bound are scored. The
+    scored matches of every looked-up word are kept and updated incrementally as possibilities are added or removed,
+    so repeated lookups, which are the common case, cost a single dict lookup.
+    """
+
+    def __init__(self, possibilities=(), n=3, cutoff=0.8, maxsize=4096):
+        self.n = n
+        self.cutoff = cutoff
+        self.maxsize = maxsize
+        self.words = set()
+        self.buckets = {}       # length: set of possibilities
+        self.matches = {}       # word: [(score, possibility), ...] for all possibilities scoring >= cutoff
+        self.refresh(possibilities)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def _score(self, s, x):
+        s.set_seq1(x)
+        if s.real_quick_ratio() >= self.cutoff and s.quick_ratio() >= self.cutoff and s.ratio() >= self.cutoff:
+            return s.ratio()
+
+    def add(self, word):
+        if word in self.words:
+            return
+        self.words.add(word)
+        self.buckets.setdefault(len(word), set()).add(word)
+        for query, matches in self.matches.iteritems():
+            s = difflib.SequenceMatcher()
+            s.set_seq2(query)
+            score = self._score(s, word)
+            if score is not None:
+                matches.append((score, word))
+
+    def remove(self, word):
+        if word not in self.words:
+            return
+        self.words.discard(word)
+        self.buckets[len(word)].discard(word)
+        if not self.buckets[len(word)]:
+            del self.buckets[len(word)]
+        for matches in self.matches.itervalues():
+            matches[:] = [m for m in matches if m[1] != word]
+
+    def refresh(self, possibilities):
+        """Incrementally update the matcher to contain exactly the given possibilities."""
+        possibilities = set(possibilities)
+        for word in self.words - possibilities:
+            self.remove(word)
+        for word in possibilities - self.words:
+            self.add(word)
+
+    def get_close_matches(self, word):
+        """Return the same list as difflib.get_close_matches(word, possibilities, n, cutoff)."""
+        if word not in self.matches:
+            if len(self.matches) >= self.maxsize:
+                self.matches.clear()
+            s = difflib.SequenceMatcher()
+            s.set_seq2(word)
+            matches = []
+            for length, bucket in self.buckets.iteritems():
+                if length + len(word) and 2.0 * min(length, len(word)) / (length + len(word)) < self.cutoff:
+                    continue    # cannot pass real_quick_ratio()
+                for x in bucket:
+                    score = self._score(s, x)
+                    if score is not None:
+                        matches.append((score, x))
+            self.matches[word] = matches
+        return [x for score, x in heapq.nlargest(self.n, self.matches[word])]
+
+
 def clean_string(string):
     """
     Nims standard string cleaning utility function.
@@ -202,6 +287,76 @@ def gzip_inplace(path, mode=None):
     os.remove(path)
 
 
+def gzip_copy(path, gzpath, mode=None):
+    """
+    Compress a file into gzpath in a single pass, and return the SHA-1 digest and size of its uncompressed content.
+
+    The source is read only once, so a large file is copied, compressed and hashed without a temporary copy.
+    """
+    hash_ = hashlib.sha1()
+    size = 0
+    with open(path, 'rb') as pathfile:
+        with gzip.open(gzpath, 'wb', compresslevel=4) as gzfile:
+            for chunk in iter(lambda: pathfile.read(1048576), ''):
+                hash_.update(chunk)
+                size += len(chunk)
+                gzfile.write(chunk)
+    shutil.copystat(path, gzpath)
+    if mode: os.chmod(gzpath, mode)
+    return hash_.digest(), size
+
+
+NUMBERED_SUFFIXES = ('_dicoms.tgz', '_physio.tgz')
+
+
+def numbered_filename(filename, number):
+    """
+    Return filename with a number inserted before its conventional suffix, e.g., 1_2_1_2_dicoms.tgz for 1_2_1_dicoms.tgz.
+
+    Return None for names that are recognized by their exact form and cannot take a number: PFiles (P?????.7, possibly
+    gzipped), and auxiliary files, which are matched to their main file by name (_<main file>_<kind>).
+    """
+    if filename.startswith('_') or fnmatch.fnmatch(filename, 'P?????.7') or fnmatch.fnmatch(filename, 'P?????.7.gz'):
+        return None
+    for suffix in NUMBERED_SUFFIXES:
+        if filename.endswith(suffix):
+            return '%s_%d%s' % (filename[:-len(suffix)], number, suffix)
+    root, dot, ext = filename.partition('.')
+    return '%s_%d%s%s' % (root, number, dot, ext)
+
+
+MANIFEST_FILENAME = '.manifest'
+
+
+def write_manifest(dirpath, entries):
+    """Record the SHA-1 digest and uncompressed size of files in a directory, given as {filename: (digest, size)}."""
+    with open(os.path.join(dirpath, MANIFEST_FILENAME), 'w') as manifest:
+        for filename, (digest, size) in sorted(entries.iteritems()):
+            manifest.write('%s %d %s\n' % (digest.encode('hex'), size, filename))
+
+
+def read_manifest(dirpath):
+    """Return {filename: (digest, size)} from the manifest of a directory, or an empty dict if there is none."""
+    entries = {}
+    try:
+        with open(os.path.join(dirpath, MANIFEST_FILENAME)) as manifest:
+            for line in manifest:
+                digest, size, filename = line.rstrip('\n').split(' ', 2)
+                entries[filename] = (digest.decode('hex'), int(size))
+    except IOError:
+        pass
+    return entries
+
+
+def file_digest(path):
+    """Return the SHA-1 digest of the uncompressed content of a file."""
+    hash_ = hashlib.sha1()
+    with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as fd:
+        for chunk in iter(lambda: fd.read(1048576), ''):
+            hash_.update(chunk)
+    return hash_.digest()
+
+
 def redigest(path):
 
     def hash_file(fd):
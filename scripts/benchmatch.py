@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""Compare nimsutil.CloseMatcher against difflib.get_close_matches for research group lookups."""
+
+import time
+import random
+import string
+import difflib
+import argparse
+
+import nimsutil
+
+
+def random_id(rng):
+    return ''.join(rng.choice(string.ascii_lowercase) for i in range(rng.randint(4, 10)))
+
+
+def mutate(rng, word):
+    i = rng.randrange(len(word))
+    op = rng.choice('sdik')
+    if op == 's':
+        return word[:i] + rng.choice(string.ascii_lowercase) + word[i+1:]
+    elif op == 'd':
+        return word[:i] + word[i+1:]
+    elif op == 'i':
+        return word[:i] + rng.choice(string.ascii_lowercase) + word[i:]
+    return word
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super(ArgumentParser, self).__init__()
+        self.add_argument('-g', '--groups', type=int, default=2000, help='number of known group ids')
+        self.add_argument('-n', '--lookups', type=int, default=2000, help='number of lookups')
+        self.add_argument('-d', '--distinct', type=int, default=50, help='number of distinct lab ids looked up')
+        self.add_argument('-s', '--seed', type=int, default=0, help='random seed')
+
+
+if __name__ == '__main__':
+    args = ArgumentParser().parse_args()
+    rng = random.Random(args.seed)
+    known_ids = list(set(random_id(rng) for i in range(args.groups)))
+    lab_ids = [mutate(rng, rng.choice(known_ids)) if rng.random() < 0.8 else random_id(rng) for i in range(args.distinct)]
+    lookups = [rng.choice(lab_ids) for i in range(args.lookups)]
+
+    start = time.time()
+    matcher = nimsutil.CloseMatcher(known_ids, cutoff=0.8)
+    build_time = time.time() - start
+
+    start = time.time()
+    expected = [difflib.get_close_matches(lab_id, known_ids, cutoff=0.8) for lab_id in lookups]
+    difflib_time = time.time() - start
+
+    start = time.time()
+    actual = [matcher.get_close_matches(lab_id) for lab_id in lookups]
+    matcher_time = time.time() - start
+
+    mismatches = sum(e != a for e, a in zip(expected, actual))
+    print '%d group ids, %d lookups of %d lab ids, %d mismatches' % (len(known_ids), len(lookups), len(set(lookups)), mismatches)
+    print 'difflib:      %8.3fs (%.3fms per lookup)' % (difflib_time, 1000. * difflib_time / len(lookups))
+    print 'CloseMatcher: %8.3fs (%.3fms per lookup, %.3fs to build)' % (matcher_time, 1000. * matcher_time / len(lookups), build_time)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+Check that the hot queries of the scheduler, processor and web app are planned with their indexes.
+
+An empty database is filled with a synthetic hierarchy of a realistic shape, analyzed, and each query is run through
+EXPLAIN (EXPLAIN QUERY PLAN on SQLite). A query fails the check if none of its expected indexes appears in its plan.
+Partial indexes are PostgreSQL-only; on other databases, queries that depend on them alone are skipped.
+Use a scratch database: the schema is created from the model, and the database must not contain any data.
+"""
+
+import sys
+import random
+import datetime
+import argparse
+
+import sqlalchemy as sa
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Executable, ClauseElement
+
+from nimsgears import model
+from nimsgears.model import *
+
+SCAN_TYPES = [u'anatomy_t1w', u'anatomy_t2w', u'anatomy_pd', u'anatomy_ir', u'localizer', u'field_map', u'calibration',
+        u'functional', u'diffusion', u'spectroscopy', u'perfusion', u'shim', u'unknown']
+
+
+class Explain(Executable, ClauseElement):
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def visit_explain(element, compiler, **kw):
+    return 'EXPLAIN ' + compiler.process(element.statement)
+
+
+@compiles(Explain, 'sqlite')
+def visit_explain_sqlite(element, compiler, **kw):
+    return 'EXPLAIN QUERY PLAN ' + compiler.process(element.statement)
+
+
+def populate(engine, rng, experiments, sessions, epochs, chunksize=5000):
+    """Fill the database with experiments, sessions of epochs with three datasets and one job each, and access rows."""
+    now = datetime.datetime.now()
+    rows = dict((table, []) for table in model.metadata.sorted_tables)
+    rows[ResearchGroup.table] = [dict(id=i+1, gid=u'group%d' % (i+1)) for i in range(max(1, experiments / 5))]
+    rows[User.table] = [dict(id=i+1, uid=u'user%d' % (i+1)) for i in range(max(1, experiments / 2))]
+    ids = iter(xrange(1, sys.maxint))
+
+    def container(cls, timestamp, **kwargs):
+        id_ = ids.next()
+        rows[DataContainer.table].append(dict(id=id_, timestamp=timestamp, dirty=rng.random() < 0.001, scheduling=False,
+                trashtime=(now if rng.random() < 0.01 else None), row_type=cls.mapper.polymorphic_identity))
+        kwargs['datacontainer_id'] = id_
+        rows[cls.table].append(kwargs)
+        return id_
+
+    exp_ids = [container(Experiment, now, name=u'exp%d' % i, owner_id=rng.randint(1, len(rows[ResearchGroup.table])))
+            for i in range(experiments)]
+    exp_owner = dict((row['datacontainer_id'], row['owner_id']) for row in rows[Experiment.table])
+    for user in rows[User.table]:
+        for exp_id in rng.sample(exp_ids, min(len(exp_ids), 5)):
+            rows[Access.table].append(dict(user_id=user['id'], experiment_datacontainer_id=exp_id, privilege=rng.randint(1, 4)))
+    for i in range(sessions):
+        timestamp = now - datetime.timedelta(hours=i)
+        exp_id = rng.choice(exp_ids)
+        subj_id = container(Subject, timestamp, code=u's%d' % i, experiment_datacontainer_id=exp_id)
+        sess_id = container(Session, timestamp, exam=i, subject_datacontainer_id=subj_id)
+        ancestry = dict(experiment_datacontainer_id=exp_id, research_group_id=exp_owner[exp_id])
+        for j in range(epochs):
+            epoch_id = container(Epoch, timestamp, series=j+1, acq=0, session_datacontainer_id=sess_id,
+                    psd=u'psd%d' % rng.randint(1, 50), scan_type=rng.choice(SCAN_TYPES), **ancestry)
+            for kind, filetype in [(u'primary', u'dicom'), (u'derived', u'nifti'), (u'peripheral', u'physio')]:
+                rows[Dataset.table].append(dict(container_id=epoch_id, session_datacontainer_id=sess_id, kind=kind,
+                        filetype=filetype, updatetime=timestamp, trashtime=(now if rng.random() < 0.01 else None), **ancestry))
+            status = rng.choice([u'done'] * 97 + [u'failed', u'pending', u'running'])
+            rows[Job.table].append(dict(data_container_id=epoch_id, task=u'find&proc', status=status, needs_rerun=rng.random() < 0.001))
+    for table in model.metadata.sorted_tables:
+        for i in range(0, len(rows[table]), chunksize):
+            engine.execute(table.insert(), rows[table][i:i+chunksize])
+    engine.execute('ANALYZE')
+
+
+def checks(cooltime=datetime.timedelta(seconds=30)):
+    """Return (description, query, names of indexes, any of which should be used) for each hot query."""
+    user = User.query.first()
+    epoch = Epoch.query.first()
+    return [
+            ('processor: next pending job',
+                Job.query.join(DataContainer).join(Epoch).filter(Job.task == u'find&proc').filter(Job.status == u'pending').order_by(Job.id),
+                ['ix_job_pending']),
+            ('scheduler: jobs to rerun',
+                Job.query.filter((Job.status != u'running') & (Job.status != u'abandoned') & (Job.needs_rerun == True)),
+                ['ix_job_needs_rerun']),
+            ('scheduler: job of a data container',
+                Job.query.filter_by(data_container=epoch).filter_by(task=u'find&proc'),
+                ['ix_job_data_container_id_task']),
+            ('scheduler: jobs to archive',
+                Job.query.filter(Job.status.in_([u'done', u'abandoned'])).filter(sa.func.coalesce(Job.needs_rerun, False) == False)
+                    .filter(Job.updatetime < datetime.datetime.now() - datetime.timedelta(days=30)).limit(1000),
+                ['ix_job_status_id']),
+            ('scheduler: oldest cool dirty data container',
+                DataContainer.query.filter(DataContainer.dirty == True)
+                    .filter(~DataContainer.datasets.any(Dataset.updatetime > (datetime.datetime.now() - cooltime)))
+                    .order_by(DataContainer.timestamp),
+                ['ix_datacontainer_dirty_timestamp', 'ix_datacontainer_dirty']),
+            ('status page: failed jobs',
+                Job.query.filter(Job.status == u'failed').order_by(Job.id),
+                ['ix_job_status_id', 'ix_job_pending']),
+            ('browse: accessible sessions',
+                user._filter_access(Session.toplevel_query(), u'Read-Only'),
+                ['ix_access_user_experiment', 'ix_access_user_id']),
+            ('nimsfs: session by exam',
+                Session.query.filter(Session.exam == 1234),
+                ['ix_session_exam']),
+            ('nimsfs: epoch by series',
+                Epoch.query.filter(Epoch.session == epoch.session).filter(Epoch.series == 3).filter(Epoch.acq == 0),
+                ['ix_epoch_session_series_acq']),
+            ('search: epochs by psd',
+                Epoch.query.filter(Epoch.psd == u'psd7'),
+                ['ix_epoch_psd']),
+            ('search: epochs by scan type',
+                Epoch.query.filter(Epoch.scan_type == u'spectroscopy'),
+                ['ix_epoch_scan_type']),
+            ('epoch datasets of a kind',
+                Dataset.query.filter(Dataset.container == epoch).filter(Dataset.kind == u'primary').filter(Dataset.trashtime == None),
+                ['ix_dataset_container_id_kind']),
+            ('physio datasets',
+                Dataset.query.filter(Dataset.kind == u'peripheral').filter(Dataset.filetype == u'physio').filter(Dataset.container == epoch),
+                ['ix_dataset_container_id_kind', 'ix_dataset_kind_filetype']),
+            ('trashed datasets',
+                Dataset.query.filter(Dataset.trashtime != None),
+                ['ix_dataset_trashtime']),
+            ('trashed data containers',
+                DataContainer.query.filter(DataContainer.trashtime != None),
+                ['ix_datacontainer_trashtime']),
+            ]
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super(ArgumentParser, self).__init__()
+        self.add_argument('db_uri', nargs='?', default='sqlite://', help='URI of an empty scratch database (default: in-memory SQLite)')
+        self.add_argument('-e', '--experiments', type=int, default=100, help='number of experiments')
+        self.add_argument('-n', '--sessions', type=int, default=4000, help='number of sessions')
+        self.add_argument('-p', '--epochs', type=int, default=10, help='number of epochs per session')
+        self.add_argument('-s', '--seed', type=int, default=0, help='random seed')
+        self.add_argument('-v', '--verbose', action='store_true', help='print the plans of passing queries, too')
+
+
+if __name__ == '__main__':
+    args = ArgumentParser().parse_args()
+    engine = sa.create_engine(args.db_uri)
+    model.init_model(engine)
+    model.metadata.create_all(engine)
+    if DBSession.query(DataContainer.id).first():
+        sys.exit('%s is not empty' % args.db_uri)
+    populate(engine, random.Random(args.seed), args.experiments, args.sessions, args.epochs)
+    print '%d epochs, %d datasets, %d jobs' % (Epoch.query.count(), Dataset.query.count(), Job.query.count())
+
+    partial_index_names = set(index.name for table in model.metadata.sorted_tables for index in table.indexes
+            if index.kwargs.get('postgresql_where') is not None)
+    failures = 0
+    for description, query, index_names in checks():
+        plan = '\n'.join(unicode(tuple(row)[-1]) for row in DBSession.execute(Explain(query.statement)))
+        ok = any(name in plan for name in index_names)
+        if not ok and engine.dialect.name != 'postgresql' and partial_index_names.issuperset(index_names):
+            print 'skip %s (partial index)' % description
+            continue
+        failures += not ok
+        print '%-4s %s' % ('ok' if ok else 'FAIL', description)
+        if args.verbose or not ok:
+            print '     ' + plan.replace('\n', '\n     ')
+    sys.exit(failures and 1)
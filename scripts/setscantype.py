@@ -14,8 +14,8 @@ class DummyImage(nimsimage.NIMSImage):
         self.te = te
         self.psd_type = psd_type
         self.is_dwi = is_dwi
-        self.fov = np.fromstring(fov[1:-1], sep=',')
-        self.mm_per_vox = np.fromstring(mm_per_vox[1:-1], sep=',')
+        self.fov = np.array(fov, dtype=float)
+        self.mm_per_vox = np.array(mm_per_vox, dtype=float)
         self.num_timepoints = num_timepoints
 
 epochs = Epoch.query.filter(Epoch.scan_type=='anatomy').all()
@@ -24,12 +24,11 @@ ids = [e.id for e in epochs]
 for id in ids:
     e = Epoch.query.filter(Epoch.id==id).first()
     # fix bad fov's
-    #fov = np.fromstring(e.fov[1:-1], sep=',')
-    #if fov.size==1:
+    #fov = np.array(e.fov, dtype=float)
+    #if e.fov_y is None:
     #    fov = np.array([fov[0],fov[0]])
     #fov[fov<5.] *= 100.
-    #e.fov = unicode(str(list(fov.round(3))))
-    #e.fov = unicode('[%0.2f, %0.2f]' % (fov[0], fov[1]))
+    #e.fov = list(fov.round(3))
     psd_type = nimsimage.infer_psd_type(e.psd)
     # hack to infer dwi. (All dwi's at CNI use some variant of the epi2 psd.)
     if 'epi' in psd_type and 'epi2' in e.psd: